@@ -0,0 +1,296 @@
+# Define the CSR_Graph class.
+# A compact graph type: neighbors of all nodes are stored in two int32 arrays
+# (compressed sparse row format), instead of a dict of lists.
+# Graphs can be saved in a binary file (header followed by arrays), and
+# loaded by memory-mapping, so that there is no parsing, and processes
+# reading the same file share pages.
+
+# Filename: csr_graph.py
+
+import struct
+import numpy as np
+import itertools
+from scipy import sparse
+
+# Binary file format (little-endian):
+#   header (64 bytes): magic (8 bytes), version (uint32), 0 (uint32),
+#       n_nodes, n_indices, n_entries (int64 each), zeros.
+#   indptr (int32, n_nodes + 1), indices (int32, n_indices),
+#   nodes (int32, n_entries).
+graph_file_extension = '.csrg'
+graph_file_magic = 'CSRGRAPH'
+graph_file_version = 1
+graph_file_header = struct.Struct('<8sIIqqq')
+graph_file_header_size = 64
+
+
+def is_graph_file(filename):
+    """
+    Check if the filename is for the binary graph file (by its extension).
+    """
+    return filename.endswith(graph_file_extension)
+
+
+class CSR_Graph():
+    """
+    Graph in the compressed sparse row (CSR) format.
+    Neighbors of node i are indices[indptr[i]:indptr[i + 1]] (sorted,
+    without duplicates), so slicing neighbors takes O(1), and membership
+    tests take O(log(degree)).
+    Node ID's are row numbers (0 to n_nodes-1); nodes stores the ID's that
+    have an entry in the dict of lists form (keys of the dict).
+    """
+    def __init__(self, indptr, indices, nodes=None):
+        """
+        Constructor for CSR_Graph class.
+        Input:
+            indptr: np.array (n_nodes + 1) of int32
+            indices: np.array of int32 (sorted for each node)
+            nodes: ID's with an entry (sorted np.array; default: None,
+                all ID's from 0 to n_nodes-1)
+        """
+        self.indptr = np.asarray(indptr, dtype=np.int32)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.n_nodes = len(self.indptr) - 1
+        if nodes is None:
+            nodes = np.arange(self.n_nodes)
+        self.nodes = np.asarray(nodes, dtype=np.int32)
+
+    @classmethod
+    def from_edges(cls, src, dst, n_nodes, nodes=None):
+        """
+        Build a graph from arrays of edges (src -> dst). Repeated edges are
+        merged into one (the graph has no multiple edges).
+        Input:
+            src, dst: np.arrays of node ID's (same size)
+            n_nodes: number of nodes (larger than any ID)
+            nodes: ID's with an entry (default: None, unique ID's of src)
+        Output:
+            graph: CSR_Graph
+        """
+        src = np.asarray(src, dtype=np.int64)
+        dst = np.asarray(dst, dtype=np.int64)
+        if nodes is None:
+            nodes = np.unique(src)
+        adjacency = sparse.csr_matrix((np.ones(len(src), dtype=np.int8),
+                                       (src, dst)), shape=(n_nodes, n_nodes))
+        adjacency.sum_duplicates()  # also sorts indices.
+        return cls(adjacency.indptr, adjacency.indices, nodes)
+
+    @classmethod
+    def from_dictlist(cls, graph_dict, n_nodes=None):
+        """
+        Build a graph from a dict of lists (e.g., from read_dictlist_from_file)
+        Repeated neighbors in a list are kept once (see from_edges).
+        Input:
+            graph_dict: dict of lists representing a graph.
+            n_nodes: number of nodes (default: None, the largest ID + 1)
+        Output:
+            graph: CSR_Graph
+        """
+        nodes = np.fromiter(graph_dict.iterkeys(), dtype=np.int64,
+                            count=len(graph_dict))
+        degrees = np.fromiter((len(graph_dict[node]) for node in nodes),
+                              dtype=np.int64, count=len(nodes))
+        src = np.repeat(nodes, degrees)
+        dst = np.fromiter(itertools.chain.from_iterable(graph_dict[node]
+                                                        for node in nodes),
+                          dtype=np.int64, count=degrees.sum())
+        if n_nodes is None:
+            n_nodes = np.concatenate(([-1], nodes, dst)).max() + 1
+        return cls.from_edges(src, dst, n_nodes, np.sort(nodes))
+
+    def save(self, filename):
+        """
+        Save the graph in the binary format (see my_utilities.atomic_open).
+        Input:
+            filename: name of the file
+        Output:
+            None
+        """
+        # Imported here, since my_utilities imports this module.
+        from my_utilities import atomic_open
+        header = graph_file_header.pack(graph_file_magic, graph_file_version,
+                                        0, self.n_nodes, len(self.indices),
+                                        len(self.nodes))
+        with atomic_open(filename) as f:
+            f.write(header.ljust(graph_file_header_size, '\0'))
+            for array in (self.indptr, self.indices, self.nodes):
+                f.write(array.astype('<i4').tostring())
+        return
+
+    @classmethod
+    def load(cls, filename, mmap_mode='r'):
+        """
+        Load a graph saved in the binary format by memory-mapping.
+        Input:
+            filename: name of the file
+            mmap_mode: mode for np.memmap; None to read into memory
+                (default: 'r', read-only)
+        Output:
+            graph: CSR_Graph (arrays are views of the file)
+        """
+        with open(filename, 'rb') as f:
+            header = f.read(graph_file_header_size)
+        if len(header) < graph_file_header_size:
+            raise ValueError("Not a graph file: " + filename)
+        (magic, version, _, n_nodes, n_indices, n_entries) =\
+            graph_file_header.unpack(header[:graph_file_header.size])
+        if magic != graph_file_magic or version != graph_file_version:
+            raise ValueError("Not a graph file (or unknown version): " +
+                             filename)
+        sizes = [n_nodes + 1, n_indices, n_entries]
+        arrays = []
+        offset = graph_file_header_size
+        for size in sizes:
+            if mmap_mode is None:
+                with open(filename, 'rb') as f:
+                    f.seek(offset)
+                    array = np.fromfile(f, dtype='<i4', count=size)
+            elif size == 0:
+                array = np.zeros(0, dtype='<i4')
+            else:
+                array = np.memmap(filename, dtype='<i4', mode=mmap_mode,
+                                  offset=offset, shape=(size,))
+            arrays.append(array)
+            offset += 4 * size
+        return cls(*arrays)
+
+    def to_dictlist(self):
+        """
+        Convert the graph into a dict of lists (sorted neighbors).
+        Output:
+            graph_dict: dict of lists representing the graph.
+        """
+        graph_dict = {}
+        for node in self.nodes.tolist():
+            graph_dict[node] = self.neighbors(node).tolist()
+        return graph_dict
+
+    def neighbors(self, node):
+        """
+        Return neighbors of the node (sorted np.array, a view).
+        """
+        return self.indices[self.indptr[node]:self.indptr[node + 1]]
+
+    def degree(self, node):
+        """
+        Return the degree of the node.
+        """
+        return self.indptr[node + 1] - self.indptr[node]
+
+    def degrees(self):
+        """
+        Return degrees of all nodes (np.array).
+        """
+        return np.diff(self.indptr)
+
+    def has_edge(self, node1, node2):
+        """
+        Check if node2 is a neighbor of node1 (binary search).
+        """
+        if node1 >= self.n_nodes:
+            return False
+        start = self.indptr[node1]
+        end = self.indptr[node1 + 1]
+        i = start + np.searchsorted(self.indices[start:end], node2)
+        return i < end and self.indices[i] == node2
+
+    def edges(self, nodes=None):
+        """
+        Return edges from given nodes as arrays (src, dst), with edges from
+        the same node contiguous, in the order of nodes.
+        Input:
+            nodes: np.array of node ID's (default: None, all nodes)
+        Output:
+            src, dst: np.arrays of node ID's
+        """
+        if nodes is None:
+            return (np.repeat(np.arange(self.n_nodes), self.degrees()),
+                    np.asarray(self.indices))
+        nodes = np.asarray(nodes, dtype=np.int64)
+        nodes = nodes[nodes < self.n_nodes]
+        starts = self.indptr[nodes].astype(np.int64)
+        lengths = self.indptr[nodes + 1] - starts
+        # Positions in indices for edges of each node.
+        positions = np.arange(lengths.sum()) +\
+            np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        return (np.repeat(nodes, lengths), self.indices[positions])
+
+    def n_edges(self):
+        """
+        Return the number of (directed) edges.
+        """
+        return len(self.indices)
+
+    def to_sparse(self, size=None):
+        """
+        Return the adjacency matrix (csr, int8, sorted indices), sharing
+        the arrays of the graph.
+        Input:
+            size: number of rows and columns (>= n_nodes; default: n_nodes)
+        Output:
+            adjacency: sparse.csr_matrix
+        """
+        indptr = self.indptr
+        if size is None:
+            size = self.n_nodes
+        elif size > self.n_nodes:
+            indptr = np.append(indptr, np.repeat(indptr[-1],
+                                                 size - self.n_nodes))
+        adjacency = sparse.csr_matrix((np.ones(len(self.indices),
+                                               dtype=np.int8),
+                                       self.indices, indptr),
+                                      shape=(size, size))
+        adjacency.has_sorted_indices = True
+        return adjacency
+
+    def two_hop(self):
+        """
+        Find neighbors of neighbors of every node, excluding the node itself
+        and its neighbors, from the sparse product A * A.
+        Output:
+            graph: CSR_Graph (same nodes)
+        """
+        adjacency = self.to_sparse().astype(np.int32)
+        paths = adjacency * adjacency
+        exclude = adjacency + sparse.identity(self.n_nodes, dtype=np.int32,
+                                              format='csr')
+        exclude.data[:] = 1
+        # Numbers of paths are kept only where exclude is zero.
+        paths = paths - paths.multiply(exclude)
+        paths.eliminate_zeros()
+        paths.sort_indices()
+        return CSR_Graph(paths.indptr, paths.indices, self.nodes)
+
+    def reindex(self, users_id_map):
+        """
+        Map node ID's with the given map (same as reindex_graph with a map):
+        nodes and neighbors not in the map are dropped.
+        Input:
+            users_id_map: map for old ID to new ID (dict, new ID's from 0)
+        Output:
+            graph: CSR_Graph (n_nodes: size of the map)
+            num_not_counted: number of distinct old ID's not in the map.
+        """
+        old_ids = np.fromiter(users_id_map.iterkeys(), dtype=np.int64,
+                              count=len(users_id_map))
+        new_ids = np.fromiter(users_id_map.itervalues(), dtype=np.int64,
+                              count=len(users_id_map))
+        inside = (old_ids >= 0) & (old_ids < self.n_nodes)
+        id_map = np.empty(self.n_nodes, dtype=np.int64)
+        id_map.fill(-1)
+        id_map[old_ids[inside]] = new_ids[inside]
+
+        (src, dst) = self.edges()
+        new_src = id_map[src]
+        new_dst = id_map[dst]
+        new_nodes = id_map[self.nodes]
+        not_counted = np.union1d(self.nodes[new_nodes < 0],
+                                 self.indices[(new_src >= 0) &
+                                              (new_dst < 0)])
+        keep = (new_src >= 0) & (new_dst >= 0)
+        graph = CSR_Graph.from_edges(new_src[keep], new_dst[keep],
+                                     len(users_id_map),
+                                     np.sort(new_nodes[new_nodes >= 0]))
+        return graph, len(not_counted)
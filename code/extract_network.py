@@ -4,48 +4,35 @@
 # by Suhan Ree
 # last edited on 06-17-2015
 
-import os
-import cPickle as pickle
-
-from my_utilities import read_json_file
+from my_utilities import read_json_file, find_id_map
 from my_utilities import write_dictlist_to_file, write_dict_to_file
+from my_utilities import write_graph_to_file
 
-# Filename for the pickled data of user_id and numbered id map.
+# Filenames for the data.
 # inputs:
 userdata_filename = '../data/yelp_academic_dataset_user.json'
 
 # outputs:
-pickle_filename = '../data/user_id_map.pkl'
+user_id_map_dir = '../data/columns/user_id_map'
 network_filename = '../data/network.csv'
+network_graph_filename = '../data/network.csrg'  # binary (memory-mapped)
 degree_filename = '../data/degrees'
 
 
 def main():
     """
     From the json file, it will extract the network data, and saves them
-    into a csv file.
+    into a csv file (and a binary file).
     """
     # Now we have to read from a data file in json.
     # user_json should be the list of json objects.
     user_jsons = read_json_file(userdata_filename)
 
     # Each user will be assigned with an integer instead of string user_id's.
-    # This mapping data will be stored in a dictionary, and will be pickled.
-    # But if this info is already pickled it will just read from it.
-    if os.path.exists(pickle_filename):
-        print "Reading from the pickled data..."
-        with open(pickle_filename, 'r') as f:
-            user_id_map = pickle.load(f)
-    else:
-        user_id_map = {}
-        id = 0
-        for user_json in user_jsons:
-            user_id = user_json['user_id']
-            if user_id not in user_id_map:
-                user_id_map[user_id] = id
-                id += 1
-        with open(pickle_filename, 'wb') as f:
-            pickle.dump(user_id_map, f)
+    # This mapping data will be stored in a dictionary, and will be saved
+    # in the columnar format (shared with make_dataframes.py).
+    # But if this info is already saved it will just read from it.
+    user_id_map = find_id_map(user_jsons, 'user_id', user_id_map_dir)
 
     # Now it is time to find network & degree data.
     friends = {}
@@ -61,6 +48,7 @@ def main():
 
     # Saving network & degree information to a file (csv).
     write_dictlist_to_file(network_filename, friends)
+    write_graph_to_file(network_graph_filename, friends)
     write_dict_to_file(degree_filename, degrees)
 
     return
@@ -5,6 +5,194 @@
 
 import numpy as np
 import itertools
+import atexit
+import json
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+from multiprocessing import Pool, current_process
+
+from my_utilities import atomic_open
+
+# Directory for factors saved by saving_matrices (if no store is given).
+default_factor_directory = '../data/factors'
+
+# Process pools for the ALS solver (key: number of processes), created once
+# per process and shared by all fits (e.g., of a sweep). Scripts close them
+# with close_als_pools when done (they are also closed at exit).
+als_pools = {}
+
+
+def get_als_pool(n_jobs):
+    """
+    Return the process pool of n_jobs processes for the ALS solver (created
+    at the first call, and reused by later fits).
+    """
+    if n_jobs not in als_pools:
+        if not als_pools:
+            atexit.register(close_als_pools)
+        als_pools[n_jobs] = Pool(n_jobs)
+    return als_pools[n_jobs]
+
+
+def close_als_pools():
+    """
+    Close process pools created by get_als_pool.
+    """
+    for pool in als_pools.itervalues():
+        pool.close()
+        pool.join()
+    als_pools.clear()
+
+
+def scatter_add(mat, index, values):
+    """
+    Add rows of values into rows of mat given by index, accumulating
+    repeated indices (like np.add.at, but much faster).
+    Input:
+        mat: 2d np.array to be updated in place.
+        index: row indices (1d np.array of int)
+        values: rows to be added (2d np.array, len(index) rows)
+    Output:
+        None
+    """
+    unique_index, inverse = np.unique(index, return_inverse=True)
+    sums = np.zeros((unique_index.size, mat.shape[1]))
+    for k in xrange(mat.shape[1]):
+        sums[:, k] = np.bincount(inverse, weights=values[:, k],
+                                 minlength=unique_index.size)
+    mat[unique_index] += sums
+
+
+def solve_ridge_block(args):
+    """
+    Solve the ridge (regularized least squares) systems for a contiguous
+    block of rows of u (or columns of v) in closed form, with the other
+    factor matrix held fixed. All systems in the block are built with
+    bincount and solved in one batched call.
+    (module-level function so that it can be used by a process pool)
+    Input:
+        args: tuple of
+            index: row index (within the block) of each rating (1d np.array)
+            other_index: index of each rating in the other factor matrix
+            values: adjusted ratings (1d np.array)
+            other_mat: fixed factor matrix (2d np.array, one row per index)
+            n_rows: number of rows in the block
+            regularization_param: regularization parameter (float)
+    Output:
+        solution: np.array (n_rows, n_features)
+    """
+    (index, other_index, values, other_mat, n_rows, regularization_param) =\
+        args
+    n_features = other_mat.shape[1]
+    x = other_mat[other_index]
+    gram = np.zeros((n_rows, n_features, n_features))
+    rhs = np.zeros((n_rows, n_features))
+    for k in xrange(n_features):
+        rhs[:, k] = np.bincount(index, weights=x[:, k] * values,
+                                minlength=n_rows)
+        for l in xrange(k, n_features):
+            gram[:, k, l] = np.bincount(index, weights=x[:, k] * x[:, l],
+                                        minlength=n_rows)
+            gram[:, l, k] = gram[:, k, l]
+    # Regularization scaled by the number of ratings (at least one, so that
+    # rows without any rating are solved to zero).
+    counts = np.bincount(index, minlength=n_rows)
+    diag = np.arange(n_features)
+    gram[:, diag, diag] += \
+        regularization_param * np.maximum(counts, 1).reshape(-1, 1)
+    try:
+        return np.linalg.solve(gram, rhs)
+    except np.linalg.LinAlgError:
+        # Singular systems (e.g., regularization_param=0 and fewer ratings
+        # than n_features): minimum-norm least squares solutions instead.
+        return np.einsum('ijk,ik->ij', np.linalg.pinv(gram), rhs)
+
+
+def solve_shared_block(args):
+    """
+    Solve one block of the ALS solver in a worker process (see
+    solve_ridge_block), with arrays memory-mapped from the files written by
+    Matrix_Factorization._als_share, so that only filenames are sent.
+    Input:
+        args: tuple of
+            directory: directory of the files
+            block_name: name of the block (e.g., 'user0')
+            side: 'user' or 'item' (for the file of the fixed factor matrix)
+            n_rows: number of rows in the block
+            regularization_param: regularization parameter (float)
+    Output:
+        solution: np.array (n_rows, n_features)
+    """
+    (directory, block_name, side, n_rows, regularization_param) = args
+    (index, other_index, values, other_mat) = [
+        np.load(os.path.join(directory, name + '.npy'), mmap_mode='r')
+        for name in (block_name + '_index', block_name + '_other_index',
+                     block_name + '_values', side + '_other_mat')]
+    return solve_ridge_block((index, other_index, values, other_mat, n_rows,
+                              regularization_param))
+
+
+class Factor_Store():
+    """
+    Keyed store of fitted factors (u, v, average rating, and biases), used
+    to save factors and to warm-start later fits.
+    Factors are kept in memory, or on disk (one .npz file per key, so that
+    they can be shared by processes) if a directory is given.
+    """
+    def __init__(self, directory=None):
+        """
+        Constructor of the class
+        Input:
+            directory: directory for the files; if None, factors are kept
+                in memory (default: None)
+        """
+        self.directory = directory
+        self.factors = {}  # used if directory is None.
+        if directory is not None and not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def filename(self, key):
+        """
+        Filename for the given key (tuple).
+        """
+        return os.path.join(self.directory, 'factors_' +
+                            '_'.join(map(str, key)) + '.npz')
+
+    def save(self, key, factors):
+        """
+        Save factors for the given key (overwritten if exists).
+        Input:
+            key: tuple
+            factors: dict of np.array's (None values are not saved)
+        Output:
+            None
+        """
+        factors = dict((name, np.array(value)) for name, value in
+                       factors.iteritems() if value is not None)
+        if self.directory is None:
+            self.factors[key] = factors
+        else:
+            with atomic_open(self.filename(key)) as f:
+                np.savez(f, **factors)
+
+    def load(self, key):
+        """
+        Load factors for the given key.
+        Input:
+            key: tuple
+        Output:
+            factors: dict of np.array's (None if not found)
+        """
+        if self.directory is None:
+            return self.factors.get(key)
+        filename = self.filename(key)
+        if not os.path.exists(filename):
+            return None
+        with np.load(filename) as data:
+            return dict((name, data[name]) for name in data.files)
 
 
 class Matrix_Factorization():
@@ -19,7 +207,21 @@ class Matrix_Factorization():
                  user_bias_correction=False,
                  item_bias_correction=False,
                  saving_matrices=False,
-                 saved_matrices=False):
+                 saved_matrices=False,
+                 engine='loop',
+                 batch_size=1000,
+                 solver='sgd',
+                 n_jobs=1,
+                 pool=None,
+                 lazy_prediction=False,
+                 bias_damping=0,
+                 max_iterations=None,
+                 factor_store=None,
+                 warm_start=False,
+                 factor_key=None,
+                 warm_start_key=None,
+                 validation_hook=None,
+                 history_filename=None):
         """
         Constructor of the class
         Input:
@@ -31,8 +233,53 @@ class Matrix_Factorization():
 
             user_bias_correction: (default: False)
             item_bias_correction: (default: False)
-            saving_matrices: True if saving u, v (default: False)
-            saved_matrices: True if u. v are already saved (default: False)
+            saving_matrices: True if saving u, v (to factor_store, or to
+                default_factor_directory if not given) (default: False)
+            saved_matrices: True if u. v are already saved; they are loaded
+                instead of fitting (default: False)
+            engine: 'loop' for SGD over one rating at a time, or
+                'vectorized' for mini-batch SGD on the COO arrays in NumPy
+                (default: 'loop')
+            batch_size: number of ratings per mini-batch for the
+                'vectorized' engine (default: 1000)
+            solver: 'sgd' for Stochastic Gradient Descent, or 'als' for
+                Alternating Least Squares, which solves for u and v in turn
+                in closed form (learn_rate and engine are not used)
+                (default: 'sgd')
+            n_jobs: number of processes used by the 'als' solver; a pool
+                of n_jobs processes is created once, and shared by later
+                fits (see get_als_pool). Inside worker processes of a pool
+                (parallel validation or sweeps), 1 is used instead.
+                (default: 1)
+            pool: process pool for the 'als' solver, used instead of the
+                shared one (not closed here) (default: None)
+            lazy_prediction: if True, the dense prediction matrix is not
+                stored, and predictions are computed from u, v, and biases
+                when asked (default: False)
+            bias_damping: regularization for biases; the bias of a user
+                (item) is shrunk toward 0 as if it had this many extra
+                ratings equal to the average (default: 0)
+            max_iterations: if given, iterations stop after this many
+                epochs even before meeting the criterion (default: None)
+            factor_store: Factor_Store object; fitted factors are saved to
+                it after every fit (default: None)
+            warm_start: if True, u and v are initialized from factor_store
+                (e.g., from a neighboring grid point on the same fold),
+                if found there. (default: False)
+            factor_key: name of the factors in factor_store (tuple, e.g.,
+                a grid point); the key is the name followed by
+                (n_users, n_items, training_id), where training_id
+                identifies the training ratings, so that factors of
+                different folds are kept apart (factors from other folds
+                were fitted on the current validation set)
+                (default: None, which means (n_features,))
+            warm_start_key: name of the factors to start from, e.g., a
+                neighboring grid point (default: None, factor_key)
+            validation_hook: function (recommender) -> validation RMSE,
+                called after every epoch, e.g., Validator.rmse_hook(i)
+                (default: None)
+            history_filename: if given, the training history is appended
+                to this file, one json line per epoch (default: None)
         """
         self.n_features = n_features
         self.learn_rate = learn_rate
@@ -43,123 +290,436 @@ class Matrix_Factorization():
         self.item_bias_correction = item_bias_correction
         self.saving_matrices = saving_matrices
         self.saved_matrices = saved_matrices
+        self.engine = engine
+        self.batch_size = int(batch_size)
+        self.solver = solver
+        self.n_jobs = int(n_jobs)
+        self.lazy_prediction = lazy_prediction
+        self.bias_damping = bias_damping
+        self.max_iterations = max_iterations
+        self.warm_start = warm_start
+        self.factor_key = factor_key
+        self.warm_start_key = warm_start_key
+        if factor_store is None and (saving_matrices or saved_matrices):
+            factor_store = Factor_Store(default_factor_directory)
+        self.factor_store = factor_store
+        self.validation_hook = validation_hook
+        self.history_filename = history_filename
 
         self.ratings_mat = None
         self.ratings_mat_coo = None
+        self.residuals = None  # adjusted ratings aligned with coo arrays.
+        self.als_user_blocks = None  # blocks of ratings for the ALS solver.
+        self.als_item_blocks = None
+        self.pool = pool  # process pool given for the ALS solver.
+        self.als_pool = None  # process pool used during a fit.
+        # Directory of arrays shared with the pool during a fit, and the
+        # memory-mapped fixed factor matrices (see _als_share).
+        self.als_directory = None
+        self.als_other_mats = None
         self.user_mat = None  # u in SVD
         self.item_mat = None  # v in SVD (diagonal matrix does not exist)
         self.prediction = None  # prediction matrix found after SVD
         self.average_bias_user = None
         self.average_bias_item = None
         self.average_rating = 0
+        # Training history of the last fit (one dict for each epoch).
+        self.history = []
+        self.n_fits = 0  # number of fits done (to tell fits apart).
+        self.training_id = None  # identifies the training ratings.
 
     def fit(self, ratings_mat):
-        filename_u = '../data/u.mat'
-        filename_v = '../data/v.mat'
-        if self.saved_matrices:
-            self.user_mat.load(filename_u)
-            self.item_mat.load(filename_v)
-            return
-
-        self.ratings_mat = ratings_mat.copy()  # in dok (dictionary) format.
+        # csr is kept for looking up rated items of a user.
+        self.ratings_mat = ratings_mat.tocsr()
         # coo is better for looping over nonzero values (converting to coo).
         self.ratings_mat_coo = ratings_mat.tocoo()
         self.n_users, self.n_items = ratings_mat.shape
         self.n_rated = self.ratings_mat_coo.row.size
+        self.training_id = self._find_training_id()
         print "    problem size:", self.n_users, self.n_items, self.n_rated
 
-        # Subtract the overall average rating from ratings_mat.
+        if self.saved_matrices:
+            factors = self.factor_store.load(self.store_key())
+            if factors is not None:
+                self.set_factors(factors)
+                print "    Saved factors loaded."
+                return
+            print "    No saved factors found; fitting."
+
+        # Adjusted ratings are stored as a flat array aligned with the COO
+        # arrays. First, subtract the overall average rating.
         self.average_rating = self.ratings_mat_coo.data.mean()
-        for irow, icol in itertools.izip(self.ratings_mat_coo.row,
-                                         self.ratings_mat_coo.col):
-            self.ratings_mat[irow, icol] -= self.average_rating
+        self.residuals = self.ratings_mat_coo.data - self.average_rating
 
         # user bias subtraction done here
         if self.user_bias_correction:
-            self.average_bias_user = np.zeros(self.n_users)
-            for irow in xrange(self.n_users):
-                nonzero_indices = np.where(self.ratings_mat_coo.row == irow)[0]
-                if nonzero_indices.size:  # With at least one review
-                    self.average_bias_user[irow] =\
-                        self.ratings_mat_coo.data[nonzero_indices].mean()\
-                        - self.average_rating
-                else:
-                    self.average_bias_user[irow] = 0
-            for irow, icol in itertools.izip(self.ratings_mat_coo.row,
-                                             self.ratings_mat_coo.col):
-                self.ratings_mat[irow, icol] -= self.average_bias_user[irow]
+            self.average_bias_user = self._find_bias(self.ratings_mat_coo.row,
+                                                     self.n_users)
+            self.residuals -= self.average_bias_user[self.ratings_mat_coo.row]
             print "    User biases subtracted"
 
         # item bias subtraction done here
         if self.item_bias_correction:
-            self.average_bias_item = np.zeros(self.n_items)
-            for icol in xrange(self.n_items):
-                nonzero_indices = np.where(self.ratings_mat_coo.col == icol)[0]
-                if nonzero_indices.size:  # With at least one review
-                    self.average_bias_item[icol] =\
-                        self.ratings_mat_coo.data[nonzero_indices].mean()\
-                        - self.average_rating
-                else:
-                    self.average_bias_item[icol] = 0
-            for irow, icol in itertools.izip(self.ratings_mat_coo.row,
-                                             self.ratings_mat_coo.col):
-                self.ratings_mat[irow, icol] -= self.average_bias_item[icol]
+            self.average_bias_item = self._find_bias(self.ratings_mat_coo.col,
+                                                     self.n_items)
+            self.residuals -= self.average_bias_item[self.ratings_mat_coo.col]
             print "    Item biases subtracted"
 
         # Initializing u and v  (they are not sparse)
-        self.user_mat = 2 * np.array(
+        # From stored factors for warm start (if found), or randomly.
+        factors = None
+        if self.warm_start and self.factor_store is not None:
+            factors = self.factor_store.load(
+                self.store_key(self.warm_start_key))
+        if factors is not None and \
+                factors['user_mat'].shape == (self.n_users, self.n_features) \
+                and factors['item_mat'].shape == (self.n_features,
+                                                  self.n_items):
+            self.user_mat = np.array(factors['user_mat'], dtype=float)
+            self.item_mat = np.array(factors['item_mat'], dtype=float)
+            print "    Warm start from stored factors."
+        else:
+            self.user_mat = 2 * np.array(
                     np.random.rand(self.n_users * self.n_features)
                     .reshape([self.n_users, self.n_features])) - 1
-        self.item_mat = 2 * np.array(
+            self.item_mat = 2 * np.array(
                     np.random.rand(self.n_items * self.n_features)
                     .reshape([self.n_features, self.n_items])) - 1
 
         # Iteration starts here.
+        if self.solver == 'als':
+            run_epoch = self._als_epoch
+            self.als_user_blocks = self._als_blocks(
+                self.ratings_mat_coo.row, self.ratings_mat_coo.col,
+                self.n_users)
+            self.als_item_blocks = self._als_blocks(
+                self.ratings_mat_coo.col, self.ratings_mat_coo.row,
+                self.n_items)
+            if current_process().daemon:
+                # Worker processes of a pool (e.g., Validator with n_jobs > 1,
+                # or sweeps) cannot start processes, so blocks are solved
+                # in this process.
+                if self.n_jobs > 1 or self.pool is not None:
+                    print "    ALS runs in one process (in a worker process)."
+            elif self.pool is not None:
+                self.als_pool = self.pool
+            elif self.n_jobs > 1:
+                self.als_pool = get_als_pool(self.n_jobs)
+        elif self.engine == 'vectorized':
+            run_epoch = self._sgd_epoch_vectorized
+        else:
+            run_epoch = self._sgd_epoch_loop
         optimizer_iteration_count = 0
         pct_improvement = 0
         sse_accum = 0
-        while ((optimizer_iteration_count < 2) or
-               (pct_improvement > self.optimizer_pct_improvement_criterion)):
-            old_sse = sse_accum
-            sse_accum = 0
-            for irow, icol in itertools.izip(self.ratings_mat_coo.row,
-                                             self.ratings_mat_coo.col):
-                # Adjusted self.ratings_mat should be used here.
-                error = self.ratings_mat[irow, icol] - \
-                    np.dot(self.user_mat[irow, :], self.item_mat[:, icol])
-                sse_accum += error**2
-                for k in range(self.n_features):
-                    self.user_mat[irow, k] = self.user_mat[irow, k] +\
-                        self.learn_rate * \
-                        (error * self.item_mat[k, icol] -
-                         self.regularization_param * self.user_mat[irow, k])
-                    self.item_mat[k, icol] = self.item_mat[k, icol] +\
-                        self.learn_rate * \
-                        (error * self.user_mat[irow, k] -
-                         self.regularization_param * self.item_mat[k, icol])
-            pct_improvement = 100 * (old_sse - sse_accum) / old_sse
-            old_sse = sse_accum
-            optimizer_iteration_count += 1
+        self.history = []
+        self.n_fits += 1
+        try:
+            if self.als_pool is not None:
+                self._als_share()
+            while (((optimizer_iteration_count < 2) or
+                    (pct_improvement >
+                     self.optimizer_pct_improvement_criterion)) and
+                   (self.max_iterations is None or
+                    optimizer_iteration_count < self.max_iterations)):
+                old_sse = sse_accum
+                start_time = time.time()
+                sse_accum = run_epoch()
+                elapsed = time.time() - start_time
+                if old_sse:
+                    pct_improvement = 100 * (old_sse - sse_accum) / old_sse
+                else:  # No improvement to compute for the first epoch.
+                    pct_improvement = None
+                optimizer_iteration_count += 1
+                self.record_epoch(optimizer_iteration_count, sse_accum,
+                                  pct_improvement, elapsed)
+        finally:
+            self.als_pool = None  # Pools are kept for later fits.
+            self.als_other_mats = None
+            if self.als_directory is not None:
+                shutil.rmtree(self.als_directory, ignore_errors=True)
+                self.als_directory = None
         print "    Iteration done in", optimizer_iteration_count, "times."
 
-        # prediction matrix (not sparse)
-        self.prediction = np.dot(self.user_mat, self.item_mat)
+        # prediction matrix (not sparse), unless predicting lazily.
+        if self.lazy_prediction:
+            self.prediction = None
+        else:
+            self.prediction = self._find_prediction()
+
+        # If saveing is needed
+        if self.factor_store is not None:
+            self.factor_store.save(self.store_key(), self.get_factors())
 
+    def record_epoch(self, epoch, sse, pct_improvement, elapsed):
+        """
+        Record one epoch to the training history (and to history_filename).
+        Input:
+            epoch: epoch number (starting from 1)
+            sse: SSE of the epoch (float)
+            pct_improvement: improvement of SSE in % (None for the first)
+            elapsed: wall time of the epoch in seconds (float)
+        Output:
+            None
+        """
+        if pct_improvement is not None:
+            pct_improvement = float(pct_improvement)
+        entry = {'fit': self.n_fits, 'epoch': epoch, 'sse': float(sse),
+                 'rmse': float(np.sqrt(sse / max(self.n_rated, 1))),
+                 'pct_improvement': pct_improvement,
+                 # True when the improvement gets below the criterion.
+                 'converged': bool(pct_improvement is not None and
+                                   pct_improvement <=
+                                   self.optimizer_pct_improvement_criterion),
+                 'time': elapsed,
+                 'ratings_per_sec': self.n_rated / elapsed if elapsed > 0
+                 else None,
+                 'n_rated': self.n_rated, 'solver': self.solver,
+                 'engine': self.engine}
+        if self.validation_hook is not None:
+            entry['val_rmse'] = self.validation_hook(self)
+        self.history.append(entry)
+        if self.history_filename is not None:
+            with open(self.history_filename, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+
+    def store_key(self, name=None):
+        """
+        Key for factor_store: the name (default: factor_key) followed by
+        the training set (see factor_key).
+        """
+        if name is None:
+            name = self.factor_key
+        if name is None:
+            name = (self.n_features,)
+        return tuple(name) + (self.n_users, self.n_items, self.training_id)
+
+    def _find_training_id(self):
+        """
+        Find a short hash of the training ratings (positions and values),
+        which is the same for the same fold.
+        Output:
+            training_id: hex string
+        """
+        self.ratings_mat.sort_indices()
+        sha = hashlib.sha1()
+        for array in (self.ratings_mat.indptr, self.ratings_mat.indices,
+                      self.ratings_mat.data):
+            sha.update(np.ascontiguousarray(array, dtype=np.float64)
+                       .tostring())
+        return sha.hexdigest()[:16]
+
+    def get_factors(self):
+        """
+        Return fitted factors (u, v, average rating, and biases) in a dict.
+        """
+        return {'user_mat': self.user_mat, 'item_mat': self.item_mat,
+                'average_rating': self.average_rating,
+                'average_bias_user': self.average_bias_user,
+                'average_bias_item': self.average_bias_item}
+
+    def set_factors(self, factors):
+        """
+        Set factors (found by get_factors) without fitting.
+        """
+        self.user_mat = np.array(factors['user_mat'], dtype=float)
+        self.item_mat = np.array(factors['item_mat'], dtype=float)
+        self.average_rating = float(factors['average_rating'])
+        self.average_bias_user = factors.get('average_bias_user')
+        self.average_bias_item = factors.get('average_bias_item')
+        if self.lazy_prediction:
+            self.prediction = None
+        else:
+            self.prediction = self._find_prediction()
+
+    def _find_bias(self, index, size):
+        """
+        Find the average bias (from the overall average rating) of each user
+        or item, using sums over the COO arrays.
+        With bias_damping, the bias is shrunk toward 0 for users (items)
+        with few ratings: sum(rating - average) / (n_ratings + bias_damping).
+        Input:
+            index: row (for users) or col (for items) of the COO arrays.
+            size: number of users or items.
+        Output:
+            bias: np.array (1d, 0 for ones without any rating)
+        """
+        counts = np.bincount(index, minlength=size)
+        sums = np.bincount(index, weights=self.ratings_mat_coo.data,
+                           minlength=size) - counts * self.average_rating
+        bias = np.zeros(size)
+        rated = counts > 0  # With at least one review
+        bias[rated] = sums[rated] / (counts[rated] + self.bias_damping)
+        return bias
+
+    def _sgd_epoch_loop(self):
+        """
+        One SGD epoch, updating u and v after every single rating.
+        Output:
+            sse_accum: SSE accumulated during the epoch (float)
+        """
+        sse_accum = 0
+        for irow, icol, residual in itertools.izip(self.ratings_mat_coo.row,
+                                                   self.ratings_mat_coo.col,
+                                                   self.residuals):
+            # Adjusted ratings should be used here.
+            error = residual - \
+                np.dot(self.user_mat[irow, :], self.item_mat[:, icol])
+            sse_accum += error**2
+            for k in range(self.n_features):
+                self.user_mat[irow, k] = self.user_mat[irow, k] +\
+                    self.learn_rate * \
+                    (error * self.item_mat[k, icol] -
+                     self.regularization_param * self.user_mat[irow, k])
+                self.item_mat[k, icol] = self.item_mat[k, icol] +\
+                    self.learn_rate * \
+                    (error * self.user_mat[irow, k] -
+                     self.regularization_param * self.item_mat[k, icol])
+        return sse_accum
+
+    def _sgd_epoch_vectorized(self):
+        """
+        One SGD epoch using mini-batches of the COO arrays.
+        Ratings are visited in a random order; within a mini-batch all
+        errors are computed from the same u and v, and the updates are
+        added back Hogwild-style (repeated users/items accumulate).
+        Output:
+            sse_accum: SSE accumulated during the epoch (float)
+        """
+        rows = self.ratings_mat_coo.row
+        cols = self.ratings_mat_coo.col
+        # item_mat.T is a view, so updates go straight into item_mat.
+        item_mat_t = self.item_mat.T
+        sse_accum = 0.
+        order = np.random.permutation(self.n_rated)
+        for start in xrange(0, self.n_rated, self.batch_size):
+            batch = order[start:start + self.batch_size]
+            brows = rows[batch]
+            bcols = cols[batch]
+            u = self.user_mat[brows]
+            v = item_mat_t[bcols]
+            error = self.residuals[batch] - np.sum(u * v, axis=1)
+            sse_accum += np.dot(error, error)
+            error = error.reshape(-1, 1)
+            scatter_add(self.user_mat, brows, self.learn_rate *
+                        (error * v - self.regularization_param * u))
+            scatter_add(item_mat_t, bcols, self.learn_rate *
+                        (error * u - self.regularization_param * v))
+        return sse_accum
+
+    def _als_blocks(self, index, other_index, n_rows):
+        """
+        Split ratings into contiguous blocks of rows (users or items) for
+        the ALS solver, one block per process.
+        Input:
+            index: row index of each rating (1d np.array)
+            other_index: index of each rating on the other side
+            n_rows: number of rows (users or items)
+        Output:
+            blocks: list of tuples (start, end, positions, index relative
+                to start, other_index) where positions are the positions of
+                the ratings in the COO arrays.
+        """
+        order = np.argsort(index, kind='mergesort')
+        sorted_index = index[order]
+        bounds = np.linspace(0, n_rows, max(self.n_jobs, 1) + 1).astype(int)
+        blocks = []
+        for start, end in itertools.izip(bounds[:-1], bounds[1:]):
+            lo, hi = np.searchsorted(sorted_index, [start, end])
+            positions = order[lo:hi]
+            blocks.append((start, end, positions,
+                           sorted_index[lo:hi] - start,
+                           other_index[positions]))
+        return blocks
+
+    def _als_share(self):
+        """
+        Write the arrays of all blocks, which do not change during a fit,
+        to a temporary directory once, for the process pool of the ALS
+        solver; the fixed factor matrices are memory-mapped files, updated
+        once per half-epoch (see _als_solve).
+        Output:
+            None
+        """
+        self.als_directory = tempfile.mkdtemp(prefix='als_')
+        self.als_other_mats = {}
+        for (side, blocks, n_other) in (('user', self.als_user_blocks,
+                                         self.n_items),
+                                        ('item', self.als_item_blocks,
+                                         self.n_users)):
+            for b, (_, _, positions, index, other_index) in enumerate(blocks):
+                block_name = os.path.join(self.als_directory,
+                                          '%s%d' % (side, b))
+                np.save(block_name + '_index.npy', index)
+                np.save(block_name + '_other_index.npy', other_index)
+                np.save(block_name + '_values.npy', self.residuals[positions])
+            self.als_other_mats[side] = np.lib.format.open_memmap(
+                os.path.join(self.als_directory, side + '_other_mat.npy'),
+                mode='w+', dtype=np.float64, shape=(n_other, self.n_features))
+
+    def _als_solve(self, blocks, other_mat, mat, side):
+        """
+        Solve for one side of the factorization (in place), block by block.
+        Input:
+            blocks: blocks found by _als_blocks.
+            other_mat: fixed factor matrix (one row per user or item)
+            mat: factor matrix to be solved (one row per user or item)
+            side: 'user' or 'item' (side being solved)
+        Output:
+            None
+        """
+        if self.als_pool is not None:
+            # Only the fixed factor matrix changes: it is copied once into
+            # the shared file, and tasks are just filenames.
+            self.als_other_mats[side][:] = other_mat
+            tasks = [(self.als_directory, '%s%d' % (side, b), side,
+                      end - start, self.regularization_param)
+                     for b, (start, end, _, _, _) in enumerate(blocks)]
+            solutions = self.als_pool.map(solve_shared_block, tasks)
+        else:
+            tasks = [(index, other_index, self.residuals[positions],
+                      other_mat, end - start, self.regularization_param)
+                     for (start, end, positions, index, other_index) in
+                     blocks]
+            solutions = map(solve_ridge_block, tasks)
+        for (start, end, _, _, _), solution in itertools.izip(blocks,
+                                                              solutions):
+            mat[start:end] = solution
+
+    def _als_epoch(self):
+        """
+        One ALS epoch: solve for u with v fixed, and then for v with u fixed.
+        Output:
+            sse_accum: SSE after the epoch (float)
+        """
+        self._als_solve(self.als_user_blocks, self.item_mat.T, self.user_mat,
+                        'user')
+        self._als_solve(self.als_item_blocks, self.user_mat, self.item_mat.T,
+                        'item')
+        error = self.residuals - np.sum(
+            self.user_mat[self.ratings_mat_coo.row] *
+            self.item_mat.T[self.ratings_mat_coo.col], axis=1)
+        return np.dot(error, error)
+
+    def _find_prediction(self, user_ids=slice(None)):
+        """
+        Compute predictions for given users from u, v, and biases.
+        Input:
+            user_ids: users to predict for (default: all users)
+        Output:
+            prediction: np.array (2d)
+        """
         # average rating added.
-        self.prediction += self.average_rating
+        prediction = np.dot(self.user_mat[user_ids], self.item_mat) +\
+            self.average_rating
 
         # Adding back baises subtracted before finding u and v
         if self.user_bias_correction:
-            self.prediction = self.prediction +\
-                self.average_bias_user.reshape(-1, 1)
+            prediction +=\
+                self.average_bias_user[user_ids].reshape(-1, 1)
         if self.item_bias_correction:
-            self.prediction = self.prediction +\
-                self.average_bias_item.reshape(1, -1)
-
-        # If saveing is needed
-        if self.saving_matrices:
-            self.user_mat.dump(filename_u)
-            self.item_mat.dump(filename_v)
+            prediction += self.average_bias_item.reshape(1, -1)
+        return prediction
 
     def pred_one_rating(self, user_id, item_id):
         """
@@ -167,6 +727,8 @@ class Matrix_Factorization():
         Output:
             prediected: float
         """
+        if self.prediction is None:
+            return self.find_rating_from_uv(user_id, item_id)
         return self.prediction[user_id, item_id]
 
     def find_rating_from_uv(self, user_id, item_id):
@@ -183,20 +745,56 @@ class Matrix_Factorization():
             rating += self.average_bias_item[item_id]
         return rating
 
+    def predict_pairs(self, rows, cols):
+        """
+        Predict for many user-item pairs at once from current u and v
+        (e.g., the row and col arrays of a coo matrix).
+        Input:
+            rows: user ID's (1d np.array)
+            cols: item ID's (1d np.array, same size as rows)
+        Output:
+            prediected: np.array (1d)
+        """
+        rows = np.asarray(rows)
+        cols = np.asarray(cols)
+        ratings = np.sum(self.user_mat[rows] * self.item_mat.T[cols], axis=1)\
+            + self.average_rating
+        if self.user_bias_correction:
+            ratings += self.average_bias_user[rows]
+        if self.item_bias_correction:
+            ratings += self.average_bias_item[cols]
+        return ratings
+
+    def predict_batch(self, rows, cols):
+        """
+        Batch prediction used by Validator (same as predict_pairs).
+        Input:
+            rows: user ID's (1d np.array)
+            cols: item ID's (1d np.array, same size as rows)
+        Output:
+            predicted: np.array (1d)
+        """
+        return self.predict_pairs(rows, cols)
+
     def pred_one_user(self, user_id):
         """
         Predict for one user.
         Output:
             prediected: np.array (1d)
         """
+        if self.prediction is None:
+            return self._find_prediction([user_id])[0]
         return self.prediction[user_id]
 
     def pred_all(self):
         """
         Predict for all user-item pairs.
+        (With lazy_prediction, the matrix is computed, but not stored.)
         Output:
             prediected: np.array (2d)
         """
+        if self.prediction is None:
+            return self._find_prediction()
         return self.prediction
 
     def pred_average(self, user_bias=False, item_bias=False):
@@ -211,11 +809,28 @@ class Matrix_Factorization():
         prediction = np.zeros((self.n_users, self.n_items)) +\
             self.average_rating
         if user_bias:
-            for irow in xrange(self.n_users):
-                prediction[irow, :] += self.average_bias_user[irow]
+            prediction += self.average_bias_user.reshape(-1, 1)
+        if item_bias:
+            prediction += self.average_bias_item.reshape(1, -1)
+        return prediction
+
+    def pred_average_pairs(self, rows, cols, user_bias=False,
+                           item_bias=False):
+        """
+        Same as pred_average, but only for given user-item pairs.
+        Input:
+            rows: user ID's (1d np.array)
+            cols: item ID's (1d np.array, same size as rows)
+            user_bias: if True, add user_bias (default: False)
+            item_bias: if True, add item_bias (default: False)
+        Output:
+            prediected: np.array (1d)
+        """
+        prediction = np.zeros(len(rows)) + self.average_rating
+        if user_bias:
+            prediction += self.average_bias_user[rows]
         if item_bias:
-            for icol in xrange(self.n_items):
-                prediction[:, icol] += self.average_bias_item[icol]
+            prediction += self.average_bias_item[cols]
         return prediction
 
     def top_n_recs(self, user_id, num):
@@ -229,7 +844,5 @@ class Matrix_Factorization():
         """
         pred_output = self.pred_one_user(user_id)  # 1d np.array
         items_predicted = np.ones(self.n_items, dtype='bool')
-        for icol in xrange(self.n_items):
-            if self.ratings_mat[user_id, icol]:
-                items_predicted[icol] = False
+        items_predicted[self.ratings_mat[user_id].indices] = False
         return np.argsort(pred_output[items_predicted])[-num:][::-1]
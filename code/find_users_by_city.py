@@ -12,24 +12,46 @@
 
 import numpy as np
 import os
-import cPickle as pickle
-import networkx as nx
+import itertools
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
 
 from my_utilities import write_dictlist_to_file, write_dict_to_file
-from my_utilities import read_dictlist_from_file, write_ratings_to_file
-from my_utilities import convert_to_nx, convert_from_nx
+from my_utilities import write_ratings_to_file
+from my_utilities import read_dataframe, read_columns, write_columns
+from my_utilities import write_ratings_to_columns
+from my_utilities import write_graph_to_file, read_graph_from_file
+from my_utilities import fork_pool, get_worker_state
+from csr_graph import CSR_Graph
 
-# Filename for the pickled data of reviews with city info.
+# Directory for the data of reviews with city info (columnar format).
 # inputs:
-review_by_city_dataframe_pickle_filename =\
-    '../data/review_by_city_dataframe.pkl'
+review_by_city_dataframe_dir = '../data/columns/review_by_city_dataframe'
 network_filename = '../data/network.csv'
+network_graph_filename = '../data/network.csrg'  # used if exists.
 
 # outputs:
 user_by_city_filename = '../data/user_by_city'
 network_city_filename = '../data/network%s.csv'
+network_city_graph_filename = '../data/network%s.csrg'  # binary
 degree_city_filename = '../data/degrees%s'
 review_by_city_filename = '../data/reviews%s'
+review_by_city_columns_dir = '../data/columns/reviews%s'
+# Edges of each city (columns src and dst), written by the stage assigning
+# cities, and read by the stage of each city.
+edges_city_dir = '../data/columns/edges%s'
+
+
+
+def run_city_worker(city):
+    """
+    Run make_city_files for the city in a worker process (the state of
+    fork_pool: (review_city_df, edges_by_city)).
+    """
+    (review_city_df, edges_by_city) = get_worker_state()
+    (src, dst) = edges_by_city[city]
+    make_city_files(city, review_city_df, src, dst)
+    return city
 
 
 def find_city(user_id, user_cities, friends, user_city_int):
@@ -70,107 +92,365 @@ def find_city(user_id, user_cities, friends, user_city_int):
         return (user_cities[arg[np.random.randint(len(arg))]], 1)
 
 
-def main():
+def read_review_city_df():
     """
-    Find the users for each given city (save them in pickle files),
-    and find build networks for given cities and degree distributions.
+    Read the dataframe of reviews with city info.
+    Output:
+        review_city_df: pandas dataframe (None if it does not exist)
     """
-    if os.path.exists(review_by_city_dataframe_pickle_filename):
-        print "Reading from the pickled data: " + \
-            review_by_city_dataframe_pickle_filename
-        with open(review_by_city_dataframe_pickle_filename, 'r') as f:
-            review_city_df = pickle.load(f)
+    if os.path.exists(review_by_city_dataframe_dir):
+        print "Reading from the stored data: " + review_by_city_dataframe_dir
+        return read_dataframe(review_by_city_dataframe_dir)
     else:
-        print "The file, " + review_by_city_dataframe_pickle_filename +\
+        print "The directory, " + review_by_city_dataframe_dir +\
             ", does not exist."
-        return
+        return None
+
+
+def find_cities(user_ids, user_cities, friends, user_city_int):
+    """
+    Determine cities of users who left reviews in multiple cities, for all
+    given users at once. Same as calling find_city for each user in the
+    given order (adding each result to user_city_int before the next user),
+    with repeated friends counted once, including the random choices for
+    ties, but histograms of cities of
+    friends are computed for all users at once with a sparse matrix.
+    Input:
+        user_ids: ids of given users (np.array of int, in the order of
+            decisions)
+        user_cities: list of cities for each user (list of np.arrays)
+        friends: CSR_Graph (or dict of lists, see as_graph)
+        user_city_int: already known city info for users (updated here).
+    Output:
+        cities: cities of given users (np.array of int)
+        n_random: number of cities chosen randomly (int)
+    """
+    n_users = len(user_ids)
+    known_ids = np.fromiter(user_city_int.iterkeys(), dtype=int,
+                            count=len(user_city_int))
+    known_cities = np.fromiter(user_city_int.itervalues(), dtype=int,
+                               count=len(user_city_int))
+    n_cities = max([known_cities.max() + 1 if len(known_cities) else 0] +
+                   [cities.max() + 1 for cities in user_cities])
+
+    # Friends of given users (rows: given users, cols: user_id's).
+    friends = as_graph(friends)
+    n_friends = np.zeros(n_users, dtype=int)
+    inside = user_ids < friends.n_nodes
+    n_friends[inside] = friends.degrees()[user_ids[inside]]
+    cols = friends.edges(user_ids)[1].astype(int)
+    rows = np.repeat(np.arange(n_users), n_friends)
+    size = np.concatenate(([0], cols, known_ids, user_ids)).max() + 1
+
+    # Histograms of known cities of friends (user x city).
+    city_label = np.empty(size, dtype=int)
+    city_label.fill(-1)
+    city_label[known_ids] = known_cities
+    known = city_label[cols] >= 0
+    histograms = sparse.coo_matrix((np.ones(known.sum(), dtype=int),
+                                    (rows[known], city_label[cols[known]])),
+                                   shape=(n_users, n_cities)).toarray()
+
+    # Friends among given users: once a user's city is decided, it counts
+    # for friends decided later.
+    position = np.empty(size, dtype=int)
+    position.fill(-1)
+    position[user_ids] = np.arange(n_users)
+    friend_position = position[cols]
+    earlier = (friend_position >= 0) & (friend_position < rows)
+    dependents = sparse.coo_matrix((np.ones(earlier.sum(), dtype=int),
+                                    (friend_position[earlier],
+                                     rows[earlier])),
+                                   shape=(n_users, n_users)).tocsr()
 
-    # Read the network file (whole) and store the info in dict.
-    all_friends = read_dictlist_from_file(network_filename)
+    cities = np.empty(n_users, dtype=int)
+    n_random = 0
+    for i in xrange(n_users):
+        candidates = user_cities[i]
+        counts = histograms[i, candidates]
+        # To find ties, we use a list. If there is a tie, pick one randomly.
+        arg = np.flatnonzero(counts == counts.max())
+        if len(arg) == 1:
+            cities[i] = candidates[arg[0]]
+        else:
+            cities[i] = candidates[arg[np.random.randint(len(arg))]]
+            n_random += 1
+        start, end = dependents.indptr[i], dependents.indptr[i + 1]
+        histograms[dependents.indices[start:end], cities[i]] +=\
+            dependents.data[start:end]
+    user_city_int.update(itertools.izip(user_ids.tolist(), cities.tolist()))
+    return cities, n_random
 
-    # Find the cities by the user.
-    cities_by_user = review_city_df.groupby('user_id_int', sort=True)\
-        .business_city_int.unique()
 
-    # Initialize city info for all remaining users as a dict.
-    user_city_int = {}
+def as_graph(all_friends):
+    """
+    Return the network as CSR_Graph. A dict of lists is converted, so that
+    repeated friends in a list are counted once, the same as in CSR_Graph,
+    and both forms give the same results.
+    Input:
+        all_friends: CSR_Graph or dict of lists
+    Output:
+        graph: CSR_Graph
+    """
+    if isinstance(all_friends, CSR_Graph):
+        return all_friends
+    return CSR_Graph.from_dictlist(all_friends)
+
+
+def read_network():
+    """
+    Read the whole network as CSR_Graph: from the binary file
+    (memory-mapped) if exists, or from the csv file.
+    Output:
+        all_friends: CSR_Graph
+    """
+    if os.path.exists(network_graph_filename):
+        return read_graph_from_file(network_graph_filename)
+    return read_graph_from_file(network_filename)
+
+
+def assign_cities(review_city_df, all_friends, random_seed=123):
+    """
+    Find the city of each user, and write the info into a file.
+    Input:
+        review_city_df: pandas dataframe of reviews with city info.
+        all_friends: dict representing the network (or CSR_Graph)
+        random_seed: random seed for breaking ties (default: 123)
+    Output:
+        user_city_int: dict (key: user_id, value: city)
+        n_random: number of cities chosen randomly (int)
+    """
+    # Find the cities by the user (in the order of reviews), sorted by user.
+    pairs = review_city_df[['user_id_int', 'business_city_int']]\
+        .drop_duplicates()
+    order = np.argsort(pairs.user_id_int.values, kind='mergesort')
+    users = pairs.user_id_int.values[order]
+    cities = pairs.business_city_int.values[order]
+    (user_ids, starts, n_user_cities) = np.unique(users, return_index=True,
+                                                  return_counts=True)
 
     # We already know that only 5% of users have reviews in more than 1 city.
 
     # First, assign cities to 95% of users who have reviews in one city.
-    for user_id, user_cities in cities_by_user.iteritems():  # For all users.
-        if len(user_cities) == 1:
-            user_city_int[user_id] = user_cities[0]
+    single = n_user_cities == 1
+    user_city_int = dict(itertools.izip(user_ids[single].tolist(),
+                                        cities[starts[single]].tolist()))
 
     # Second, for users with multiple cities, decide based on
-    # friends of the network.
-    random_seed = 123
+    # friends of the network (in the order of user_id's).
+    multiple = np.flatnonzero(~single)
     np.random.seed(random_seed)  # initializning the RNG.
-    n_random = 0  # Number of random choices.
-    for user_id, user_cities in cities_by_user.iteritems():  # For all users.
-        if user_id not in user_city_int:
-            (user_city_int[user_id], rand) = find_city(user_id, user_cities,
-                                                    all_friends, user_city_int)
-            n_random += rand
+    (_, n_random) = find_cities(user_ids[multiple],
+                                [cities[starts[i]:starts[i] + n_user_cities[i]]
+                                 for i in multiple],
+                                all_friends, user_city_int)
 
     # Write the user info into a file.
     write_dict_to_file(user_by_city_filename, user_city_int)
+    return user_city_int, n_random
 
-    # Cities we are interested in: Phoenix (0), Las Vegas (1)
-    # and Montreal (3), here.
-    n_cities = 10
 
-    # Using this info, find network for each cities.
-    # We only considers edge belongs to a network if both end users
-    # belong to the city.
-    # Reviews of all cities will be created and saved here.
+def assign_cities_from_stored(random_seed=123, n_cities=10):
+    """
+    Same as assign_cities, but reading inputs from stored files.
+    Edges of the network are also split by city (once for all cities),
+    and written into edges_city_dir for make_city_files_from_stored.
+    Input:
+        random_seed: random seed for breaking ties (default: 123)
+        n_cities: number of cities (default: 10)
+    Output:
+        None
+    """
+    all_friends = read_network()
+    (user_city_int, n_random) = assign_cities(
+        read_dataframe(review_by_city_dataframe_dir), all_friends,
+        random_seed)
+    edges_by_city = bucket_edges_by_city(all_friends, user_city_int, n_cities)
     for city in range(n_cities):
-        my_net = {}
-        for id1 in all_friends:
-            if id1 in user_city_int and user_city_int[id1] == city:
-                current_friends = []
-                for id2 in all_friends[id1]:
-                    if id2 in user_city_int and user_city_int[id2] == city:
-                        current_friends.append(id2)
-                if len(current_friends) > 0:
-                    # Only add users with friend in city
-                    my_net[id1] = current_friends
-
-        # Using networkx, find the largest component and only keep users in it.
-        graph_nx = convert_to_nx(my_net)
-        components = nx.connected_component_subgraphs(graph_nx)
-        # Find the biggest subgraph.
-        biggest_subgraph = None
-        max_size = 0
-        for comp in components:
-            if comp.number_of_nodes() > max_size:
-                max_size = comp.number_of_nodes()
-                biggest_subgraph = comp
-
-        # Set of users with any friend in the biggest component.
-        user_with_friend = set(biggest_subgraph.nodes())
-
-        # Now it is time to save network data into csv files
-        # (both the whole network and the biggest component).
-        write_dictlist_to_file(network_city_filename % city, my_net)
-        write_dictlist_to_file(network_city_filename % (str(city) + 'b'),
-                               convert_from_nx(biggest_subgraph))
-
-        # Find degrees and save degree info into files.
-        degrees = {}
-        for id1 in my_net:
-            degrees[id1] = len(my_net[id1])
-        write_dict_to_file(degree_city_filename % city, degrees)
-
-        # Reviews for each city
-        # First removes businesses out of the city.
-        temp_df = review_city_df[review_city_df.business_city_int == city]\
-            .drop(['business_city_int'], axis=1)
-        # And then, remove users who are out of the city.
-        temp_df = temp_df[temp_df.apply(lambda x: x['user_id_int'] in
-                                        user_with_friend, axis=1)]
-        # Store them in files.
-        write_ratings_to_file(review_by_city_filename % city, temp_df)
+        (src, dst) = edges_by_city[city]
+        write_columns(edges_city_dir % city, {'src': src, 'dst': dst})
+    print "Number of random choices:", n_random
+    return
+
+
+def bucket_edges_by_city(all_friends, user_city_int, n_cities):
+    """
+    Split edges of the network by city in one pass. An edge (id1, id2) from
+    the list of id1 belongs to a city if both end users belong to the city.
+    Input:
+        all_friends: CSR_Graph (or dict of lists, see as_graph)
+        user_city_int: dict (key: user_id, value: city)
+        n_cities: number of cities
+    Output:
+        edges_by_city: list of (src, dst) (np.arrays of user_id's) for each
+            city (edges from the same user are contiguous, in the order of
+            the network).
+    """
+    all_friends = as_graph(all_friends)
+    (src, dst) = all_friends.edges()
+    (src, dst) = (src.astype(int), dst.astype(int))
+    ids = all_friends.nodes
+
+    # City of each user as an array (-1: unknown).
+    user_ids = np.fromiter(user_city_int.iterkeys(), dtype=int,
+                           count=len(user_city_int))
+    max_id = np.concatenate(([0], ids, dst, user_ids)).max()
+    user_city = np.empty(max_id + 1, dtype=int)
+    user_city.fill(-1)
+    user_city[user_ids] = np.fromiter(user_city_int.itervalues(), dtype=int,
+                                      count=len(user_city_int))
+
+    city = user_city[src]
+    keep = (city >= 0) & (city == user_city[dst])
+    (src, dst, city) = (src[keep], dst[keep], city[keep])
+    order = np.argsort(city, kind='mergesort')
+    (src, dst, city) = (src[order], dst[order], city[order])
+    bounds = np.searchsorted(city, np.arange(n_cities + 1))
+    return [(src[bounds[i]:bounds[i + 1]], dst[bounds[i]:bounds[i + 1]])
+            for i in range(n_cities)]
+
+
+def find_biggest_component(src, dst):
+    """
+    Find the biggest connected component of the network given by edges,
+    using connected components of the sparse adjacency matrix.
+    As in convert_to_nx, the edge (id1, id2) from the list of id1 is used if
+    id1 < id2, and edges are undirected.
+    (If there are multiple biggest components, the one with the smallest
+    user_id is chosen.)
+    Input:
+        src, dst: edges (np.arrays of user_id's)
+    Output:
+        graph_dict: the biggest component as dict of lists (sorted friends).
+    """
+    forward = src < dst
+    nodes = np.union1d(src, dst[forward])
+    if len(nodes) == 0:
+        return {}
+    rows = np.searchsorted(nodes, src[forward])
+    cols = np.searchsorted(nodes, dst[forward])
+    adjacency = sparse.coo_matrix((np.ones(2 * len(rows), dtype=np.int8),
+                                   (np.concatenate((rows, cols)),
+                                    np.concatenate((cols, rows)))),
+                                  shape=(len(nodes), len(nodes))).tocsr()
+    adjacency.sort_indices()
+    (n_components, labels) = connected_components(adjacency, directed=False)
+    biggest = np.argmax(np.bincount(labels))
+    graph_dict = {}
+    for i in np.flatnonzero(labels == biggest):
+        graph_dict[int(nodes[i])] = nodes[adjacency.indices[
+            adjacency.indptr[i]:adjacency.indptr[i + 1]]].tolist()
+    return graph_dict
+
+
+def make_city_files(city, review_city_df, src, dst):
+    """
+    Find the network (whole and the biggest component), degrees, and reviews
+    for the given city, and write them into files.
+    Input:
+        city: city (int)
+        review_city_df: pandas dataframe of reviews with city info.
+        src, dst: edges of the city (from bucket_edges_by_city)
+    Output:
+        None
+    """
+    # Network of the city as dict of lists. (Only users with friend in city)
+    my_net = {}
+    if len(src) > 0:
+        starts = np.flatnonzero(np.concatenate(([True],
+                                                src[1:] != src[:-1])))
+        ends = np.append(starts[1:], len(src))
+        for (start, end) in itertools.izip(starts, ends):
+            my_net[int(src[start])] = dst[start:end].tolist()
+
+    # Find the largest component and only keep users in it.
+    biggest_component = find_biggest_component(src, dst)
+
+    # Now it is time to save network data into csv files and binary files
+    # (both the whole network and the biggest component).
+    write_dictlist_to_file(network_city_filename % city, my_net)
+    write_dictlist_to_file(network_city_filename % (str(city) + 'b'),
+                           biggest_component)
+    write_graph_to_file(network_city_graph_filename % city, my_net)
+    write_graph_to_file(network_city_graph_filename % (str(city) + 'b'),
+                        biggest_component)
+
+    # Find degrees and save degree info into files.
+    degrees = {}
+    for id1 in my_net:
+        degrees[id1] = len(my_net[id1])
+    write_dict_to_file(degree_city_filename % city, degrees)
+
+    # Reviews for each city
+    # First removes businesses out of the city.
+    temp_df = review_city_df[review_city_df.business_city_int == city]\
+        .drop(['business_city_int'], axis=1)
+    # And then, remove users who are not in the biggest component.
+    temp_df = temp_df[temp_df.user_id_int.isin(biggest_component.keys())]
+    # Store them in files (text, and columnar format for Validator).
+    write_ratings_to_file(review_by_city_filename % city, temp_df)
+    write_ratings_to_columns(review_by_city_columns_dir % city, temp_df)
+    return
+
+
+def make_city_files_from_stored(city):
+    """
+    Same as make_city_files, but reading inputs from stored files (edges
+    of the city written by assign_cities_from_stored), so that each city
+    can be processed independently (e.g., in parallel).
+    Input:
+        city: city (int)
+    Output:
+        None
+    """
+    edges = read_columns(edges_city_dir % city)
+    (src, dst) = (edges['src'], edges['dst'])
+    # Only reviews of the city are copied from the memory-mapped columns.
+    in_city = read_columns(review_by_city_dataframe_dir)[
+        'business_city_int'] == city
+    make_city_files(city, read_dataframe(review_by_city_dataframe_dir,
+                                         rows=in_city), src, dst)
+    return
+
+
+def main(n_cities=10, random_seed=123, n_jobs=1):
+    """
+    Find the users for each given city (save them in files),
+    and find build networks for given cities and degree distributions.
+    Input:
+        n_cities: number of cities (default: 10)
+        random_seed: random seed for breaking ties (default: 123)
+        n_jobs: number of processes to process cities in parallel
+            (default: 1)
+    """
+    review_city_df = read_review_city_df()
+    if review_city_df is None:
+        return
+
+    # Read the network file (whole).
+    all_friends = read_network()
+
+    (user_city_int, n_random) = assign_cities(review_city_df, all_friends,
+                                              random_seed)
+
+    # Using this info, find network for each cities: edges are split by
+    # city in one pass, and then each city is processed.
+    # Reviews of all cities will be created and saved here.
+    # (Cities we are interested in: Phoenix (0), Las Vegas (1)
+    # and Montreal (3).)
+    edges_by_city = bucket_edges_by_city(all_friends, user_city_int, n_cities)
+    if n_jobs > 1:
+        pool = fork_pool((review_city_df, edges_by_city),
+                         min(n_jobs, n_cities))
+        try:
+            pool.map(run_city_worker, range(n_cities), chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for city in range(n_cities):
+            (src, dst) = edges_by_city[city]
+            make_city_files(city, review_city_df, src, dst)
 
     print "Number of random choices:", n_random
     return
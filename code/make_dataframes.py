@@ -1,11 +1,11 @@
 # (1) Make dataframes from {user, business, and review} json files,
-#       and store them as a pickled file.
+#       and store them in the columnar format (one .npy file per column).
 # (2) Decide what city each business belongs to based on their locations.
 #       kmeans classification will be used.
 # (3) Using above information, each review will be associated by one city.
 # (4) Using degree information already obtained, drop all users with no
 #   friend, because we are focusing on users in a social network.
-#   New reduced dataframes will be stored as a pickled file (reduced dataframes)
+#   New reduced dataframes will be stored in the columnar format.
 # (5) It will store business category for all businesses for future references.
 
 # Filename: make_dataframes.py
@@ -13,15 +13,16 @@
 # last edited on 06-18-2015
 
 import pandas as pd
-import json
+import numpy as np
 import os
-import cPickle as pickle
 from collections import Counter
 from sklearn.cluster import KMeans
 
-from my_utilities import read_json_file, find_id_map, write_dictlist_to_file
+from my_utilities import iter_json_file, find_id_map, write_dictlist_to_file
+from my_utilities import write_json_columns, read_columns
+from my_utilities import write_dataframe, read_dataframe
 
-# Filename for the pickled data of user_id and numbered id map.
+# Filenames for inputs, and directories for outputs (columnar format).
 # inputs:
 user_filename = '../data/yelp_academic_dataset_user.json'
 business_filename = '../data/yelp_academic_dataset_business.json'
@@ -29,146 +30,208 @@ review_filename = '../data/yelp_academic_dataset_review.json'
 degree_filename = '../data/degrees'
 
 # outputs:
-user_pickle_filename = '../data/user_id_map.pkl'            # input (if exists)
-business_pickle_filename = '../data/business_id_map.pkl'    # input (if exists)
-dataframes_pickle_filename = '../data/dataframes.pkl'       # input (if exists)
-reduced_dataframes_pickle_filename = '../data/reduced_dataframes.pkl'
-review_by_city_dataframe_pickle_filename =\
-    '../data/review_by_city_dataframe.pkl'
+user_id_map_dir = '../data/columns/user_id_map'             # input (if exists)
+business_id_map_dir = '../data/columns/business_id_map'     # input (if exists)
+dataframes_dir = '../data/columns/dataframes/%s'            # input (if exists)
+reduced_dataframes_dir = '../data/columns/reduced_dataframes/%s'
+review_by_city_dataframe_dir = '../data/columns/review_by_city_dataframe'
 categories_business_filename = '../data/categories_business'
-
-
-def main():
+# Directories for columns streamed from json files.
+user_columns_dir = '../data/columns/users'
+business_columns_dir = '../data/columns/businesses'
+review_columns_dir = '../data/columns/reviews'
+
+# Columns kept from json files: (column name, json key, dtype, converter).
+# (ID's are 22 characters long in the Yelp dataset; longer values raise an
+# error in write_json_columns, instead of being truncated.)
+user_columns = [('user_id', 'user_id', 'S22', str),
+                ('user_review_count', 'review_count', np.int64, int),
+                ('user_stars', 'average_stars', np.float64, float)]
+business_columns = [('business_id', 'business_id', 'S22', str),
+                    ('business_review_count', 'review_count', np.int64, int),
+                    ('business_stars', 'stars', np.float64, float),
+                    ('business_city', 'city', 'S64',
+                     lambda city: city.encode('utf-8')),
+                    ('business_latitude', 'latitude', np.float64, float),
+                    ('business_longitude', 'longitude', np.float64, float)]
+review_columns = [('business_id', 'business_id', 'S22', str),
+                  ('user_id', 'user_id', 'S22', str),
+                  ('review_stars', 'stars', np.int64, int),
+                  ('review_date', 'date', 'S10', str)]
+
+
+def build_dataframes():
     """
     From 3 json files, it will combine data and create a new dataframe,
-    and store it in a pickled file.
+    and store it in the columnar format.
+    If already stored, it will read from it.
+    Output:
+        (user_df, business_df, review_df): pandas dataframes
     """
-    if os.path.exists(dataframes_pickle_filename):
-        with open(dataframes_pickle_filename, 'r') as f:
-            (user_df, business_df, review_df) = pickle.load(f)
+    if os.path.exists(dataframes_dir % 'reviews'):
+        user_df = read_dataframe(dataframes_dir % 'users')
+        business_df = read_dataframe(dataframes_dir % 'businesses')
+        review_df = read_dataframe(dataframes_dir % 'reviews')
     else:
-        # Read json file for user.
-        user_jsons = read_json_file(user_filename)
+        # Json files are streamed into columnar files (one .npy per column)
+        # one line at a time, keeping only necessary fields.
+        n_users = write_json_columns(user_filename, user_columns,
+                                     user_columns_dir)
         # Each user will be assigned with an integer instead of string user_id
-        # This mapping data will be stored in a dictionary, and will be pickled.
-        # But if this info is already pickled it will just read from it.
-        user_id_map = find_id_map(user_jsons, 'user_id', user_pickle_filename)
-        n_users = len(user_id_map)   # Total number of users.
-
-        # For each user, pick only necessary columns.
-        for user in user_jsons:
-            original_keys = user.keys()
-            user['user_id_int'] = user_id_map[user['user_id']]
-            user['user_review_count'] = int(user['review_count'])
-            user['user_stars'] = float(user['average_stars'])
-            # delete all other values not necessary here.
-            for key in original_keys:
-                user.pop(key, None)
-
-        # Convert the new list into the dataframe.
-        user_df = pd.read_json(json.dumps(user_jsons))
+        # This mapping data will be stored in a dictionary, and will be saved.
+        # But if this info is already saved it will just read from it.
+        user_id_map = find_id_map(iter_json_file(user_filename, ['user_id']),
+                                  'user_id', user_id_map_dir)
+        users = read_columns(user_columns_dir)
+        user_df = pd.DataFrame({
+            'user_id_int': pd.Series(users['user_id']).map(user_id_map),
+            'user_review_count': users['user_review_count'],
+            'user_stars': users['user_stars']},
+            columns=['user_id_int', 'user_review_count', 'user_stars'])
         print "Done for users with %s users." % n_users
 
-        # Read json file for business.
-        business_jsons = read_json_file(business_filename)
-        business_id_map = find_id_map(business_jsons, 'business_id',
-                                      business_pickle_filename)
-        n_businesses = len(business_id_map)   # Total number of businesses.
-
-        # For each business, pick only necessary columns.
-        categories_map = {}  # Storing category information in a separate dict.
-        for business in business_jsons:
-            original_keys = business.keys()
-            business_id = business_id_map[business['business_id']]
-            categories_map[business_id] = business['categories']
-            business['business_id_int'] = business_id
-            business['business_review_count'] = int(business['review_count'])
-            business['business_stars'] = float(business['stars'])
-            business['business_city'] = business['city']
-            business['business_latitude'] = float(business['latitude'])
-            business['business_longitude'] = float(business['longitude'])
-            # delete all other values not necessary here.
-            for key in original_keys:
-                business.pop(key, None)
-
-        # Writing category info into a file.
+        # Same for business.
+        n_businesses = write_json_columns(business_filename,
+                                          business_columns,
+                                          business_columns_dir)
+        business_id_map = find_id_map(iter_json_file(business_filename,
+                                                     ['business_id']),
+                                      'business_id',
+                                      business_id_map_dir)
+        businesses = read_columns(business_columns_dir)
+        business_df = pd.DataFrame({
+            'business_id_int': pd.Series(businesses['business_id'])
+            .map(business_id_map),
+            'business_review_count': businesses['business_review_count'],
+            'business_stars': businesses['business_stars'],
+            'business_city': pd.Series(businesses['business_city'])
+            .str.decode('utf-8'),
+            'business_latitude': businesses['business_latitude'],
+            'business_longitude': businesses['business_longitude']},
+            columns=['business_id_int', 'business_review_count',
+                     'business_stars', 'business_city', 'business_latitude',
+                     'business_longitude'])
+
+        # Storing category information in a separate dict, and writing it
+        # into a file.
+        categories_map = {}
+        for business in iter_json_file(business_filename,
+                                       ['business_id', 'categories']):
+            categories_map[business_id_map[business['business_id']]] =\
+                business['categories']
         write_dictlist_to_file(categories_business_filename, categories_map)
-
-        # Convert the new list into the dataframe.
-        business_df = pd.read_json(json.dumps(business_jsons))
         print "Done for businesses with %s businesses." % n_businesses
 
-        # Read json file for reviews.
-        review_jsons = read_json_file(review_filename)
-        n_reviews = len(review_jsons)   # Total number of reviews.
-
-        # For each user, pick only necessary columns.
-        for review in review_jsons:
-            original_keys = review.keys()
-            review['business_id_int'] = business_id_map[review['business_id']]
-            review['user_id_int'] = user_id_map[review['user_id']]
-            review['review_stars'] = int(review['stars'])
-            review['review_date'] = review['date']
-            # delete all other values not necessary here.
-            for key in original_keys:
-                review.pop(key, None)
-
-        # Convert the new list into the dataframe.
-        review_df = pd.read_json(json.dumps(review_jsons))
+        # Same for reviews (the biggest file).
+        n_reviews = write_json_columns(review_filename, review_columns,
+                                       review_columns_dir)
+        reviews = read_columns(review_columns_dir)
+        review_df = pd.DataFrame({
+            'business_id_int': pd.Series(reviews['business_id'])
+            .map(business_id_map),
+            'user_id_int': pd.Series(reviews['user_id']).map(user_id_map),
+            'review_stars': reviews['review_stars'],
+            'review_date': reviews['review_date']},
+            columns=['business_id_int', 'user_id_int', 'review_stars',
+                     'review_date'])
         print "Done for reviews with %s reviews." % n_reviews
 
-        # Storing these dataframes as a pickled file.
-        with open(dataframes_pickle_filename, 'wb') as f:
-            pickle.dump((user_df, business_df, review_df), f)
+        # Storing these dataframes in the columnar format.
+        write_dataframe(dataframes_dir % 'users', user_df)
+        write_dataframe(dataframes_dir % 'businesses', business_df)
+        write_dataframe(dataframes_dir % 'reviews', review_df)
+    return (user_df, business_df, review_df)
+
 
+def reduce_dataframes(user_df, business_df, review_df, n_cities=10,
+                      kmeans_seed=None):
+    """
+    Decide the city of each business (k-Means of locations), drop users
+    without any friend, and store reduced dataframes in the columnar format.
+    Input:
+        user_df, business_df, review_df: pandas dataframes
+        n_cities: number of cities (clusters) (default: 10)
+        kmeans_seed: random seed for k-Means; if None, the global random
+            state is used (default: None)
+    Output:
+        None
+    """
     # Now we find data frames for reviews for specific cities.
     # From the business locations, we find ten cities using k-Means.
-    km = KMeans(10, n_jobs=8)
+    km = KMeans(n_cities, n_jobs=8, random_state=kmeans_seed)
     X = business_df[['business_latitude', 'business_longitude']].values
     y = km.fit_predict(X)
     y_counter = Counter(y).most_common()
     sorted_y = [c[0] for c in y_counter]
     sorted_y_map = {}
-    for i in range(10):
+    for i in range(n_cities):
         sorted_y_map[sorted_y[i]] = i
     # Store city info as a column. To make city numbers deterministic, City
     # numbers are ordered from the largest num of businesses to the smallest.
-    business_df['business_city_int'] = map(lambda i: sorted_y_map[i], y)
+    city_int_by_label = np.empty(n_cities, dtype=int)
+    for label, city in sorted_y_map.iteritems():
+        city_int_by_label[label] = city
+    business_df['business_city_int'] = city_int_by_label[y]
     # city_names = ['Phoenix', 'Las Vegas', 'Charlotte', 'Montreal',
     #               'Edinburgh', 'Pittsburgh',  'Madison', 'Karlsruhe',
     #               'Urbana-Champaign', 'Waterloo']
 
     # Here we drop all users without any friend.
     # First, we need degree info already found.
-    my_degrees = pd.read_csv("../data/degrees",
+    my_degrees = pd.read_csv(degree_filename,
                              names=['user_id', 'degree'], header=None)
 
-    # A set containing users with at least one friend.
-    users2_set = set(my_degrees[my_degrees.degree > 0].user_id.values)
+    # Users with at least one friend.
+    users2 = my_degrees.user_id.values[my_degrees.degree.values > 0]
 
     # Create all dataframes that only have data with users with at least one
-    # friend.
+    # friend (filtered by vectorized membership tests, not row by row).
     # First, find users first.
-    user_df2 = user_df[user_df.apply(lambda x: x['user_id_int'] in users2_set,
-                                     axis=1)]
+    user_df2 = user_df[user_df.user_id_int.isin(users2)]
     # Second, find reviews done by these users.
-    review_df2 = review_df[review_df
-            .apply(lambda x: x['user_id_int'] in users2_set, axis=1)]
+    review_df2 = review_df[review_df.user_id_int.isin(users2)]
     # Lastly, find businesses that only these reviews are done for.
-    businesses2_set = set(review_df2.business_id_int.unique())
-    business_df2 = business_df[business_df
-            .apply(lambda x: x['business_id_int'] in businesses2_set, axis=1)]
+    business_df2 = business_df[business_df.business_id_int
+                               .isin(review_df2.business_id_int.unique())]
 
     # Dataframe with the reviews (with business city).
     review_city_df2 = business_df2[['business_id_int', 'business_city_int']]\
             .merge(review_df2, on=['business_id_int'], how='inner')
 
-    # Store reduced dataframes to pickle file.
-    with open(reduced_dataframes_pickle_filename, 'wb') as f:
-        pickle.dump((user_df2, business_df2, review_df2, review_city_df2), f)
-    with open(review_by_city_dataframe_pickle_filename, 'wb') as f:
-        pickle.dump(review_city_df2, f)
+    # Store reduced dataframes in the columnar format.
+    write_dataframe(reduced_dataframes_dir % 'users', user_df2)
+    write_dataframe(reduced_dataframes_dir % 'businesses', business_df2)
+    write_dataframe(reduced_dataframes_dir % 'reviews', review_df2)
+    write_dataframe(review_by_city_dataframe_dir, review_city_df2)
+
+    return
+
+
+def reduce_stored_dataframes(n_cities=10, kmeans_seed=None):
+    """
+    Same as reduce_dataframes, but reading dataframes from stored files.
+    Input:
+        n_cities: number of cities (default: 10)
+        kmeans_seed: random seed for k-Means (default: None)
+    Output:
+        None
+    """
+    reduce_dataframes(read_dataframe(dataframes_dir % 'users'),
+                      read_dataframe(dataframes_dir % 'businesses'),
+                      read_dataframe(dataframes_dir % 'reviews'),
+                      n_cities, kmeans_seed)
+    return
+
 
+def main(n_cities=10, kmeans_seed=None):
+    """
+    Create dataframes from json files, and reduced dataframes with city info.
+    Input:
+        n_cities: number of cities (default: 10)
+        kmeans_seed: random seed for k-Means (default: None)
+    """
+    (user_df, business_df, review_df) = build_dataframes()
+    reduce_dataframes(user_df, business_df, review_df, n_cities, kmeans_seed)
     return
 
 
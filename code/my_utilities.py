@@ -5,12 +5,80 @@
 # last edited on 06-18-2015
 
 import numpy as np
-# import pandas as pd
+import pandas as pd
 import json
 import csv
 import os
-import cPickle as pickle
+import itertools
+import contextlib
 import networkx as nx
+from multiprocessing import Pool
+from csr_graph import CSR_Graph, is_graph_file
+try:
+    import ujson as fast_json  # Faster json parser (optional).
+except ImportError:
+    fast_json = json
+
+# Adjacency matrices of network files (see adjacency_matrix_from_file).
+# key: (filename, normalization, size), value: ((file size, mtime), adjacency)
+adjacency_cache = {}
+
+# State of a worker process of fork_pool (see get_worker_state).
+worker_state = None
+
+
+def fork_pool(state, n_jobs):
+    """
+    Create a process pool whose worker processes get the given state once,
+    when they start, instead of with every task. With fork, the state is
+    shared with this process, not pickled, so it can hold large data
+    (e.g., a Validator) and closures (e.g., make_recommender).
+    Task functions (module-level functions) read it with get_worker_state.
+    The caller closes the pool.
+    Input:
+        state: any object (e.g., a tuple)
+        n_jobs: number of processes
+    Output:
+        pool: multiprocessing.Pool
+    """
+    return Pool(n_jobs, set_worker_state, (state,))
+
+
+def set_worker_state(state):
+    """
+    Set the state of this process (initializer of fork_pool; also used to
+    run task functions in this process without a pool).
+    """
+    global worker_state
+    worker_state = state
+
+
+def get_worker_state():
+    """
+    Return the state given to fork_pool (or set_worker_state).
+    """
+    return worker_state
+
+
+@contextlib.contextmanager
+def atomic_open(filename):
+    """
+    Open a file for writing (binary) through a temporary file, which is
+    renamed to filename when closed, so that other processes never read a
+    partially written file.
+    Input:
+        filename: name of the file
+    Output:
+        f: file object (for the with statement)
+    """
+    temp_filename = filename + '.%s.tmp' % os.getpid()
+    try:
+        with open(temp_filename, 'wb') as f:
+            yield f
+        os.rename(temp_filename, filename)
+    finally:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
 
 
 def read_json_file(filename):
@@ -28,31 +96,293 @@ def read_json_file(filename):
     return data_json
 
 
-def find_id_map(data_json, id_label, pickle_filename):
+def iter_json_file(filename, fields=None, fast=True):
     """
-    Given the data and the pickled filename, find the id map.
-    If pickled file exists, it will read the info from the file.
+    To read the json file one line at a time (one json object per line),
+    keeping only given fields, so that the whole file is never in memory.
     Input:
-        data_json: list of json objects from a json file.
-        id_label: string label for the id in json object.
-        pickle_filename: filename of the pickled file.
+        filename: name of the file
+        fields: list of keys to keep (default: None, all keys)
+        fast: if True, use ujson if available (default: True)
+    Output:
+        generator of dicts (json objects)
+    """
+    parser = fast_json if fast else json
+    with open(filename) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            data = parser.loads(line)
+            if fields is None:
+                yield data
+            else:
+                yield dict((key, data[key]) for key in fields)
+
+
+def count_lines(filename):
+    """
+    Count non-empty lines of a file (e.g., json objects in a json file).
+    Input:
+        filename: name of the file
+    Output:
+        n_lines: int
+    """
+    n_lines = 0
+    with open(filename) as f:
+        for line in f:
+            if line.strip():
+                n_lines += 1
+    return n_lines
+
+
+def write_json_columns(filename, columns, output_dir, chunksize=100000,
+                       fast=True):
+    """
+    Stream a json file into columnar files (one .npy file per column) with
+    bounded memory: lines are counted first, and then memory-mapped arrays
+    are filled chunk by chunk while the file is read one line at a time.
+    Input:
+        filename: name of the json file
+        columns: list of (column name, json key, dtype, converter)
+            (converter: function applied to each value, or None)
+            A ValueError is raised if a value is longer than the size of
+            a string dtype (e.g., 'S22'), instead of truncating it.
+        output_dir: directory for .npy files ('<column name>.npy')
+        chunksize: number of lines per chunk (default: 100000)
+        fast: if True, use ujson if available (default: True)
+    Output:
+        n_rows: number of rows written
+    """
+    n_rows = count_lines(filename)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    arrays = [np.lib.format.open_memmap(os.path.join(output_dir,
+                                                     name + '.npy'),
+                                        mode='w+', dtype=dtype,
+                                        shape=(n_rows,))
+              for (name, _, dtype, _) in columns]
+    keys = [key for (_, key, _, _) in columns]
+
+    def write_chunk(chunk, start):
+        for array, (name, key, _, converter) in itertools.izip(arrays,
+                                                              columns):
+            if converter is None:
+                values = [record[key] for record in chunk]
+            else:
+                values = [converter(record[key]) for record in chunk]
+            if array.dtype.kind == 'S':
+                longest = max(len(value) for value in values)
+                if longest > array.dtype.itemsize:
+                    raise ValueError(
+                        "Values of column %s (%s bytes) are longer than %s "
+                        "in %s" % (name, longest, array.dtype.str, filename))
+            array[start:start + len(chunk)] = values
+
+    chunk = []
+    start = 0
+    for record in iter_json_file(filename, keys, fast):
+        chunk.append(record)
+        if len(chunk) == chunksize:
+            write_chunk(chunk, start)
+            start += len(chunk)
+            chunk = []
+    if chunk:
+        write_chunk(chunk, start)
+    for array in arrays:
+        array.flush()
+    return n_rows
+
+
+def read_columns(input_dir, mmap_mode='r'):
+    """
+    Read columnar files (.npy files in a directory) as memory-mapped arrays.
+    Input:
+        input_dir: directory with '<column name>.npy' files
+        mmap_mode: mode for np.load (default: 'r', read-only)
+    Output:
+        columns: dict (key: column name, value: np.array)
+    """
+    columns = {}
+    for filename in os.listdir(input_dir):
+        if filename.endswith('.npy'):
+            columns[filename[:-4]] = np.load(os.path.join(input_dir,
+                                                          filename),
+                                             mmap_mode=mmap_mode)
+    return columns
+
+
+def write_columns(output_dir, columns):
+    """
+    Write columns (arrays of the same length) into a directory, one .npy file
+    per column, so that they can be memory-mapped by read_columns.
+    Object arrays (e.g., strings) are converted to fixed-width arrays.
+    Input:
+        output_dir: directory for .npy files ('<column name>.npy')
+        columns: dict (key: column name, value: array-like)
+    Output:
+        None
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    for name, values in columns.iteritems():
+        values = np.asarray(values)
+        if values.dtype == object:
+            values = np.array(values.tolist())
+        np.save(os.path.join(output_dir, name + '.npy'), values)
+    return
+
+
+def write_dataframe(output_dir, df):
+    """
+    Write a dataframe into a directory in the columnar format
+    (one .npy file per column, and the order of columns in 'columns').
+    The index is not stored.
+    Input:
+        output_dir: directory name
+        df: pandas dataframe
+    Output:
+        None
+    """
+    write_columns(output_dir, dict((column, df[column].values)
+                                   for column in df.columns))
+    with open(os.path.join(output_dir, 'columns'), 'w') as f:
+        for column in df.columns:
+            f.write(column + '\n')
+    return
+
+
+def read_dataframe(input_dir, mmap_mode='r', rows=None):
+    """
+    Read a dataframe written by write_dataframe. Columns are read from
+    memory-mapped files (no parsing), but the dataframe holds copies of
+    them in memory; use read_columns to work on the memory-mapped arrays
+    without copying, or rows to copy only the rows needed.
+    Input:
+        input_dir: directory name
+        mmap_mode: mode for np.load (default: 'r', read-only)
+        rows: boolean mask or indices of rows to read (default: None, all)
+    Output:
+        df: pandas dataframe
+    """
+    columns = read_columns(input_dir, mmap_mode)
+    if rows is not None:
+        columns = dict((name, values[rows])
+                       for name, values in columns.iteritems())
+    with open(os.path.join(input_dir, 'columns'), 'r') as f:
+        names = [line.strip() for line in f if line.strip()]
+    return pd.DataFrame(columns, columns=names)
+
+
+def write_id_map(output_dir, id_map):
+    """
+    Write an id map in the columnar format: string id's are stored in the
+    order of integer id's (ids[i] is the string id for integer id i).
+    Input:
+        output_dir: directory name
+        id_map: dictionary (key: string id, value: integer id from 0)
+    Output:
+        None
+    """
+    ids = [None] * len(id_map)
+    for str_id, int_id in id_map.iteritems():
+        ids[int_id] = str_id
+    write_columns(output_dir, {'ids': ids})
+    return
+
+
+def read_id_map(input_dir):
+    """
+    Read an id map written by write_id_map.
+    Input:
+        input_dir: directory name
     Output:
         id_map: dictionary (key: string id, value: integer id)
     """
-    id_map = {}  # empty dict.
-    if os.path.exists(pickle_filename):
-        print "Reading from the pickled data:", pickle_filename
-        with open(pickle_filename, 'r') as f:
-            id_map = pickle.load(f)
+    ids = np.load(os.path.join(input_dir, 'ids.npy'), mmap_mode='r')
+    return dict(itertools.izip(ids.tolist(), xrange(len(ids))))
+
+
+def encode_ids(ids, id_map=None):
+    """
+    Turn ID's (integers or strings) into dense integer codes, for whole
+    arrays at once (hashing by pandas instead of a dict lookup per ID).
+    Input:
+        ids: array-like of ID's
+        id_map: dict (key: ID, value: code); if None, codes are assigned
+            from 0 in the order of first appearance (default: None)
+    Output:
+        codes: np.array of int32 (-1 for ID's not in id_map)
+        id_map: the given map, or the new map (dict)
+    """
+    ids = np.asarray(ids)
+    if ids.dtype.kind in 'SU':
+        ids = ids.astype(object)  # keep str/unicode objects as they are.
+    if id_map is None:
+        (codes, uniques) = pd.factorize(ids)
+        id_map = dict(itertools.izip(np.asarray(uniques).tolist(),
+                                     xrange(len(uniques))))
+        return codes.astype(np.int32), id_map
+    keys = np.asarray(list(id_map.iterkeys()))
+    values = np.empty(len(id_map) + 1, dtype=np.int32)
+    values[:-1] = np.fromiter(id_map.itervalues(), dtype=np.int32,
+                              count=len(id_map))
+    values[-1] = -1
+    if ids.dtype.kind in 'iu' and keys.dtype.kind in 'iu' and len(ids) and \
+            len(keys) and min(ids.min(), keys.min()) >= 0 and \
+            max(ids.max(), keys.max()) < 4 * (len(ids) + len(keys)):
+        # Small non-negative integers: look up in a dense array.
+        table = np.empty(max(ids.max(), keys.max()) + 1, dtype=np.int32)
+        table.fill(-1)
+        table[keys] = values[:-1]
+        return table[ids], id_map
+    # get_indexer gives -1 for missing ID's, which picks the last value.
+    return values[pd.Index(keys).get_indexer(ids)], id_map
+
+
+def remap_edges(src, dst, id_map):
+    """
+    Map both ends of edges with the given map in one call, and drop edges
+    with an end not in the map.
+    Input:
+        src, dst: array-like of ID's (same size)
+        id_map: dict (key: old ID, value: new ID)
+    Output:
+        new_src, new_dst: np.arrays of int32 (only edges with both ends
+            in the map, in the same order)
+        dropped: unique ID's not in the map (src's, and dst's of edges
+            whose src is in the map) (np.array)
+    """
+    src = np.asarray(src)
+    dst = np.asarray(dst)
+    (codes, _) = encode_ids(np.concatenate((src, dst)), id_map)
+    (src_codes, dst_codes) = (codes[:len(src)], codes[len(src):])
+    dropped = np.union1d(src[src_codes < 0],
+                         dst[(src_codes >= 0) & (dst_codes < 0)])
+    keep = (src_codes >= 0) & (dst_codes >= 0)
+    return src_codes[keep], dst_codes[keep], dropped
+
+
+def find_id_map(data_json, id_label, map_dirname):
+    """
+    Given the data and the directory of the stored map, find the id map.
+    If the map is already stored (columnar format), it will read the info
+    from it.
+    Input:
+        data_json: list (or iterator, e.g., iter_json_file) of json objects
+            from a json file.
+        id_label: string label for the id in json object.
+        map_dirname: directory of the stored map (see write_id_map).
+    Output:
+        id_map: dictionary (key: string id, value: integer id, in the order
+            of first appearance)
+    """
+    if os.path.exists(map_dirname):
+        print "Reading from the stored data:", map_dirname
+        id_map = read_id_map(map_dirname)
     else:
-        user_id = 0
-        for one_data in data_json:
-            str_id = one_data[id_label]
-            if str_id not in id_map:
-                id_map[str_id] = user_id
-                user_id += 1
-        with open(pickle_filename, 'wb') as f:
-            pickle.dump(id_map, f)
+        (_, id_map) = encode_ids([one_data[id_label]
+                                  for one_data in data_json])
+        write_id_map(map_dirname, id_map)
     return id_map
 
 
@@ -96,6 +426,37 @@ def write_dictlist_to_file(filename, my_dict, format='csv'):
     return
 
 
+def write_graph_to_file(filename, graph):
+    """
+    Write a graph (e.g., network) into a binary file (see CSR_Graph.save),
+    to be loaded by memory-mapping, instead of parsing a csv file.
+    Input:
+        filename: name of the file.
+        graph: dict of lists, or CSR_Graph.
+    Output:
+        None
+    """
+    if not isinstance(graph, CSR_Graph):
+        graph = CSR_Graph.from_dictlist(graph)
+    graph.save(filename)
+    return
+
+
+def read_graph_from_file(filename, mmap_mode='r'):
+    """
+    Read a graph (e.g., network) as CSR_Graph, from a binary file
+    (memory-mapped) or a csv file (see read_dictlist_from_file).
+    Input:
+        filename: name of the file (binary if it ends with '.csrg').
+        mmap_mode: mode for memory-mapping (default: 'r', read-only)
+    Output:
+        graph: CSR_Graph
+    """
+    if is_graph_file(filename):
+        return CSR_Graph.load(filename, mmap_mode)
+    return CSR_Graph.from_dictlist(read_dictlist_from_file(filename))
+
+
 def read_dict_from_file(filename, separator=','):
     """
     Read the dict data from a file.
@@ -138,11 +499,26 @@ def write_ratings_to_file(filename, review_df, separator=','):
     Output:
         None
     """
-    with open(filename, 'w') as f:
-        for index, row in review_df.iterrows():
-            f.write(str(row['user_id_int']) + separator +
-                    str(row['business_id_int']) + separator +
-                    str(row['review_stars']) + '\n')
+    review_df.to_csv(filename, sep=separator, header=False, index=False,
+                     columns=['user_id_int', 'business_id_int',
+                              'review_stars'])
+    return
+
+
+def write_ratings_to_columns(output_dir, review_df):
+    """
+    Write ratings data in the columnar format (user_id, item_id, rating),
+    the same data as write_ratings_to_file.
+    Input:
+        output_dir: directory name
+        review_df: pandas dataframe that contains ratings data.
+    Output:
+        None
+    """
+    write_columns(output_dir,
+                  {'user_id': review_df['user_id_int'].values,
+                   'item_id': review_df['business_id_int'].values,
+                   'rating': review_df['review_stars'].values})
     return
 
 
@@ -181,28 +557,81 @@ def convert_from_nx(graph_nx):
     return graph_dict
 
 
-def adjacency_matrix(graph_dict):
+def adjacency_matrix(graph, normalization=None, size=None):
     """
-    Returns the adjacency matrix in np.arary from a graph in dict lof lists.
+    Returns the adjacency matrix (sparse) of a graph.
     Input:
-        graph_dict: graph in a dict of lists (it is assumed that user ID's
-            are numbered from 0 to size-1 consecutively.
+        graph: graph in a dict of lists, or CSR_Graph (it is assumed that
+            user ID's are numbered from 0 to size-1 consecutively).
+        normalization: weights of edges, with the diagonal matrix D of
+            degrees (numbers of friends); users without friends have
+            empty rows and columns. (default: None)
+            None: 1 for every edge (A).
+            'row': row-stochastic, D^-1 A (each row sums to 1, so that
+                A x gives averages over friends).
+            'symmetric': D^-1/2 A D^-1/2.
+            'degree': degree-weighted, A D^-1 (each friend is weighted by
+                the inverse of the friend's degree).
+        size: number of rows and columns (default: None, the largest ID + 1)
     Output:
-        adjacency: adjacency matrix in np.array (at the moment, it is assumed
-            that the size is not too big, so that we can use dense matrices).
+        adjacency: adjacency matrix in sparse.csr_matrix (float, sorted
+            indices).
     """
-    size = len(graph_dict)
-    adjacency = np.zeros((size, size))
-    for user_id in graph_dict:
-        for friend_id in graph_dict[user_id]:
-            adjacency[user_id, friend_id] = 1
+    if not isinstance(graph, CSR_Graph):
+        graph = CSR_Graph.from_dictlist(graph)
+    if size is None:
+        size = graph.n_nodes
+    adjacency = graph.to_sparse(max(size, graph.n_nodes)).astype(np.float64)
+    if size < graph.n_nodes:
+        adjacency = adjacency[:size, :size]
+    adjacency.has_sorted_indices = True
+    if normalization is None:
+        return adjacency
+
+    degrees = np.diff(adjacency.indptr)
+    inverse = np.zeros(size)
+    inverse[degrees > 0] = 1. / degrees[degrees > 0]
+    if normalization == 'row':
+        adjacency.data *= np.repeat(inverse, degrees)
+    elif normalization == 'symmetric':
+        inverse = np.sqrt(inverse)
+        adjacency.data *= np.repeat(inverse, degrees) *\
+            inverse[adjacency.indices]
+    elif normalization == 'degree':
+        adjacency.data *= inverse[adjacency.indices]
+    else:
+        raise ValueError("Unknown normalization: %s" % normalization)
+    return adjacency
+
+
+def adjacency_matrix_from_file(filename, normalization=None, size=None):
+    """
+    Returns the adjacency matrix of a network file (see adjacency_matrix),
+    cached for each file, normalization, and size (found again only when
+    the file is modified). The matrix is shared; do not modify it.
+    Input:
+        filename: name of the network file (binary or csv).
+        normalization: None, 'row', 'symmetric', or 'degree'
+            (default: None)
+        size: number of rows and columns (default: None, the largest ID + 1)
+    Output:
+        adjacency: adjacency matrix in sparse.csr_matrix
+    """
+    key = (os.path.abspath(filename), normalization, size)
+    info = os.stat(filename)
+    stamp = (info.st_size, info.st_mtime)
+    if key in adjacency_cache and adjacency_cache[key][0] == stamp:
+        return adjacency_cache[key][1]
+    adjacency = adjacency_matrix(read_graph_from_file(filename),
+                                 normalization, size)
+    adjacency_cache[key] = (stamp, adjacency)
     return adjacency
 
 
 def reindex_graph(graph_dict, users_id_map=None):
     """
     reindex the graph so that user ID's are indexed from 0 to n-1
-    consecutively.
+    consecutively. (ID's are mapped as whole arrays, see encode_ids.)
     Input:
         graph_dict: a dict of lists representing a graph.
         users_id_map: map for old user ID to new user ID (if found, already)
@@ -213,33 +642,58 @@ def reindex_graph(graph_dict, users_id_map=None):
                     If we are given an old one, it will be returned.
         num_not_counted: number of users not counted.
     """
+    keys = np.asarray(list(graph_dict))
     new_graph_dict = {}
     if users_id_map is not None:
-        not_counted = set([])
-        for u_id in graph_dict:
-            if u_id in users_id_map:
-                new_graph_dict[users_id_map[u_id]] = []
-                for u_id2 in graph_dict[u_id]:
-                    if u_id2 in users_id_map:
-                        new_graph_dict[users_id_map[u_id]].\
-                            append(users_id_map[u_id2])
-                    else:
-                        not_counted.add(u_id2)
-            else:
-                not_counted.add(u_id)
+        # Only friends of users in the map are used.
+        (key_codes, _) = encode_ids(keys, users_id_map)
+        mapped = key_codes >= 0
+        friends = [graph_dict[u_id] for u_id in keys[mapped].tolist()]
+        degrees = np.fromiter((len(friend_list) for friend_list in friends),
+                              dtype=int, count=len(friends))
+        friends = np.asarray(list(itertools.chain.from_iterable(friends)))
+        (src, dst, dropped) = remap_edges(
+            np.repeat(keys[mapped], degrees),
+            friends.astype(keys.dtype) if len(friends) == 0 else friends,
+            users_id_map)
+        not_counted = np.union1d(dropped, keys[~mapped])
+        for code in key_codes[mapped].tolist():
+            new_graph_dict[code] = []
+        # Edges from the same user are contiguous.
+        if len(src) > 0:
+            run_starts = np.flatnonzero(np.concatenate(([True],
+                                                        src[1:] != src[:-1])))
+            run_ends = np.append(run_starts[1:], len(src))
+            src = src.tolist()
+            dst = dst.tolist()
+            for (start, end) in itertools.izip(run_starts.tolist(),
+                                               run_ends.tolist()):
+                new_graph_dict[src[start]] = dst[start:end]
         return new_graph_dict, users_id_map, len(not_counted)
     else:
-        users_id_map = {}
-        new_id = 0
-        for u_id in graph_dict:
-            if u_id not in users_id_map:
-                users_id_map[u_id] = new_id
-                new_id += 1
-            new_graph_dict[users_id_map[u_id]] = []
-            for u_id2 in graph_dict[u_id]:
-                if u_id2 not in users_id_map:
-                    users_id_map[u_id2] = new_id
-                    new_id += 1
-                new_graph_dict[users_id_map[u_id]].\
-                    append(users_id_map[u_id2])
+        # New ID's in the order of first appearance, when reading each user
+        # followed by the user's friends.
+        friends = [graph_dict[u_id] for u_id in keys.tolist()]
+        degrees = np.fromiter((len(friend_list) for friend_list in friends),
+                              dtype=int, count=len(friends))
+        friends = np.asarray(list(itertools.chain.from_iterable(friends)))
+        if len(friends) == 0:
+            friends = friends.astype(keys.dtype)
+        ends = np.cumsum(degrees)
+        key_positions = ends - degrees + np.arange(len(keys))
+        is_key = np.zeros(len(keys) + len(friends), dtype=bool)
+        is_key[key_positions] = True
+        if keys.dtype.kind in 'SU' or friends.dtype.kind in 'SU':
+            sequence = np.empty(len(is_key), dtype=object)
+        else:
+            sequence = np.empty(len(is_key),
+                                dtype=np.result_type(keys, friends))
+        sequence[key_positions] = keys
+        sequence[~is_key] = friends
+        (codes, users_id_map) = encode_ids(sequence)
+        friend_codes = codes[~is_key].tolist()
+        for (code, start, end) in itertools.izip(
+                codes[key_positions].tolist(), (ends - degrees).tolist(),
+                ends.tolist()):
+            new_graph_dict[code] = friend_codes[start:end]
         return new_graph_dict, users_id_map, 0
@@ -0,0 +1,327 @@
+# Stage runner for the preprocessing pipeline.
+# Each stage declares its input files, parameters, and output files.
+# A stage is run only when the key of the stage (hash of its parameters,
+# source files of its code, and contents of its input files) differs
+# from the key stored when it was last run (or its outputs are missing);
+# its old outputs are removed first.
+# Stages are run in waves: all stages whose inputs are ready are run
+# together (in a process pool if n_jobs > 1), e.g., stages for each city.
+
+# Filename: pipeline.py
+
+import os
+import sys
+import json
+import hashlib
+import shutil
+import types
+
+from my_utilities import fork_pool, get_worker_state
+
+# Directory for stored keys of stages and hashes of files.
+default_stamp_directory = '../data/stages'
+
+
+
+def run_stage_worker(i):
+    """
+    Run i-th stage in a worker process (the state of fork_pool: stages).
+    """
+    get_worker_state()[i].run()
+    return i
+
+
+def list_files(path):
+    """
+    List files of the path (the path itself if it is a file, or all files
+    under it, sorted, if it is a directory).
+    Input:
+        path: file or directory name
+    Output:
+        filenames: list of filenames
+    """
+    if not os.path.isdir(path):
+        return [path]
+    filenames = []
+    for (dirpath, dirnames, names) in os.walk(path):
+        dirnames.sort()
+        for name in sorted(names):
+            filenames.append(os.path.join(dirpath, name))
+    return filenames
+
+
+def hash_file(filename, chunksize=2**20):
+    """
+    Find the hash (sha1) of the contents of a file.
+    Input:
+        filename: name of the file
+        chunksize: number of bytes read at once (default: 2**20)
+    Output:
+        hex digest (string)
+    """
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(chunksize)
+            if not chunk:
+                break
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def source_filename(module):
+    """
+    Return the source file (.py) of a module.
+    """
+    return os.path.splitext(os.path.abspath(module.__file__))[0] + '.py'
+
+
+def project_modules(module):
+    """
+    Find modules of the project (in the same directory) that a module uses,
+    directly or through other project modules, from its global names
+    (e.g., 'import my_utilities' or 'from csr_graph import CSR_Graph').
+    Input:
+        module: module object
+    Output:
+        modules: list of module objects (including the given one)
+    """
+    directory = os.path.dirname(source_filename(module))
+    found = {module.__name__: module}
+    stack = [module]
+    while stack:
+        for value in vars(stack.pop()).values():
+            if isinstance(value, types.ModuleType):
+                used = value
+            else:
+                name = getattr(value, '__module__', None)
+                if not isinstance(name, basestring):
+                    continue
+                used = sys.modules.get(name)
+            if used is None or used.__name__ in found or \
+                    getattr(used, '__file__', None) is None:
+                continue
+            if os.path.dirname(source_filename(used)) == directory:
+                found[used.__name__] = used
+                stack.append(used)
+    return found.values()
+
+
+class Stage():
+    """
+    A stage of the pipeline: function(**params) reads inputs and writes
+    outputs (files or directories).
+    """
+    def __init__(self, name, function, inputs=[], outputs=[], params=None,
+                 code=None):
+        """
+        Constructor for Stage class.
+        Input:
+            name: name of the stage (unique)
+            function: function to run (module-level function)
+            inputs: list of input files or directories
+            outputs: list of output files or directories
+            params: dict of parameters (json-serializable), given to
+                function as keyword arguments (default: None)
+            code: list of other modules or source files the stage depends
+                on; project modules used by the module of function are
+                found automatically (see project_modules) (default: None)
+        """
+        self.name = name
+        self.function = function
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = params or {}
+        self.code = list(code or [])
+
+    def source_filenames(self):
+        """
+        Return source files of the code of the stage (sorted): modules of
+        the project used by the function, and ones given in code.
+        """
+        filenames = set(source_filename(module) for module in
+                        project_modules(sys.modules[self.function.__module__]))
+        for item in self.code:
+            if isinstance(item, types.ModuleType):
+                filenames.update(source_filename(module)
+                                 for module in project_modules(item))
+            else:
+                filenames.add(os.path.abspath(item))
+        return sorted(filenames)
+
+    def run(self):
+        """
+        Run the function of the stage.
+        """
+        print "Running stage:", self.name
+        self.function(**self.params)
+        return
+
+    def remove_outputs(self):
+        """
+        Remove outputs of the stage (if exist).
+        """
+        for path in self.outputs:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+        return
+
+
+class Stage_Runner():
+    """
+    Class for running stages, only when their inputs or parameters changed.
+    """
+    def __init__(self, stages, stamp_directory=default_stamp_directory,
+                 n_jobs=1):
+        """
+        Constructor for Stage_Runner class.
+        Input:
+            stages: list of Stage objects
+            stamp_directory: directory to store keys of stages and
+                hashes of files (default: '../data/stages')
+            n_jobs: number of processes to run independent stages
+                (default: 1)
+        """
+        self.stages = stages
+        self.stamp_directory = stamp_directory
+        self.n_jobs = n_jobs
+        if not os.path.exists(stamp_directory):
+            os.makedirs(stamp_directory)
+        # Hashes of files are reused while size and modification time of
+        # files are not changed. (key: filename, value: [size, mtime, hash])
+        self.hashes_filename = os.path.join(stamp_directory, 'hashes.json')
+        self.hashes = {}
+        if os.path.exists(self.hashes_filename):
+            with open(self.hashes_filename, 'r') as f:
+                self.hashes = json.load(f)
+
+    def file_hash(self, filename):
+        """
+        Find the hash of a file (reusing the stored one if not modified).
+        """
+        info = os.stat(filename)
+        stored = self.hashes.get(filename)
+        if stored is not None and stored[0] == info.st_size and \
+                stored[1] == info.st_mtime:
+            return stored[2]
+        digest = hash_file(filename)
+        self.hashes[filename] = [info.st_size, info.st_mtime, digest]
+        return digest
+
+    def stage_key(self, stage):
+        """
+        Find the key of the stage from its parameters, source files of its
+        code, and contents of its inputs.
+        Input:
+            stage: Stage object
+        Output:
+            key: hex digest (string)
+        """
+        sha = hashlib.sha1()
+        sha.update(json.dumps([stage.name, stage.params], sort_keys=True))
+        for filename in stage.source_filenames():
+            sha.update(os.path.basename(filename))
+            sha.update(self.file_hash(filename))
+        for path in stage.inputs:
+            sha.update(path)
+            if not os.path.exists(path):
+                sha.update('missing')
+                continue
+            for filename in list_files(path):
+                sha.update(os.path.relpath(filename, path))
+                sha.update(self.file_hash(filename))
+        return sha.hexdigest()
+
+    def stamp_filename(self, stage):
+        """
+        Return the filename storing the key of the stage.
+        """
+        return os.path.join(self.stamp_directory, stage.name)
+
+    def is_current(self, stage, key):
+        """
+        Check if outputs of the stage are up to date for the given key.
+        """
+        filename = self.stamp_filename(stage)
+        if not os.path.exists(filename):
+            return False
+        with open(filename, 'r') as f:
+            if f.read().strip() != key:
+                return False
+        return all(os.path.exists(path) for path in stage.outputs)
+
+    def write_hashes(self):
+        """
+        Store hashes of files.
+        """
+        with open(self.hashes_filename, 'w') as f:
+            json.dump(self.hashes, f)
+        return
+
+    def find_dependencies(self):
+        """
+        Find stages each stage depends on (stages producing its inputs).
+        Output:
+            dependencies: list of sets of stage indices.
+        """
+        producers = {}
+        for i, stage in enumerate(self.stages):
+            for path in stage.outputs:
+                producers[os.path.normpath(path)] = i
+        dependencies = []
+        for stage in self.stages:
+            dependencies.append(set(producers[os.path.normpath(path)]
+                                    for path in stage.inputs
+                                    if os.path.normpath(path) in producers))
+        return dependencies
+
+    def run(self, force=False):
+        """
+        Run stages whose outputs are not up to date, in the order of
+        dependencies.
+        Input:
+            force: if True, run all stages (default: False)
+        Output:
+            names: list of names of stages run.
+        """
+        dependencies = self.find_dependencies()
+        done = set()
+        names = []
+        while len(done) < len(self.stages):
+            ready = [i for i in range(len(self.stages))
+                     if i not in done and dependencies[i] <= done]
+            if not ready:
+                raise ValueError("Stages have circular dependencies.")
+            keys = {}
+            for i in ready:
+                keys[i] = self.stage_key(self.stages[i])
+            stale = [i for i in ready
+                     if force or not self.is_current(self.stages[i], keys[i])]
+            for i in stale:
+                self.stages[i].remove_outputs()
+                # Stamp is removed first, so that an interrupted stage
+                # is run again.
+                if os.path.exists(self.stamp_filename(self.stages[i])):
+                    os.remove(self.stamp_filename(self.stages[i]))
+            if self.n_jobs > 1 and len(stale) > 1:
+                pool = fork_pool(self.stages, min(self.n_jobs, len(stale)))
+                try:
+                    pool.map(run_stage_worker, stale, chunksize=1)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                for i in stale:
+                    self.stages[i].run()
+            for i in stale:
+                with open(self.stamp_filename(self.stages[i]), 'w') as f:
+                    f.write(keys[i] + '\n')
+                names.append(self.stages[i].name)
+            for i in ready:
+                if i not in stale:
+                    print "Up to date:", self.stages[i].name
+            self.write_hashes()
+            done.update(ready)
+        return names
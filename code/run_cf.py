@@ -5,9 +5,10 @@
 # last edited on 06-26-2015
 
 import sys
+import itertools
 import numpy as np
 
-from validator import Validator
+from sweep import Sweep_Scheduler, city_filenames
 from factorization import Matrix_Factorization  # , MetaPredictor
 
 
@@ -18,38 +19,64 @@ def main():
     input_filename = sys.argv[1]
     user_bias = bool(int(sys.argv[2]))
     item_bias = bool(int(sys.argv[3]))
+    n_jobs = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+    checkpoint_filename = sys.argv[5] if len(sys.argv) > 5 else 'none'
+    if checkpoint_filename == 'none':
+        checkpoint_filename = None
+    file_format = sys.argv[6] if len(sys.argv) > 6 else 'binary'
+    factor_directory = sys.argv[7] if len(sys.argv) > 7 else 'none'
+    if factor_directory == 'none':
+        factor_directory = None
+    curve_filename = sys.argv[8] if len(sys.argv) > 8 else 'none'
+    if curve_filename == 'none':
+        curve_filename = None
+    (ratings_filename, network_filename) = city_filenames[file_format]
     nums = []
     with open(input_filename, 'r') as f:
         for line in f:
             nums.append(line.strip().split(" "))
 
+    def make_recommender(validator, params):
+        """
+        Creating an object for my model
+        """
+        (nfeat, lrate, rparam) = params
+        return Matrix_Factorization(n_features=nfeat,
+                                    learn_rate=lrate,
+                                    regularization_param=rparam,
+                                    optimizer_pct_improvement_criterion=2,
+                                    user_bias_correction=user_bias,
+                                    item_bias_correction=item_bias)
+
+    # k: number of folds for cross validation.
+    k = 10
+    param_grid = list(itertools.product(map(int, nums[1]),
+                                        map(float, nums[2]),
+                                        map(float, nums[3])))
+    config = {'model': 'Matrix_Factorization', 'user_bias': user_bias,
+              'item_bias': item_bias}
+    # With factor_directory, grid points with the same n_features are
+    # warm-started from the previous one on each fold.
+    scheduler = Sweep_Scheduler(make_recommender, k, n_jobs,
+                                checkpoint_filename, config=config,
+                                ratings_filename=ratings_filename,
+                                network_filename=network_filename,
+                                factor_directory=factor_directory,
+                                warm_start_group=lambda params: params[0],
+                                curve_filename=curve_filename)
+    results = scheduler.run(nums[0], param_grid)
     for city in nums[0]:
-        # Filenames needed.
-        ratings_filename = "../data/reviews" + city
-        network_filename = "../data/network" + city + "b.csv"
-        # Create the Validator object.
-        # k: number of folds for cross validation.
-        k = 10
-        # Creating an object for my model
-        val = Validator(ratings_filename, network_filename, k, 0.)
-        for nfeat in map(int, nums[1]):
-            for lrate in map(float, nums[2]):
-                for rparam in map(float, nums[3]):
-                    my_rec = Matrix_Factorization(n_features=nfeat,
-                                        learn_rate=lrate,
-                                        regularization_param=rparam,
-                                        optimizer_pct_improvement_criterion=2,
-                                        user_bias_correction=user_bias,
-                                        item_bias_correction=item_bias)
-                    (val_results, ratios) = val.validate(my_rec, run_all=True)
-                    print 'validation results: '
-                    print city, nfeat, lrate, rparam, ratios, val_results, \
-                        np.mean(val_results)
+        for (nfeat, lrate, rparam) in param_grid:
+            (val_results, ratios) = results[(city, (nfeat, lrate, rparam))]
+            print 'validation results: '
+            print city, nfeat, lrate, rparam, ratios, val_results, \
+                np.mean(val_results)
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 4:
-        print "Usage: python run_recommender.py input 0 1"
+    if len(sys.argv) not in (4, 5, 6, 7, 8, 9):
+        print "Usage: python run_recommender.py input 0 1",\
+            "[n_jobs [checkpoint [format [factors [curves]]]]]"
         print "     input: input filename"
         print "         first line: list of cities (separated by space)"
         print "         second line: list of n_feature's"
@@ -57,5 +84,17 @@ if __name__ == "__main__":
         print "         fourth line: list of regularization parameter"
         print "     0: user_bias (1 if True)"
         print "     1: item_bias (1 if True)"
+        print "     n_jobs: number of processes (default: 1)"
+        print "     checkpoint: file to store finished results, to resume",\
+            "an interrupted run ('none' for no checkpoint; optional)"
+        print "     format: 'binary' (columns of ratings, network%sb.csrg)",\
+            "or 'text' (csv files, reviews%s and network%sb.csv)",\
+            "(default: binary)"
+        print "     factors: directory for fitted factors, to warm-start",\
+            "each grid point from the previous one (same n_feature) on",\
+            "the same fold ('none' for no warm start; optional)"
+        print "     curves: file to record validation curves, the RMSE of",\
+            "each fold after every epoch, with the training history",\
+            "('none' for no curves; optional)"
         sys.exit()
     main()
@@ -5,9 +5,10 @@
 # last edited on 06-27-2015
 
 import sys
+import itertools
 import numpy as np
 
-from validator import Validator
+from sweep import Sweep_Scheduler, city_filenames
 from using_friends import Using_Friends
 
 
@@ -21,36 +22,78 @@ def main():
 
     input_filename = sys.argv[1]
     if_average = bool(int(sys.argv[2]))
+    n_jobs = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    checkpoint_filename = sys.argv[4] if len(sys.argv) > 4 else 'none'
+    if checkpoint_filename == 'none':
+        checkpoint_filename = None
+    file_format = sys.argv[5] if len(sys.argv) > 5 else 'binary'
+    (ratings_filename, network_filename) = city_filenames[file_format]
     nums = []
     with open(input_filename, 'r') as f:
         for line in f:
             nums.append(line.strip().split(" "))
 
+    def make_recommender(validator, params):
+        """
+        Creating an object for my model
+        """
+        (llimit, ulimit, weight2) = params
+        # The network and friends of friends are found once for each city
+        # (in prepare), and shared by all recommenders.
+        return Using_Friends(validator.get_friends_graph(),
+                             n_ratings_lower_limit=llimit,
+                             n_ratings_upper_limit=ulimit,
+                             if_average=if_average,
+                             friends2_weight=weight2,
+                             friends2=validator.friends2_graph)
+
+    # Weights for friends of friends (optional fourth line).
+    weights2 = map(float, nums[3]) if len(nums) > 3 else [0.]
+
+    def prepare(validator):
+        """
+        Find the network as CSR_Graph, and friends of friends if used.
+        """
+        validator.get_friends_graph()
+        if max(weights2) > 0:
+            validator.get_friends2()
+
+    param_grid = list(itertools.product(map(int, nums[1]),
+                                        map(int, nums[2]), weights2))
+    config = {'model': 'Using_Friends', 'if_average': if_average}
+    scheduler = Sweep_Scheduler(make_recommender, k, n_jobs,
+                                checkpoint_filename, config=config,
+                                ratings_filename=ratings_filename,
+                                network_filename=network_filename,
+                                prepare=prepare)
+    results = scheduler.run(nums[0], param_grid)
     for city in nums[0]:
-        ratings_filename = "../data/reviews" + city
-        network_filename = "../data/network" + city + "b.csv"
-        # Creating an object for my model
-        val = Validator(ratings_filename, network_filename, k, 0.)
-        for llimit in map(int, nums[1]):
-            for ulimit in map(int, nums[2]):
-                uf = Using_Friends(val.get_network(),
-                    n_ratings_lower_limit=llimit, n_ratings_upper_limit=ulimit,
-                    if_average=if_average)
-                (val_results, ratios) = val.validate(uf, run_all=True)
-                print 'validation results: '
-                print city, llimit, ulimit, ratios, val_results, \
-                    np.mean(val_results)
+        for (llimit, ulimit, weight2) in param_grid:
+            (val_results, ratios) = results[(city,
+                                             (llimit, ulimit, weight2))]
+            print 'validation results: '
+            print city, llimit, ulimit, weight2, ratios, val_results, \
+                np.mean(val_results)
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print "Usage: python run_recommender2.py input 0"
+    if len(sys.argv) not in (3, 4, 5, 6):
+        print "Usage: python run_recommender2.py input 0",\
+            "[n_jobs [checkpoint [format]]]"
         print "     input: filename for parameters"
         print "         first line: list of cities (separated by space)"
         print "         second line: list of lower limits (separated by space)"
         print "         third line: list of upper limits (separated by space)"
+        print "         fourth line: list of weights for friends of friends",\
+            "(optional, default: 0, only friends)"
         print "     0: If this value is 0, there will be no prediction, when",\
             "there are not enough ratings from friends.",\
             "If 1, the item average will be used for prediction."
+        print "     n_jobs: number of processes (default: 1)"
+        print "     checkpoint: file to store finished results, to resume",\
+            "an interrupted run ('none' for no checkpoint; optional)"
+        print "     format: 'binary' (columns of ratings, network%sb.csrg)",\
+            "or 'text' (csv files, reviews%s and network%sb.csv)",\
+            "(default: binary)"
         sys.exit()
     main()
@@ -0,0 +1,95 @@
+# To run the preprocessing pipeline (extract_network.py, make_dataframes.py,
+# and find_users_by_city.py) with the stage runner (pipeline.py): only stages
+# whose inputs or parameters changed are run, and stages for each city are
+# run in parallel.
+# usage: python run_pipeline.py [n_jobs [kmeans_seed [n_cities [force]]]]
+#   (kmeans_seed: random seed for k-Means, -1 for no seed (default: 0))
+
+# Filename: run_pipeline.py
+
+import sys
+
+import extract_network
+import make_dataframes
+import find_users_by_city
+from pipeline import Stage, Stage_Runner
+
+
+def make_stages(n_cities=10, kmeans_seed=0, random_seed=123):
+    """
+    Define stages of the preprocessing pipeline.
+    Input:
+        n_cities: number of cities (default: 10)
+        kmeans_seed: random seed for k-Means (default: 0)
+        random_seed: random seed for breaking ties when finding cities of
+            users (default: 123)
+    Output:
+        stages: list of Stage objects
+    """
+    md = make_dataframes
+    fc = find_users_by_city
+    dataframes = [md.dataframes_dir % name
+                  for name in ['users', 'businesses', 'reviews']]
+    stages = [
+        Stage('extract_network', extract_network.main,
+              inputs=[extract_network.userdata_filename],
+              outputs=[extract_network.network_filename,
+                       extract_network.network_graph_filename,
+                       extract_network.degree_filename,
+                       extract_network.user_id_map_dir]),
+        Stage('build_dataframes', md.build_dataframes,
+              inputs=[md.user_filename, md.business_filename,
+                      md.review_filename, md.user_id_map_dir],
+              outputs=dataframes + [md.business_id_map_dir,
+                                    md.categories_business_filename,
+                                    md.user_columns_dir,
+                                    md.business_columns_dir,
+                                    md.review_columns_dir]),
+        Stage('reduce_dataframes', md.reduce_stored_dataframes,
+              inputs=dataframes + [md.degree_filename],
+              outputs=[md.reduced_dataframes_dir % name for name in
+                       ['users', 'businesses', 'reviews']] +
+              [md.review_by_city_dataframe_dir],
+              params={'n_cities': n_cities, 'kmeans_seed': kmeans_seed}),
+        Stage('assign_cities', fc.assign_cities_from_stored,
+              inputs=[fc.review_by_city_dataframe_dir, fc.network_filename,
+                      fc.network_graph_filename],
+              outputs=[fc.user_by_city_filename] +
+              [fc.edges_city_dir % city for city in range(n_cities)],
+              params={'random_seed': random_seed, 'n_cities': n_cities})]
+    for city in range(n_cities):
+        stages.append(
+            Stage('city%s' % city, fc.make_city_files_from_stored,
+                  inputs=[fc.review_by_city_dataframe_dir,
+                          fc.edges_city_dir % city],
+                  outputs=[fc.network_city_filename % city,
+                           fc.network_city_filename % (str(city) + 'b'),
+                           fc.network_city_graph_filename % city,
+                           fc.network_city_graph_filename %
+                           (str(city) + 'b'),
+                           fc.degree_city_filename % city,
+                           fc.review_by_city_filename % city,
+                           fc.review_by_city_columns_dir % city],
+                  params={'city': city}))
+    return stages
+
+
+def main():
+    """
+    Run the pipeline.
+    """
+    n_jobs = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    kmeans_seed = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    if kmeans_seed < 0:
+        kmeans_seed = None
+    n_cities = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+    force = bool(int(sys.argv[4])) if len(sys.argv) > 4 else False
+
+    runner = Stage_Runner(make_stages(n_cities, kmeans_seed), n_jobs=n_jobs)
+    names = runner.run(force)
+    print "Stages run:", ", ".join(names) if names else "none"
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+# Adaptive search of model parameters using successive halving.
+# All candidates are first scored on a few folds (and a few epochs, for
+# models with iterations); only the better ones are scored again with more
+# folds and epochs, and only the survivors get the full k-fold validation.
+
+# Filename: search.py
+
+import numpy as np
+
+
+def successive_halving(validator, make_recommender, candidates, eta=3,
+                       min_folds=1, min_iterations=3, n_jobs=1, seed=0,
+                       factor_store=None, factor_tag=None):
+    """
+    Find the best parameters among candidates with successive halving.
+    At rung r, remaining candidates are validated on min_folds * eta**r
+    folds, with at most min_iterations * eta**r epochs (if the recommender
+    has max_iterations), and the best 1/eta of them are kept.
+    When one candidate (or all folds) is reached, the remaining candidates
+    are validated on all folds without the limit on epochs.
+    Input:
+        validator: Validator object.
+        make_recommender: function (validator, params) -> recommender
+        candidates: list of parameters (tuples)
+        eta: ratio of candidates dropped at each rung (default: 3)
+        min_folds: number of folds at the first rung (default: 1)
+        min_iterations: max. epochs at the first rung (default: 3)
+        n_jobs: number of processes for folds (default: 1)
+        seed: random seed for fitting (default: 0)
+        factor_store: Factor_Store (on disk, for n_jobs > 1); if given,
+            recommenders with warm_start save their factors there, and
+            start from the factors of the same candidate at the previous
+            rung on the same fold (at the first rung, from the previous
+            candidate). Candidates run one by one, so results are the same
+            for any n_jobs. (default: None, no warm start)
+        factor_tag: name of the model configuration, added to names of
+            factors (default: None)
+    Output:
+        best_params: parameters with the lowest mean RMSE on all folds.
+        history: list of (rung, params, n_folds, max_iterations, rmse's)
+    """
+    history = []
+    candidates = [tuple(params) for params in candidates]
+    n_folds = min(min_folds, validator.k)
+    max_iterations = min_iterations
+    rung = 0
+    fitted = set()  # candidates with stored factors.
+    while len(candidates) > 1 and n_folds < validator.k:
+        scores = []
+        previous = None
+        for params in candidates:
+            start = params if params in fitted else previous
+            list_rmse = run_candidate(validator, make_recommender, params,
+                                      range(n_folds), max_iterations,
+                                      n_jobs, seed, factor_store,
+                                      factor_tag, start)
+            history.append((rung, params, n_folds, max_iterations,
+                            list_rmse))
+            scores.append(mean_rmse(list_rmse))
+            fitted.add(params)
+            previous = params
+        print "Rung", rung, "done with", len(candidates), "candidates,", \
+            n_folds, "folds, and", max_iterations, "iterations."
+        n_keep = max(1, int(np.ceil(len(candidates) / float(eta))))
+        order = np.argsort(scores, kind='mergesort')
+        candidates = [candidates[i] for i in sorted(order[:n_keep])]
+        n_folds = min(n_folds * eta, validator.k)
+        max_iterations *= eta
+        rung += 1
+
+    # Full validation for the survivors.
+    best_params = None
+    best_score = np.inf
+    previous = None
+    for params in candidates:
+        start = params if params in fitted else previous
+        list_rmse = run_candidate(validator, make_recommender, params,
+                                  range(validator.k), None, n_jobs, seed,
+                                  factor_store, factor_tag, start)
+        fitted.add(params)
+        previous = params
+        history.append((rung, params, validator.k, None, list_rmse))
+        score = mean_rmse(list_rmse)
+        if best_params is None or score < best_score:
+            best_params = params
+            best_score = score
+    return best_params, history
+
+
+def run_candidate(validator, make_recommender, params, folds, max_iterations,
+                  n_jobs, seed, factor_store=None, factor_tag=None,
+                  start_params=None):
+    """
+    Validate one candidate on given folds with a limit on epochs.
+    If factor_store is given, the recommender (with warm_start) saves its
+    factors there, and starts from the factors of start_params (if not
+    None) on each fold.
+    Output:
+        list_rmse: list of RMSE for each fold.
+    """
+    recommender = make_recommender(validator, params)
+    if hasattr(recommender, 'max_iterations'):
+        recommender.max_iterations = max_iterations
+    if factor_store is not None and hasattr(recommender, 'warm_start'):
+        recommender.factor_store = factor_store
+        recommender.factor_key = (factor_tag,) + params
+        recommender.warm_start = start_params is not None
+        if start_params is not None:
+            recommender.warm_start_key = (factor_tag,) + start_params
+    (list_rmse, _) = validator.validate(recommender, n_jobs=n_jobs,
+                                        seed=seed, folds=folds)
+    return list_rmse
+
+
+def mean_rmse(list_rmse):
+    """
+    Mean of RMSE's (inf if any fold has no prediction).
+    """
+    if any(rmse is None for rmse in list_rmse):
+        return np.inf
+    return np.mean(list_rmse)
@@ -0,0 +1,90 @@
+# To search parameters of the CF recommender system with successive halving,
+# instead of running all folds for every combination (run_cf.py).
+
+# Filename: search_cf.py
+
+import sys
+import itertools
+
+from validator import Validator
+from factorization import Matrix_Factorization, Factor_Store
+from factorization import close_als_pools
+from search import successive_halving
+from sweep import city_filenames, config_tag
+
+
+def main():
+    """
+    To search parameters of the CF model.
+    """
+    input_filename = sys.argv[1]
+    user_bias = bool(int(sys.argv[2]))
+    item_bias = bool(int(sys.argv[3]))
+    n_jobs = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+    file_format = sys.argv[5] if len(sys.argv) > 5 else 'binary'
+    factor_directory = sys.argv[6] if len(sys.argv) > 6 else 'none'
+    if factor_directory == 'none':
+        factor_store = None
+    else:
+        factor_store = Factor_Store(factor_directory)
+    config = {'model': 'Matrix_Factorization', 'user_bias': user_bias,
+              'item_bias': item_bias}
+    nums = []
+    with open(input_filename, 'r') as f:
+        for line in f:
+            nums.append(line.strip().split(" "))
+
+    def make_recommender(validator, params):
+        """
+        Creating an object for my model
+        """
+        (nfeat, lrate, rparam) = params
+        return Matrix_Factorization(n_features=nfeat,
+                                    learn_rate=lrate,
+                                    regularization_param=rparam,
+                                    optimizer_pct_improvement_criterion=2,
+                                    user_bias_correction=user_bias,
+                                    item_bias_correction=item_bias)
+
+    candidates = list(itertools.product(map(int, nums[1]),
+                                        map(float, nums[2]),
+                                        map(float, nums[3])))
+    try:
+        for city in nums[0]:
+            ratings_filename = city_filenames[file_format][0] % city
+            network_filename = city_filenames[file_format][1] % city
+            # k: number of folds for cross validation.
+            k = 10
+            val = Validator(ratings_filename, network_filename, k, 0., seed=0)
+            (best_params, history) = successive_halving(
+                val, make_recommender, candidates, n_jobs=n_jobs,
+                factor_store=factor_store, factor_tag=config_tag(config))
+            print 'search results: '
+            for (rung, params, n_folds, max_iterations, list_rmse) in \
+                    history:
+                print city, rung, n_folds, max_iterations, params, list_rmse
+            print 'best: '
+            print city, best_params
+    finally:
+        close_als_pools()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (4, 5, 6, 7):
+        print "Usage: python search_cf.py input 0 1 [n_jobs [format",\
+            "[factors]]]"
+        print "     input: input filename"
+        print "         first line: list of cities (separated by space)"
+        print "         second line: list of n_feature's"
+        print "         third line: list of learning rates"
+        print "         fourth line: list of regularization parameter"
+        print "     0: user_bias (1 if True)"
+        print "     1: item_bias (1 if True)"
+        print "     n_jobs: number of processes (default: 1)"
+        print "     format: 'binary' or 'text' files (see sweep.py)",\
+            "(default: binary)"
+        print "     factors: directory for fitted factors, to warm-start",\
+            "candidates from their factors at the previous rung on the",\
+            "same fold ('none' for no warm start; optional)"
+        sys.exit()
+    main()
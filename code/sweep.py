@@ -0,0 +1,331 @@
+# Scheduler for hyperparameter sweeps (grid searches) over cities.
+# (city, params, fold) tasks are run in a process pool. Each city's data
+# (Validator) is loaded once and shared by all grid points (worker processes
+# are forked after loading). Finished results are appended to a checkpoint
+# file (json, one line per task), so that an interrupted sweep resumes
+# where it stopped.
+# With a directory of factors, grid points of the same fold run in chains,
+# each fit warm-started from the factors of the previous grid point.
+
+# Filename: sweep.py
+
+import json
+import os
+import itertools
+import hashlib
+
+from validator import Validator
+from factorization import Factor_Store, close_als_pools
+from my_utilities import fork_pool, set_worker_state, get_worker_state
+
+# Filenames of ratings and the network for each city (%s: city), in binary
+# formats (columns of ratings and CSR_Graph) or in text formats (csv).
+city_filenames = {
+    'binary': ('../data/columns/reviews%s', '../data/network%sb.csrg'),
+    'text': ('../data/reviews%s', '../data/network%sb.csv')}
+
+
+def config_tag(config):
+    """
+    Short hash of a model configuration (see Sweep_Scheduler), used in
+    names of stored factors, so that factors of different configurations
+    are kept apart.
+    """
+    return hashlib.sha1(json.dumps(config, sort_keys=True)).hexdigest()[:8]
+
+
+def open_for_append(filename):
+    """
+    Open a file of json lines (checkpoint or curves) for appending.
+    A partially written last line (of an interrupted sweep) is ended first,
+    so that the next line is not appended to it (and lost).
+    """
+    f = open(filename, 'a')
+    if os.path.getsize(filename) > 0:
+        with open(filename, 'rb') as f_last:
+            f_last.seek(-1, os.SEEK_END)
+            if f_last.read(1) != '\n':
+                f.write('\n')
+    return f
+
+
+def run_sweep_task(task):
+    """
+    Run one task for the current city: grid points of the chain are
+    validated on the fold in order (the state of fork_pool:
+    (validator, make_recommender, use_average, seed, factor_store, tag,
+    record_curves)).
+    With factor_store, each fit (of recommenders with warm_start) starts
+    from the factors of the previous grid point; for grid points already
+    done, stored factors are loaded instead of fitting (if found).
+    With record_curves, recommenders with validation_hook find the RMSE of
+    the fold after every epoch (Validator.rmse_hook).
+    Input:
+        task: (fold, chain), where chain is a list of (params, is_done)
+    Output:
+        results: list of (params, fold, rmse, ratio, history) for grid
+            points not done before (history: training history with
+            the RMSE of the fold, or None).
+    """
+    (validator, make_recommender, use_average, seed, factor_store, tag,
+     record_curves) = get_worker_state()
+    (fold, chain) = task
+    results = []
+    previous = None
+    for (params, is_done) in chain:
+        recommender = make_recommender(validator, params)
+        if factor_store is not None and hasattr(recommender, 'warm_start'):
+            recommender.factor_store = factor_store
+            recommender.factor_key = (tag,) + params
+            recommender.warm_start = previous is not None
+            if previous is not None:
+                recommender.warm_start_key = (tag,) + previous
+            recommender.saved_matrices = is_done
+        record = record_curves and hasattr(recommender, 'validation_hook')
+        if record:
+            recommender.validation_hook = validator.rmse_hook(fold)
+        (rmse, ratio) = validator.validate_fold(recommender, fold,
+                                                use_average, seed)
+        history = recommender.history if record else None
+        if not is_done:
+            results.append((params, fold, rmse, ratio, history))
+        previous = params
+    return results
+
+
+class Sweep_Scheduler():
+    """
+    Class for running a grid of parameters for many cities with k-fold
+    validation, in parallel and with checkpoints.
+    """
+    def __init__(self, make_recommender, k=10, n_jobs=1,
+                 checkpoint_filename=None, seed=0, use_average=False,
+                 config=None,
+                 ratings_filename=city_filenames['binary'][0],
+                 network_filename=city_filenames['binary'][1],
+                 prepare=None, factor_directory=None,
+                 warm_start_group=None, curve_filename=None):
+        """
+        Constructor of the class
+        Input:
+            make_recommender: function (validator, params) -> recommender
+            k: number of folds for cross validation (default: 10)
+            n_jobs: number of processes (default: 1)
+            checkpoint_filename: file to store finished results; if it
+                exists, tasks already there will not run again
+                (default: None, no checkpoint)
+            seed: random seed for folds and fitting, so that a resumed
+                sweep uses the same folds (default: 0)
+            use_average: if True, predict using just averages
+                (default: False)
+            config: configuration of the model not in params (dict,
+                json-serializable, e.g., the recommender type and options
+                given to make_recommender); results in the checkpoint are
+                used only for the same config (default: None)
+            ratings_filename, network_filename: filenames for each city,
+                with %s for the city (see city_filenames)
+                (default: binary formats)
+            prepare: function (validator) -> None, called once for each
+                city before running tasks, to find data shared by all
+                tasks (e.g., Validator.get_friends2) (default: None)
+            factor_directory: directory for fitted factors (Factor_Store);
+                if given, grid points of each fold run in chains (in the
+                order of param_grid, in one process), and each fit starts
+                from the factors of the previous grid point of the chain
+                (for recommenders with warm_start, e.g.,
+                Matrix_Factorization), so that results are the same for
+                any n_jobs. Factors are kept, so that a resumed sweep gives
+                the same results. (default: None, no warm start)
+            warm_start_group: function params -> group; grid points of the
+                same group (e.g., n_features) form a chain (default: None,
+                one chain for all grid points)
+            curve_filename: file for validation curves; if given,
+                recommenders with validation_hook (e.g.,
+                Matrix_Factorization) find the RMSE of the validation fold
+                after every epoch, and their training histories are
+                appended to this file (json, one line per epoch, with
+                city, params, and fold) (default: None)
+        """
+        self.make_recommender = make_recommender
+        self.k = int(k)
+        self.n_jobs = int(n_jobs)
+        self.checkpoint_filename = checkpoint_filename
+        self.seed = seed
+        self.use_average = use_average
+        # Normalized by json, to compare with configs in the checkpoint.
+        self.config = json.loads(json.dumps(config))
+        self.ratings_filename = ratings_filename
+        self.network_filename = network_filename
+        self.prepare = prepare
+        if factor_directory is not None:
+            self.factor_store = Factor_Store(factor_directory)
+        else:
+            self.factor_store = None
+        self.warm_start_group = warm_start_group
+        self.curve_filename = curve_filename
+
+    def read_checkpoint(self):
+        """
+        Read finished results from the checkpoint file (only the ones with
+        the same k, seed, use_average, and config).
+        Output:
+            done: dict (key: (city, params, fold), value: (rmse, ratio))
+        """
+        done = {}
+        if self.checkpoint_filename is None or \
+                not os.path.exists(self.checkpoint_filename):
+            return done
+        with open(self.checkpoint_filename, 'r') as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except ValueError:  # Partially written last line.
+                    continue
+                if result['k'] != self.k or result['seed'] != self.seed or\
+                        result.get('use_average', False) !=\
+                        self.use_average or\
+                        result.get('config') != self.config:
+                    continue
+                done[(result['city'], tuple(result['params']),
+                      result['fold'])] = (result['rmse'], result['ratio'])
+        return done
+
+    def write_checkpoint(self, f, city, params, fold, rmse, ratio):
+        """
+        Append one finished result to the checkpoint file.
+        """
+        f.write(json.dumps({'city': city, 'params': list(params),
+                            'fold': fold, 'k': self.k, 'seed': self.seed,
+                            'use_average': self.use_average,
+                            'config': self.config,
+                            'rmse': rmse, 'ratio': ratio}) + '\n')
+        f.flush()
+
+    def write_curve(self, f, city, params, fold, history):
+        """
+        Append the training history of one task to the curve file.
+        """
+        for entry in history:
+            entry = dict(entry, city=city, params=list(params), fold=fold)
+            f.write(json.dumps(entry) + '\n')
+        f.flush()
+
+    def run(self, cities, param_grid):
+        """
+        Run the sweep.
+        Input:
+            cities: list of cities (str)
+            param_grid: list of parameters (tuples) for make_recommender
+        Output:
+            results: dict (key: (city, params),
+                value: (list of rmse, list of ratio) in the order of folds)
+        """
+        param_grid = [tuple(params) for params in param_grid]
+        done = self.read_checkpoint()
+        results = {}
+        try:
+            for city in cities:
+                tasks = self.make_tasks(city, param_grid, done)
+                if tasks:
+                    self.run_city(city, tasks, done)
+                else:
+                    print "All results for city", city, \
+                        "found in checkpoint."
+        finally:
+            # Pools of ALS solvers fitted in this process (n_jobs=1).
+            close_als_pools()
+        for city in cities:
+            for params in param_grid:
+                results[(city, params)] = (
+                    [done[(city, params, fold)][0] for fold in range(self.k)],
+                    [done[(city, params, fold)][1] for fold in range(self.k)])
+        return results
+
+    def make_tasks(self, city, param_grid, done):
+        """
+        Make tasks of the city for grid points not done.
+        Without factor_directory, a chain is one grid point; with it, a
+        chain has grid points of a group up to the last one not done.
+        Input:
+            city: city (str)
+            param_grid: list of parameters (tuples)
+            done: dict of finished results
+        Output:
+            tasks: list of (fold, chain), where chain is a list of
+                (params, is_done)
+        """
+        if self.factor_store is None:
+            chains = [[params] for params in param_grid]
+        else:
+            chains = []
+            group_chains = {}
+            for params in param_grid:
+                if self.warm_start_group is not None:
+                    group = self.warm_start_group(params)
+                else:
+                    group = None
+                if group not in group_chains:
+                    group_chains[group] = []
+                    chains.append(group_chains[group])
+                group_chains[group].append(params)
+        tasks = []
+        for chain in chains:
+            for fold in range(self.k):
+                is_done = [(city, params, fold) in done for params in chain]
+                if not all(is_done):
+                    last = max(i for i in range(len(chain))
+                               if not is_done[i])
+                    tasks.append((fold, zip(chain[:last + 1],
+                                            is_done[:last + 1])))
+        return tasks
+
+    def run_city(self, city, tasks, done):
+        """
+        Load the data for the city once, and run given tasks for it.
+        Input:
+            city: city (str)
+            tasks: list of (fold, chain) (see make_tasks)
+            done: dict of finished results (updated here)
+        Output:
+            None
+        """
+        validator = Validator(self.ratings_filename % city,
+                              self.network_filename % city, self.k, 0.,
+                              seed=self.seed)
+        if self.prepare is not None:
+            # Before worker processes are forked, so that they share it.
+            self.prepare(validator)
+        state = (validator, self.make_recommender, self.use_average,
+                 self.seed, self.factor_store, config_tag(self.config),
+                 self.curve_filename is not None)
+        if self.n_jobs > 1:
+            pool = fork_pool(state, min(self.n_jobs, len(tasks)))
+            task_results = pool.imap_unordered(run_sweep_task, tasks)
+        else:
+            pool = None
+            set_worker_state(state)
+            task_results = itertools.imap(run_sweep_task, tasks)
+        if self.checkpoint_filename is not None:
+            f = open_for_append(self.checkpoint_filename)
+        else:
+            f = None
+        if self.curve_filename is not None:
+            f_curve = open_for_append(self.curve_filename)
+        else:
+            f_curve = None
+        try:
+            for (params, fold, rmse, ratio, history) in \
+                    itertools.chain.from_iterable(task_results):
+                done[(city, params, fold)] = (rmse, ratio)
+                if f is not None:
+                    self.write_checkpoint(f, city, params, fold, rmse, ratio)
+                if f_curve is not None and history is not None:
+                    self.write_curve(f_curve, city, params, fold, history)
+        finally:
+            if f is not None:
+                f.close()
+            if f_curve is not None:
+                f_curve.close()
+            if pool is not None:
+                pool.close()
+                pool.join()
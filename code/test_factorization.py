@@ -0,0 +1,316 @@
+# Behaviour tests for Matrix_Factorization: the fast versions (engines,
+# solvers, and predictions) are compared with the original ones on small
+# random ratings, and stored factors and warm starts are checked.
+# usage: python -m unittest test_factorization  (in the code directory)
+
+# Filename: test_factorization.py
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from multiprocessing import Pool
+from scipy import sparse
+
+from factorization import Matrix_Factorization, Factor_Store, scatter_add
+from factorization import solve_ridge_block, als_pools, close_als_pools
+
+
+def random_ratings(n_users, n_items, density, rng):
+    """
+    Random ratings (1~5) of rank about 2, with noise, as a csr matrix.
+    """
+    user_mat = rng.normal(0, 1, size=(n_users, 2))
+    item_mat = rng.normal(0, 1, size=(2, n_items))
+    full = np.clip(np.round(3 + user_mat.dot(item_mat) +
+                            rng.normal(0, 0.3, size=(n_users, n_items))),
+                   1, 5)
+    (rows, cols) = np.nonzero(rng.rand(n_users, n_items) < density)
+    return sparse.csr_matrix((full[rows, cols], (rows, cols)),
+                             shape=(n_users, n_items))
+
+
+def fit_recommender(ratings, seed=1, **kwargs):
+    """
+    Fit Matrix_Factorization (2 features, 40 epochs) from the given seed.
+    """
+    options = dict(n_features=2, learn_rate=0.02,
+                   optimizer_pct_improvement_criterion=0, max_iterations=40)
+    options.update(kwargs)
+    recommender = Matrix_Factorization(**options)
+    np.random.seed(seed)
+    recommender.fit(ratings)
+    return recommender
+
+
+def reference_biases(ratings_coo, damping=0):
+    """
+    Average rating, and user and item biases with loops over users and items
+    (the original implementation, with bias_damping added).
+    Item biases are found from ratings, not from ratings minus user biases.
+    """
+    average = ratings_coo.data.mean()
+    biases = []
+    for (index, size) in [(ratings_coo.row, ratings_coo.shape[0]),
+                          (ratings_coo.col, ratings_coo.shape[1])]:
+        bias = np.zeros(size)
+        for i in xrange(size):
+            values = ratings_coo.data[np.where(index == i)[0]]
+            if values.size:
+                bias[i] = (values - average).sum() / (values.size + damping)
+        biases.append(bias)
+    return average, biases[0], biases[1]
+
+
+def history_rmse(recommender):
+    """
+    Training RMSE of each epoch of the last fit.
+    """
+    return np.array([entry['rmse'] for entry in recommender.history])
+
+
+class Test_SGD(unittest.TestCase):
+    def test_scatter_add(self):
+        rng = np.random.RandomState(0)
+        for _ in range(20):
+            mat = rng.rand(10, 3)
+            index = rng.randint(10, size=30)
+            values = rng.rand(30, 3)
+            expected = mat.copy()
+            np.add.at(expected, index, values)
+            scatter_add(mat, index, values)
+            np.testing.assert_allclose(mat, expected)
+
+    def test_vectorized_matches_loop(self):
+        ratings = random_ratings(60, 40, 0.3, np.random.RandomState(0))
+        loop = history_rmse(fit_recommender(ratings, engine='loop'))
+        for batch_size in [1, 20]:
+            vectorized = history_rmse(fit_recommender(
+                ratings, engine='vectorized', batch_size=batch_size))
+            self.assertEqual(len(vectorized), len(loop))
+            np.testing.assert_allclose(vectorized, loop, rtol=0.05)
+        # Both have learned the ratings (RMSE well below the std).
+        self.assertLess(loop[-1], 0.5 * ratings.data.std())
+
+
+class Test_ALS(unittest.TestCase):
+    def tearDown(self):
+        close_als_pools()
+
+    def test_ridge_block(self):
+        rng = np.random.RandomState(1)
+        (n_rows, n_other, n_features) = (6, 8, 3)
+        index = rng.randint(n_rows - 1, size=25)  # The last row is empty.
+        other_index = rng.randint(n_other, size=25)
+        values = rng.normal(size=25)
+        other_mat = rng.normal(size=(n_other, n_features))
+        for reg in [0.1, 0.]:
+            solution = solve_ridge_block((index, other_index, values,
+                                          other_mat, n_rows, reg))
+            for row in range(n_rows):
+                x = other_mat[other_index[index == row]]
+                y = values[index == row]
+                gram = x.T.dot(x) + reg * max(len(y), 1) * np.eye(n_features)
+                expected = np.linalg.lstsq(gram, x.T.dot(y), rcond=None)[0]
+                np.testing.assert_allclose(solution[row], expected,
+                                           atol=1e-10)
+        self.assertFalse(np.any(solution[n_rows - 1]))
+
+    def test_rmse_decreases(self):
+        ratings = random_ratings(60, 40, 0.3, np.random.RandomState(0))
+        als = history_rmse(fit_recommender(ratings, solver='als',
+                                           max_iterations=10))
+        self.assertTrue(np.all(np.diff(als) <= 1e-9))
+        # Far fewer epochs needed than SGD.
+        sgd = history_rmse(fit_recommender(ratings, engine='vectorized',
+                                           max_iterations=10))
+        self.assertLess(als[-1], 0.5 * sgd[-1])
+
+    def test_processes(self):
+        # Users and items without ratings (empty rows of blocks) included.
+        ratings = random_ratings(50, 30, 0.3, np.random.RandomState(2))
+        ratings = sparse.vstack([ratings, sparse.csr_matrix((3, 30))])
+        serial = fit_recommender(ratings, solver='als', n_jobs=1)
+        for n_jobs in [2, 3]:
+            parallel = fit_recommender(ratings, solver='als', n_jobs=n_jobs)
+            np.testing.assert_array_equal(parallel.user_mat,
+                                          serial.user_mat)
+            np.testing.assert_array_equal(parallel.item_mat,
+                                          serial.item_mat)
+        # The pool is kept for later fits.
+        self.assertEqual(sorted(als_pools), [2, 3])
+        self.assertTrue(np.all(np.isfinite(serial.pred_all())))
+        pool = Pool(2)
+        try:
+            given = fit_recommender(ratings, solver='als', pool=pool)
+        finally:
+            pool.close()
+            pool.join()
+        np.testing.assert_array_equal(given.user_mat, serial.user_mat)
+
+
+class Test_Bias(unittest.TestCase):
+    def test_biases(self):
+        ratings = random_ratings(40, 30, 0.2, np.random.RandomState(5))
+        ratings = sparse.vstack([ratings, sparse.csr_matrix((2, 30))])
+        coo = ratings.tocoo()
+        for damping in [0, 2.5]:
+            recommender = fit_recommender(ratings, max_iterations=1,
+                                          user_bias_correction=True,
+                                          item_bias_correction=True,
+                                          bias_damping=damping)
+            (average, user_bias, item_bias) = reference_biases(coo, damping)
+            self.assertAlmostEqual(recommender.average_rating, average)
+            np.testing.assert_allclose(recommender.average_bias_user,
+                                       user_bias, atol=1e-12)
+            np.testing.assert_allclose(recommender.average_bias_item,
+                                       item_bias, atol=1e-12)
+            np.testing.assert_allclose(
+                recommender.residuals,
+                coo.data - average - user_bias[coo.row] - item_bias[coo.col],
+                atol=1e-12)
+
+
+class Test_Prediction(unittest.TestCase):
+    def test_lazy_prediction(self):
+        ratings = random_ratings(40, 30, 0.3, np.random.RandomState(3))
+        rows = np.repeat(np.arange(40), 30)
+        cols = np.tile(np.arange(30), 40)
+        for (user_bias, item_bias) in [(False, False), (True, True)]:
+            options = dict(engine='vectorized', max_iterations=5,
+                           user_bias_correction=user_bias,
+                           item_bias_correction=item_bias)
+            dense = fit_recommender(ratings, **options)
+            lazy = fit_recommender(ratings, lazy_prediction=True, **options)
+            self.assertEqual(dense.prediction.shape, (40, 30))
+            self.assertIsNone(lazy.prediction)
+            expected = dense.prediction
+            np.testing.assert_allclose(lazy.pred_all(), expected)
+            np.testing.assert_allclose(
+                lazy.predict_batch(rows, cols).reshape(40, 30), expected)
+            for user_id in [0, 17, 39]:
+                np.testing.assert_allclose(lazy.pred_one_user(user_id),
+                                           expected[user_id])
+                self.assertAlmostEqual(lazy.pred_one_rating(user_id, 5),
+                                       expected[user_id, 5])
+                np.testing.assert_array_equal(lazy.top_n_recs(user_id, 5),
+                                              dense.top_n_recs(user_id, 5))
+            self.assertIsNone(lazy.prediction)
+
+    def test_pred_average_pairs(self):
+        ratings = random_ratings(40, 30, 0.3, np.random.RandomState(4))
+        recommender = fit_recommender(ratings, max_iterations=2,
+                                      user_bias_correction=True,
+                                      item_bias_correction=True)
+        (rows, cols) = ratings.nonzero()
+        for user_bias in [False, True]:
+            for item_bias in [False, True]:
+                np.testing.assert_allclose(
+                    recommender.pred_average_pairs(rows, cols, user_bias,
+                                                   item_bias),
+                    recommender.pred_average(user_bias,
+                                             item_bias)[rows, cols])
+
+
+class Test_Factor_Store(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_save_load(self):
+        factors = {'user_mat': np.arange(6.).reshape(3, 2),
+                   'average_rating': 3.5, 'average_bias_user': None}
+        for store in [Factor_Store(), Factor_Store(self.directory)]:
+            self.assertIsNone(store.load(('a', 2)))
+            store.save(('a', 2), factors)
+            loaded = store.load(('a', 2))
+            self.assertEqual(sorted(loaded), ['average_rating', 'user_mat'])
+            np.testing.assert_array_equal(loaded['user_mat'],
+                                          factors['user_mat'])
+            self.assertEqual(loaded['average_rating'], 3.5)
+            self.assertIsNone(store.load(('a', 3)))
+        self.assertEqual(os.listdir(self.directory), ['factors_a_2.npz'])
+
+    def test_warm_start(self):
+        rng = np.random.RandomState(6)
+        ratings = random_ratings(40, 30, 0.3, rng)
+        other_ratings = random_ratings(40, 30, 0.3, rng)
+        store = Factor_Store(self.directory)
+        options = dict(engine='vectorized', max_iterations=10,
+                       item_bias_correction=True, factor_store=store)
+        cold = fit_recommender(ratings, factor_key=('a',), **options)
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+        # Same training set: starts from the stored factors.
+        warm = fit_recommender(ratings, seed=2, factor_key=('b',),
+                               warm_start=True, warm_start_key=('a',),
+                               **options)
+        self.assertLess(history_rmse(warm)[0], 0.8 * history_rmse(cold)[0])
+        self.assertLess(history_rmse(warm)[0], history_rmse(cold)[-1])
+        # Other training sets (e.g., other folds) do not share factors.
+        other_cold = fit_recommender(other_ratings, seed=2,
+                                     factor_key=('c',), **options)
+        other = fit_recommender(other_ratings, seed=2, factor_key=('d',),
+                                warm_start=True, warm_start_key=('a',),
+                                **options)
+        np.testing.assert_array_equal(history_rmse(other),
+                                      history_rmse(other_cold))
+        self.assertEqual(len(os.listdir(self.directory)), 4)
+        # Saved factors are loaded instead of fitting.
+        loaded = fit_recommender(ratings, seed=3, factor_key=('b',),
+                                 saved_matrices=True, **options)
+        self.assertEqual(loaded.history, [])
+        np.testing.assert_array_equal(loaded.pred_all(), warm.pred_all())
+
+
+class Test_History(unittest.TestCase):
+    def test_history(self):
+        rng = np.random.RandomState(7)
+        ratings = random_ratings(40, 30, 0.3, rng)
+        held_out = random_ratings(40, 30, 0.1, rng).tocoo()
+
+        def hook(recommender):
+            errors = held_out.data - recommender.predict_pairs(held_out.row,
+                                                               held_out.col)
+            return np.sqrt(np.mean(errors ** 2))
+
+        (handle, filename) = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            recommender = fit_recommender(
+                ratings, engine='vectorized', max_iterations=None,
+                optimizer_pct_improvement_criterion=5,
+                validation_hook=hook, history_filename=filename)
+            history = recommender.history
+            self.assertEqual([entry['epoch'] for entry in history],
+                             range(1, len(history) + 1))
+            # Stopped at the first epoch below the criterion.
+            self.assertIsNone(history[0]['pct_improvement'])
+            self.assertEqual([entry['converged'] for entry in history],
+                             [False] * (len(history) - 1) + [True])
+            self.assertLessEqual(history[-1]['pct_improvement'], 5)
+            for entry in history:
+                self.assertAlmostEqual(entry['rmse'],
+                                       np.sqrt(entry['sse'] / ratings.nnz))
+                self.assertEqual(entry['fit'], 1)
+            # The hook is called after every epoch (the last one with the
+            # fitted factors).
+            self.assertEqual(history[-1]['val_rmse'], hook(recommender))
+            self.assertLess(history[-1]['val_rmse'], history[0]['val_rmse'])
+            recommender.max_iterations = 2
+            np.random.seed(1)
+            recommender.fit(ratings)
+            self.assertEqual([entry['fit'] for entry in
+                              recommender.history], [2, 2])
+            with open(filename, 'r') as f:
+                lines = [json.loads(line) for line in f]
+            self.assertEqual(lines, history + recommender.history)
+        finally:
+            os.remove(filename)
+
+
+if __name__ == '__main__':
+    unittest.main()
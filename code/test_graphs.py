@@ -0,0 +1,237 @@
+# Equivalence tests for the graph utilities: vectorized versions are
+# compared with simple reference implementations on random graphs.
+# usage: python -m unittest test_graphs  (in the code directory)
+
+# Filename: test_graphs.py
+
+import os
+import shutil
+import random
+import tempfile
+import unittest
+import numpy as np
+from scipy import sparse
+
+from csr_graph import CSR_Graph
+from my_utilities import reindex_graph, adjacency_matrix
+from my_utilities import adjacency_matrix_from_file, write_graph_to_file
+from using_friends import Using_Friends
+
+
+def reference_reindex_graph(graph_dict, users_id_map=None):
+    """
+    reindex_graph with loops over dicts (the original implementation).
+    """
+    new_graph_dict = {}
+    if users_id_map is not None:
+        not_counted = set([])
+        for u_id in graph_dict:
+            if u_id in users_id_map:
+                new_graph_dict[users_id_map[u_id]] = []
+                for u_id2 in graph_dict[u_id]:
+                    if u_id2 in users_id_map:
+                        new_graph_dict[users_id_map[u_id]].\
+                            append(users_id_map[u_id2])
+                    else:
+                        not_counted.add(u_id2)
+            else:
+                not_counted.add(u_id)
+        return new_graph_dict, users_id_map, len(not_counted)
+    users_id_map = {}
+    new_id = 0
+    for u_id in graph_dict:
+        if u_id not in users_id_map:
+            users_id_map[u_id] = new_id
+            new_id += 1
+        new_graph_dict[users_id_map[u_id]] = []
+        for u_id2 in graph_dict[u_id]:
+            if u_id2 not in users_id_map:
+                users_id_map[u_id2] = new_id
+                new_id += 1
+            new_graph_dict[users_id_map[u_id]].append(users_id_map[u_id2])
+    return new_graph_dict, users_id_map, 0
+
+
+def random_network(n_users, n_edges, rng):
+    """
+    Random undirected network (dict of lists, every user has an entry,
+    no duplicates or self loops).
+    """
+    graph_dict = dict((user_id, []) for user_id in range(n_users))
+    for _ in range(n_edges):
+        (id1, id2) = rng.randint(n_users, size=2)
+        if id1 != id2 and id2 not in graph_dict[id1]:
+            graph_dict[id1].append(int(id2))
+            graph_dict[id2].append(int(id1))
+    return graph_dict
+
+
+def brute_force_two_hop(graph_dict, user_id):
+    """
+    Friends of friends of a user, excluding the user and friends.
+    """
+    friends2 = set()
+    for friend_id in graph_dict[user_id]:
+        friends2.update(graph_dict[friend_id])
+    friends2.difference_update(graph_dict[user_id])
+    friends2.discard(user_id)
+    return sorted(friends2)
+
+
+class Test_Reindex(unittest.TestCase):
+    def test_reindex_graph(self):
+        random.seed(1)
+        for _ in range(200):
+            graph_dict = {}
+            for user_id in random.sample(range(100), random.randint(0, 30)):
+                graph_dict[user_id] = [random.randrange(120) for _ in
+                                       range(random.randint(0, 6))]
+            self.assertEqual(reindex_graph(graph_dict),
+                             reference_reindex_graph(graph_dict))
+            users_id_map = dict((user_id, i) for i, user_id in enumerate(
+                random.sample(range(120), random.randint(0, 60))))
+            self.assertEqual(reindex_graph(graph_dict, users_id_map),
+                             reference_reindex_graph(graph_dict,
+                                                     users_id_map))
+
+    def test_csr_reindex(self):
+        rng = np.random.RandomState(2)
+        for _ in range(50):
+            graph_dict = random_network(40, 60, rng)
+            kept = rng.permutation(40)[:rng.randint(0, 40)]
+            users_id_map = dict((int(user_id), i)
+                                for i, user_id in enumerate(kept))
+            (expected, _, expected_not_counted) = reference_reindex_graph(
+                graph_dict, users_id_map)
+            (graph, not_counted) = CSR_Graph.from_dictlist(graph_dict)\
+                .reindex(users_id_map)
+            self.assertEqual(graph.to_dictlist(),
+                             dict((user_id, sorted(friends)) for
+                                  user_id, friends in expected.iteritems()))
+            self.assertEqual(not_counted, expected_not_counted)
+
+
+class Test_CSR_Graph(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_save_load(self):
+        rng = np.random.RandomState(3)
+        filename = os.path.join(self.directory, 'network.csrg')
+        for graph_dict in [{}, {5: []}, random_network(50, 80, rng)]:
+            graph = CSR_Graph.from_dictlist(graph_dict)
+            graph.save(filename)
+            for mmap_mode in ['r', None]:
+                loaded = CSR_Graph.load(filename, mmap_mode)
+                self.assertEqual(loaded.n_nodes, graph.n_nodes)
+                for name in ['indptr', 'indices', 'nodes']:
+                    np.testing.assert_array_equal(getattr(loaded, name),
+                                                  getattr(graph, name))
+                self.assertEqual(loaded.to_dictlist(),
+                                 dict((user_id, sorted(friends)) for
+                                      user_id, friends in
+                                      graph_dict.iteritems()))
+
+    def test_not_a_graph_file(self):
+        filename = os.path.join(self.directory, 'network.csrg')
+        with open(filename, 'wb') as f:
+            f.write('1,2,3\n' * 20)
+        self.assertRaises(ValueError, CSR_Graph.load, filename)
+
+    def test_two_hop(self):
+        rng = np.random.RandomState(4)
+        for _ in range(100):
+            n_users = rng.randint(1, 40)
+            graph_dict = random_network(n_users, rng.randint(0, 80), rng)
+            friends2 = CSR_Graph.from_dictlist(graph_dict, n_users).two_hop()
+            for user_id in range(n_users):
+                self.assertEqual(friends2.neighbors(user_id).tolist(),
+                                 brute_force_two_hop(graph_dict, user_id))
+
+
+class Test_Adjacency_Matrix(unittest.TestCase):
+    def test_normalizations(self):
+        rng = np.random.RandomState(5)
+        graph_dict = random_network(30, 40, rng)
+        dense = np.zeros((30, 30))
+        for user_id, friends in graph_dict.iteritems():
+            dense[user_id, friends] = 1
+        degrees = dense.sum(axis=1)
+        inverse = np.zeros(30)
+        inverse[degrees > 0] = 1. / degrees[degrees > 0]
+        expected = {None: dense,
+                    'row': np.diag(inverse).dot(dense),
+                    'symmetric': np.diag(np.sqrt(inverse)).dot(dense)
+                    .dot(np.diag(np.sqrt(inverse))),
+                    'degree': dense.dot(np.diag(inverse))}
+        for graph in [graph_dict, CSR_Graph.from_dictlist(graph_dict)]:
+            for normalization, matrix in expected.iteritems():
+                adjacency = adjacency_matrix(graph, normalization)
+                self.assertTrue(sparse.isspmatrix_csr(adjacency))
+                np.testing.assert_allclose(adjacency.toarray(), matrix)
+        self.assertRaises(ValueError, adjacency_matrix, graph_dict, 'other')
+
+    def test_cache(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'network.csrg')
+            write_graph_to_file(filename, {0: [1], 1: [0]})
+            adjacency = adjacency_matrix_from_file(filename, 'row')
+            self.assertIs(adjacency_matrix_from_file(filename, 'row'),
+                          adjacency)
+            # Rewritten with a different size: found again.
+            write_graph_to_file(filename, {0: [1, 2], 1: [0], 2: [0]})
+            self.assertEqual(adjacency_matrix_from_file(filename,
+                                                        'row').shape,
+                             (3, 3))
+        finally:
+            shutil.rmtree(directory)
+
+
+class Test_Using_Friends(unittest.TestCase):
+    def test_friends2(self):
+        rng = np.random.RandomState(6)
+        (n_users, n_items) = (30, 12)
+        graph_dict = random_network(n_users, 45, rng)
+        ratings = sparse.random(n_users, n_items, density=0.3,
+                                random_state=rng, format='coo')
+        ratings.data = rng.randint(1, 6, size=ratings.nnz).astype(float)
+        dense = ratings.toarray()
+        weight = 0.5
+        # Weighted mean of ratings by friends and friends of friends.
+        expected = np.zeros((n_users, n_items))
+        for user_id in range(n_users):
+            friends = set(graph_dict[user_id])
+            friends2 = set(brute_force_two_hop(graph_dict, user_id))
+            for item_id in range(n_items):
+                if dense[user_id, item_id]:
+                    expected[user_id, item_id] = dense[user_id, item_id]
+                    continue
+                raters = np.flatnonzero(dense[:, item_id])
+                ratings1 = [dense[r, item_id] for r in raters if r in friends]
+                ratings2 = [dense[r, item_id] for r in raters
+                            if r in friends2]
+                if len(ratings1) + len(ratings2) >= 2:
+                    expected[user_id, item_id] =\
+                        (sum(ratings1) + weight * sum(ratings2)) /\
+                        (len(ratings1) + weight * len(ratings2))
+        friends2 = CSR_Graph.from_dictlist(graph_dict, n_users).two_hop()
+        for network in [graph_dict, CSR_Graph.from_dictlist(graph_dict)]:
+            for engine in ['loop', 'sparse']:
+                for given in [None, friends2]:
+                    recommender = Using_Friends(
+                        network, 2, 100, engine=engine,
+                        friends2_weight=weight, friends2=given).fit(ratings)
+                    one = np.array([[recommender.pred_one_rating(u, i)
+                                     for i in range(n_items)]
+                                    for u in range(n_users)])
+                    np.testing.assert_allclose(one, expected)
+                    np.testing.assert_allclose(recommender.pred_all(),
+                                               expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
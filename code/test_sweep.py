@@ -0,0 +1,201 @@
+# Behaviour tests for parameter sweeps (Sweep_Scheduler) and searches
+# (successive_halving): results in parallel, or after a resumed sweep, are
+# compared with results of one serial run on small random ratings.
+# usage: python -m unittest test_sweep  (in the code directory)
+
+# Filename: test_sweep.py
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from sweep import Sweep_Scheduler
+from search import successive_halving
+from validator import Validator
+from factorization import Matrix_Factorization, Factor_Store
+from test_validator import write_random_ratings
+
+cities = ['1', '2']
+param_grid = [(2, 0.01, 0.02), (2, 0.02, 0.02), (3, 0.01, 0.02),
+              (3, 0.02, 0.1)]
+
+
+def make_factorization(validator, params):
+    """
+    Matrix_Factorization for a grid point (n_features, learn_rate,
+    regularization_param).
+    """
+    (n_features, learn_rate, regularization_param) = params
+    return Matrix_Factorization(n_features=n_features, learn_rate=learn_rate,
+                                regularization_param=regularization_param,
+                                optimizer_pct_improvement_criterion=2,
+                                engine='vectorized', batch_size=50,
+                                max_iterations=20)
+
+
+class Sweep_Test_Case(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for i, city in enumerate(cities):
+            os.makedirs(os.path.join(self.directory, city))
+            write_random_ratings(os.path.join(self.directory, city),
+                                 seed=i)
+        self.checkpoint_filename = os.path.join(self.directory,
+                                                'checkpoint')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_sweep(self, n_jobs=1, checkpoint_filename=None, **kwargs):
+        """
+        Run the sweep over cities and param_grid with 3 folds.
+        """
+        options = dict(
+            config={'model': 'Matrix_Factorization'},
+            ratings_filename=os.path.join(self.directory, '%s', 'reviews'),
+            network_filename=os.path.join(self.directory, '%s',
+                                          'network.csv'))
+        options.update(kwargs)
+        scheduler = Sweep_Scheduler(make_factorization, 3, n_jobs,
+                                    checkpoint_filename, **options)
+        return scheduler.run(cities, param_grid)
+
+    def truncate_checkpoint(self, n_lines):
+        """
+        Keep the first n_lines of the checkpoint, and a partially written
+        line (as if the sweep was interrupted).
+        """
+        with open(self.checkpoint_filename, 'r') as f:
+            lines = f.readlines()
+        with open(self.checkpoint_filename, 'w') as f:
+            f.writelines(lines[:n_lines])
+            f.write(lines[n_lines][:20])
+        return len(lines)
+
+
+class Test_Sweep(Sweep_Test_Case):
+    def test_parallel_matches_serial(self):
+        serial = self.run_sweep()
+        self.assertEqual(sorted(serial), sorted(
+            (city, params) for city in cities for params in param_grid))
+        for n_jobs in [2, 3]:
+            self.assertEqual(self.run_sweep(n_jobs), serial)
+
+    def test_resume(self):
+        results = self.run_sweep(2, self.checkpoint_filename)
+        n_lines = self.truncate_checkpoint(10)
+        self.assertEqual(n_lines, len(cities) * len(param_grid) * 3)
+        self.assertEqual(self.run_sweep(2, self.checkpoint_filename),
+                         results)
+        with open(self.checkpoint_filename, 'r') as f:
+            self.assertEqual(len([line for line in f
+                                  if line.endswith('}\n')]), n_lines)
+        # Everything is found in the checkpoint now.
+        self.assertEqual(self.run_sweep(
+            1, self.checkpoint_filename,
+            ratings_filename='missing%s', network_filename='missing%s'),
+            results)
+
+    def test_curves(self):
+        curves = []
+        for n_jobs in [1, 2]:
+            curve_filename = os.path.join(self.directory,
+                                          'curves%d' % n_jobs)
+            self.run_sweep(n_jobs, curve_filename=curve_filename)
+            with open(curve_filename, 'r') as f:
+                entries = [json.loads(line) for line in f]
+            for entry in entries:
+                # Timings differ between runs.
+                del entry['time'], entry['ratings_per_sec']
+            curves.append(sorted(entries, key=lambda entry: (
+                entry['city'], entry['params'], entry['fold'],
+                entry['epoch'])))
+        self.assertEqual(curves[0], curves[1])
+        self.assertEqual(set((entry['city'], tuple(entry['params']),
+                              entry['fold']) for entry in curves[0]),
+                         set((city, params, fold) for city in cities
+                             for params in param_grid for fold in range(3)))
+        self.assertTrue(all(entry['val_rmse'] > 0 for entry in curves[0]))
+
+
+class Test_Warm_Start(Sweep_Test_Case):
+    def test_warm_sweep(self):
+        factor_directory = os.path.join(self.directory, 'factors')
+        options = dict(factor_directory=factor_directory,
+                       warm_start_group=lambda params: params[0])
+        results = self.run_sweep(1, self.checkpoint_filename, **options)
+        # One file per city, grid point, and fold.
+        self.assertEqual(len(os.listdir(factor_directory)),
+                         len(cities) * len(param_grid) * 3)
+        self.assertNotEqual(results, self.run_sweep())
+        for n_jobs in [2, 3]:
+            self.assertEqual(self.run_sweep(n_jobs, **options), results)
+        # Resumed with stored factors, and without them (fitted again).
+        self.truncate_checkpoint(10)
+        self.assertEqual(self.run_sweep(2, self.checkpoint_filename,
+                                        **options), results)
+        self.truncate_checkpoint(10)
+        shutil.rmtree(factor_directory)
+        self.assertEqual(self.run_sweep(2, self.checkpoint_filename,
+                                        **options), results)
+
+    def test_warm_search(self):
+        validator = Validator(os.path.join(self.directory, '1', 'reviews'),
+                              os.path.join(self.directory, '1',
+                                           'network.csv'), 6, seed=0)
+        results = []
+        for n_jobs in [1, 2]:
+            factor_directory = os.path.join(self.directory,
+                                            'factors%d' % n_jobs)
+            results.append(successive_halving(
+                validator, make_factorization, param_grid, n_jobs=n_jobs,
+                factor_store=Factor_Store(factor_directory),
+                factor_tag='test'))
+            self.assertTrue(os.listdir(factor_directory))
+        self.assertEqual(results[0], results[1])
+        self.assertNotEqual(results[0][1], successive_halving(
+            validator, make_factorization, param_grid)[1])
+
+
+class Test_Successive_Halving(Sweep_Test_Case):
+    def test_search(self):
+        validator = Validator(os.path.join(self.directory, '1', 'reviews'),
+                              os.path.join(self.directory, '1',
+                                           'network.csv'), 6, seed=0)
+        # The last one does not learn (random factors are kept).
+        candidates = [(2, 0.01, 0.02), (2, 0.05, 0.02), (3, 0.02, 0.1),
+                      (2, 0.02, 0.02), (2, 0., 0.02)]
+        (best_params, history) = successive_halving(
+            validator, make_factorization, candidates)
+        # 5 candidates on 1 fold (3 epochs), 2 on 3 folds (9 epochs), and
+        # the best one on all folds.
+        self.assertEqual([(rung, params, n_folds, max_iterations)
+                          for (rung, params, n_folds, max_iterations, _) in
+                          history],
+                         [(0, params, 1, 3) for params in candidates] +
+                         [(1, params, 3, 9) for (_, params, _, _, _) in
+                          history[5:7]] +
+                         [(2, best_params, 6, None)])
+        self.assertNotIn(candidates[-1], [params for (_, params, _, _, _)
+                                          in history[5:]])
+        ranked = sorted(history[:5], key=lambda entry: entry[4][0])
+        self.assertEqual(set(params for (_, params, _, _, _) in
+                             history[5:7]),
+                         set(params for (_, params, _, _, _) in ranked[:2]))
+        # Rungs are validations with limited epochs.
+        for (rung, params, n_folds, max_iterations, list_rmse) in \
+                [history[0], history[5], history[-1]]:
+            recommender = make_factorization(validator, params)
+            recommender.max_iterations = max_iterations
+            self.assertEqual(validator.validate(recommender, seed=0,
+                                                folds=range(n_folds))[0],
+                             list_rmse)
+        self.assertEqual(successive_halving(validator, make_factorization,
+                                            candidates, n_jobs=2),
+                         (best_params, history))
+
+
+if __name__ == '__main__':
+    unittest.main()
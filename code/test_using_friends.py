@@ -0,0 +1,85 @@
+# Behaviour tests for Using_Friends: the sparse engine is compared with the
+# loop engine on random networks and ratings.
+# usage: python -m unittest test_using_friends  (in the code directory)
+
+# Filename: test_using_friends.py
+
+import unittest
+import numpy as np
+from scipy import sparse
+
+from csr_graph import CSR_Graph
+from using_friends import Using_Friends
+from test_graphs import random_network
+
+
+def random_friend_ratings(n_users, n_items, rng):
+    """
+    Random network (dict of lists) and ratings (1~5, csr matrix).
+    """
+    graph_dict = random_network(n_users, 3 * n_users, rng)
+    ratings = sparse.random(n_users, n_items, density=0.3, random_state=rng,
+                            format='csr')
+    ratings.data = rng.randint(1, 6, size=ratings.nnz).astype(float)
+    return graph_dict, ratings
+
+
+def all_ratings(recommender, n_users, n_items):
+    """
+    Predictions of pred_one_rating for all user-item pairs.
+    """
+    return np.array([[recommender.pred_one_rating(user_id, item_id)
+                      for item_id in range(n_items)]
+                     for user_id in range(n_users)])
+
+
+class Test_Engines(unittest.TestCase):
+    def test_sparse_matches_loop(self):
+        rng = np.random.RandomState(7)
+        (n_users, n_items) = (40, 15)
+        (graph_dict, ratings) = random_friend_ratings(n_users, n_items, rng)
+        for (lower, upper) in [(1, 100), (2, 100), (3, 4), (2, 0)]:
+            for if_average in [False, True]:
+                expected = all_ratings(
+                    Using_Friends(graph_dict, lower, upper, if_average)
+                    .fit(ratings), n_users, n_items)
+                for network in [graph_dict,
+                                CSR_Graph.from_dictlist(graph_dict)]:
+                    recommender = Using_Friends(network, lower, upper,
+                                                if_average, engine='sparse')
+                    np.testing.assert_allclose(
+                        all_ratings(recommender.fit(ratings), n_users,
+                                    n_items), expected)
+
+
+class Test_Batch(unittest.TestCase):
+    def test_batch_matches_one_rating(self):
+        rng = np.random.RandomState(8)
+        (n_users, n_items) = (40, 15)
+        (graph_dict, ratings) = random_friend_ratings(n_users, n_items, rng)
+        rows = np.repeat(np.arange(n_users), n_items)
+        cols = np.tile(np.arange(n_items), n_users)
+        # Upper limit above the numbers of friends (no random picking, which
+        # batch predictions do not do).
+        for lower in [1, 3]:
+            for if_average in [False, True]:
+                for engine in ['loop', 'sparse']:
+                    recommender = Using_Friends(graph_dict, lower, 100,
+                                                if_average, engine=engine)
+                    recommender.fit(ratings)
+                    expected = all_ratings(recommender, n_users, n_items)
+                    np.testing.assert_allclose(recommender.pred_all(),
+                                               expected)
+                    np.testing.assert_allclose(
+                        recommender.predict_batch(rows, cols)
+                        .reshape(n_users, n_items), expected)
+                    for user_id in [0, 13, 39]:
+                        np.testing.assert_allclose(
+                            recommender.pred_one_user(user_id),
+                            expected[user_id])
+                    self.assertEqual(len(recommender.predict_batch([], [])),
+                                     0)
+
+
+if __name__ == '__main__':
+    unittest.main()
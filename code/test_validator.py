@@ -0,0 +1,236 @@
+# Behaviour tests for Validator: ratings loaded from csv or columnar files,
+# fold views, batched RMSE's, and parallel folds are compared with simple
+# reference implementations on small random ratings.
+# usage: python -m unittest test_validator  (in the code directory)
+
+# Filename: test_validator.py
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from validator import Validator
+from factorization import Matrix_Factorization, close_als_pools
+from using_friends import Using_Friends
+from my_utilities import write_columns, write_dictlist_to_file
+from test_graphs import random_network
+
+
+def write_random_ratings(directory, n_users=40, n_items=25, n_ratings=400,
+                         seed=0):
+    """
+    Write random ratings (with repeated user-item pairs, and user and item
+    ID's that are not consecutive) in csv and columnar formats, and a random
+    network, into the directory.
+    Output:
+        (ratings csv filename, ratings columns directory, network filename,
+         columns as a dict)
+    """
+    rng = np.random.RandomState(seed)
+    columns = {'user_id': 1000 + 7 * rng.randint(n_users, size=n_ratings),
+               'item_id': 3 * rng.randint(n_items, size=n_ratings),
+               'rating': rng.randint(1, 6, size=n_ratings)}
+    csv_filename = os.path.join(directory, 'reviews.csv')
+    with open(csv_filename, 'w') as f:
+        for row in zip(columns['user_id'], columns['item_id'],
+                       columns['rating']):
+            f.write('%d,%d,%d\n' % row)
+    columns_dir = os.path.join(directory, 'reviews')
+    write_columns(columns_dir, columns)
+    network = random_network(n_users, 3 * n_users, rng)
+    network_filename = os.path.join(directory, 'network.csv')
+    write_dictlist_to_file(network_filename,
+                           dict((1000 + 7 * user_id,
+                                 [1000 + 7 * friend for friend in friends])
+                                for user_id, friends in network.iteritems()))
+    return csv_filename, columns_dir, network_filename, columns
+
+
+def reference_ratings(columns):
+    """
+    Ratings averaged over repeated user-item pairs, with dicts.
+    Output:
+        ratings: dict (key: (user_id, item_id), value: mean rating)
+    """
+    values = {}
+    for (user_id, item_id, rating) in zip(columns['user_id'],
+                                          columns['item_id'],
+                                          columns['rating']):
+        values.setdefault((user_id, item_id), []).append(rating)
+    return dict((pair, np.mean(ratings)) for pair, ratings in
+                values.iteritems())
+
+
+def first_appearance(ids):
+    """
+    Unique ID's in the order of first appearance.
+    """
+    unique_ids = []
+    for id_ in ids:
+        if id_ not in unique_ids:
+            unique_ids.append(id_)
+    return unique_ids
+
+
+class One_Rating():
+    """
+    Recommender without batch predictions (find_rmse loops over ratings).
+    """
+    def __init__(self, recommender):
+        self.recommender = recommender
+
+    def pred_one_rating(self, user_id, item_id):
+        return self.recommender.pred_one_rating(user_id, item_id)
+
+
+class Validator_Test_Case(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        (self.csv_filename, self.columns_dir, self.network_filename,
+         self.columns) = write_random_ratings(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+class Test_Find_RMSE(Validator_Test_Case):
+    def test_batch_matches_loop(self):
+        validator = Validator(self.csv_filename, self.network_filename, 4,
+                              seed=1)
+        ratings_val = validator.get_ratings_val(0)
+        np.random.seed(0)
+        factorization = Matrix_Factorization(n_features=2, engine='vectorized',
+                                             max_iterations=5)
+        factorization.fit(validator.get_ratings_rest(0))
+        # Network predictions are missing for some ratings.
+        friends = Using_Friends(validator.get_network(), 2, 100)
+        friends.fit(validator.get_ratings_rest(0))
+        for recommender in [factorization, friends]:
+            (rmse, ratio) = validator.find_rmse(recommender, ratings_val)
+            (loop_rmse, loop_ratio) = validator.find_rmse(
+                One_Rating(recommender), ratings_val)
+            self.assertAlmostEqual(rmse, loop_rmse)
+            self.assertAlmostEqual(ratio, loop_ratio)
+            (prediction_rmse, prediction_ratio) =\
+                validator.find_rmse_prediction(recommender.pred_all(),
+                                               ratings_val)
+            self.assertAlmostEqual(prediction_rmse, loop_rmse)
+            self.assertAlmostEqual(prediction_ratio, loop_ratio)
+        self.assertLess(validator.find_rmse(friends, ratings_val)[1], 1)
+        self.assertEqual(validator.find_rmse_values(np.zeros(3),
+                                                    np.ones(3)),
+                         (None, None))
+
+
+class Test_Loading(Validator_Test_Case):
+    def test_csv_and_columns(self):
+        expected = reference_ratings(self.columns)
+        validators = [Validator(filename, self.network_filename, 4, 0.2,
+                                seed=2)
+                      for filename in [self.csv_filename, self.columns_dir]]
+        for validator in validators:
+            # ID's are mapped in the order of first appearance.
+            user_ids = first_appearance(self.columns['user_id'])
+            item_ids = first_appearance(self.columns['item_id'])
+            self.assertEqual(validator.users_id_map,
+                             dict((user_id, i) for i, user_id in
+                                  enumerate(user_ids)))
+            self.assertEqual(validator.items_id_map,
+                             dict((item_id, i) for i, item_id in
+                                  enumerate(item_ids)))
+            self.assertEqual(validator.shape,
+                             (len(user_ids), len(item_ids)))
+            self.assertEqual(validator.n_reviews,
+                             len(self.columns['rating']))
+            # Repeated pairs are averaged.
+            ratings = dict(((user_ids[user], item_ids[item]), rating)
+                           for user, item, rating in
+                           zip(validator.rows, validator.cols,
+                               validator.ratings))
+            self.assertEqual(len(ratings), len(validator.ratings))
+            self.assertEqual(sorted(ratings), sorted(expected))
+            for pair, rating in expected.iteritems():
+                self.assertAlmostEqual(ratings[pair], rating)
+        for name in ['rows', 'cols', 'ratings', 'fold_number']:
+            np.testing.assert_array_equal(getattr(validators[0], name),
+                                          getattr(validators[1], name))
+        self.assertEqual(validators[0].get_network(),
+                         validators[1].get_network())
+
+
+class Test_Folds(Validator_Test_Case):
+    def test_fold_views(self):
+        validator = Validator(self.columns_dir, self.network_filename, 5, 0.2,
+                              seed=3)
+        # Dense matrices of the ratings in each fold (-1: test set).
+        dense = {}
+        for fold in range(-1, 5):
+            dense[fold] = np.zeros(validator.shape)
+            for (row, col, rating, fold_number) in zip(
+                    validator.rows, validator.cols, validator.ratings,
+                    validator.fold_number):
+                if fold_number == fold:
+                    dense[fold][row, col] = rating
+            self.assertTrue(np.any(dense[fold]))
+        train = sum(dense[fold] for fold in range(5))
+        np.testing.assert_array_equal(validator.get_matrix_train().toarray(),
+                                      train)
+        np.testing.assert_array_equal(validator.ratings_test.toarray(),
+                                      dense[-1])
+        for fold in range(5):
+            ratings_val = validator.get_ratings_val(fold)
+            np.testing.assert_array_equal(ratings_val.toarray(), dense[fold])
+            np.testing.assert_array_equal(
+                validator.get_ratings_rest(fold).toarray(),
+                train - dense[fold])
+            # Validation sets are views of the stored arrays.
+            self.assertTrue(np.may_share_memory(ratings_val.data,
+                                                validator.ratings))
+
+
+class Test_Parallel(Validator_Test_Case):
+    def tearDown(self):
+        close_als_pools()
+        Validator_Test_Case.tearDown(self)
+
+    def test_parallel_matches_serial(self):
+        validator = Validator(self.columns_dir, self.network_filename, 4,
+                              seed=4)
+        for options in [dict(engine='vectorized'),
+                        dict(solver='als', n_jobs=2)]:
+            for use_average in [False, True]:
+                recommender = Matrix_Factorization(
+                    n_features=2, max_iterations=5,
+                    user_bias_correction=True, item_bias_correction=True,
+                    **options)
+                serial = validator.validate(recommender, use_average,
+                                            seed=5)
+                for n_jobs in [2, 3]:
+                    self.assertEqual(validator.validate(recommender,
+                                                        use_average,
+                                                        n_jobs=n_jobs,
+                                                        seed=5),
+                                     serial)
+                (list_rmse, list_ratio) = validator.validate(
+                    recommender, use_average, n_jobs=2, seed=5,
+                    folds=[1, 3])
+                self.assertEqual(list_rmse, [serial[0][1], serial[0][3]])
+                self.assertEqual(list_ratio, [serial[1][1], serial[1][3]])
+
+    def test_seed_from_global_state(self):
+        validator = Validator(self.columns_dir, self.network_filename, 4,
+                              seed=4)
+        recommender = Matrix_Factorization(n_features=2, engine='vectorized',
+                                           max_iterations=5)
+        results = []
+        for _ in range(2):
+            np.random.seed(6)
+            results.append(validator.validate(recommender, n_jobs=2,
+                                              seed=None))
+        self.assertEqual(results[0], results[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
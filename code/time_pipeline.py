@@ -0,0 +1,250 @@
+# Timing harness for the preprocessing stages (extract_network.py,
+# make_dataframes.py, and find_users_by_city.py).
+# It writes a synthetic dataset in the format of the Yelp json files
+# (scale=1 is about the size of the Yelp dataset: 366,715 users,
+# 61,184 businesses, and 1,569,264 reviews), and runs each stage on it,
+# printing the runtime of each stage.
+# With baseline_code_dir (the code directory of a checkout of the original
+# stage implementations, e.g. after
+#   git worktree add /tmp/baseline 4e5b366
+# it is /tmp/baseline/code), the original stages are timed on the same data
+# too, and the runtimes are printed side by side.
+# usage: python time_pipeline.py root_dir [scale [seed [baseline_code_dir]]]
+#   (json files are written into root_dir/data, and stages are run in
+#    root_dir/run, so that '../data' of each stage points to root_dir/data.)
+
+# Filename: time_pipeline.py
+
+import sys
+import os
+import glob
+import json
+import time
+import shutil
+import subprocess
+import numpy as np
+
+# Size of the Yelp dataset.
+n_users_yelp = 366715
+n_businesses_yelp = 61184
+n_reviews_yelp = 1569264
+n_cities = 10
+
+# Ratio of users with at least one friend, and their average degree.
+ratio_with_friends = 0.47
+mean_degree = 10
+# Probabilities of a friend, or a review, in the user's own city.
+p_same_city = 0.9
+p_review_same_city = 0.95
+
+# Stages, in order, and the script running one stage (in its own process,
+# with the stage module imported from the given code directory).
+stages = ['extract_network', 'make_dataframes', 'find_users_by_city']
+stage_script = """
+import time
+import numpy as np
+import %s as stage
+np.random.seed(%d)
+start = time.time()
+stage.main()
+print 'seconds: %%r' %% (time.time() - start)
+"""
+
+id_characters = np.array(list('abcdefghijklmnopqrstuvwxyz'
+                              'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-_'))
+
+
+def make_ids(n):
+    """
+    Create n random string id's (22 characters, like Yelp id's).
+    Input:
+        n: number of id's
+    Output:
+        ids: list of strings
+    """
+    chars = id_characters[np.random.randint(len(id_characters),
+                                            size=(n, 22))]
+    return [''.join(row) for row in chars]
+
+
+def write_synthetic_data(data_dir, scale=1.):
+    """
+    Write synthetic user, business, and review json files.
+    Users and businesses belong to one of ten cities (sizes of cities
+    decrease geometrically); most friends and reviews of a user are in the
+    user's city.
+    Input:
+        data_dir: directory for json files.
+        scale: size relative to the Yelp dataset (default: 1.)
+    Output:
+        None
+    """
+    n_users = int(n_users_yelp * scale)
+    n_businesses = int(n_businesses_yelp * scale)
+    n_reviews = int(n_reviews_yelp * scale)
+
+    city_probs = 0.6 ** np.arange(n_cities)
+    city_probs /= city_probs.sum()
+    centers = np.column_stack((33. + 3 * np.arange(n_cities),
+                               -112. + 5 * np.arange(n_cities)))
+
+    user_ids = make_ids(n_users)
+    user_city = np.random.choice(n_cities, n_users, p=city_probs)
+    business_ids = make_ids(n_businesses)
+    business_city = np.random.choice(n_cities, n_businesses, p=city_probs)
+    businesses_by_city = [np.flatnonzero(business_city == city)
+                          for city in range(n_cities)]
+    users_by_city = [np.flatnonzero(user_city == city)
+                     for city in range(n_cities)]
+
+    # Network: edges among users with friends, mostly within a city.
+    with_friends = np.flatnonzero(np.random.rand(n_users) <
+                                  ratio_with_friends)
+    n_edges = len(with_friends) * mean_degree // 2
+    id1 = with_friends[np.random.randint(len(with_friends), size=n_edges)]
+    id2 = with_friends[np.random.randint(len(with_friends), size=n_edges)]
+    same_city = np.random.rand(n_edges) < p_same_city
+    for city in range(n_cities):
+        candidates = np.intersect1d(users_by_city[city], with_friends)
+        selected = same_city & (user_city[id1] == city)
+        if len(candidates) > 0:
+            id2[selected] = candidates[
+                np.random.randint(len(candidates), size=selected.sum())]
+    edges = np.unique(np.column_stack((np.minimum(id1, id2),
+                                       np.maximum(id1, id2))), axis=0)
+    edges = edges[edges[:, 0] != edges[:, 1]]
+    edges = np.concatenate((edges, edges[:, ::-1]))
+    edges = edges[np.argsort(edges[:, 0], kind='mergesort')]
+    bounds = np.searchsorted(edges[:, 0], np.arange(n_users + 1))
+
+    with open(os.path.join(data_dir, 'yelp_academic_dataset_user.json'),
+              'w') as f:
+        review_counts = np.random.randint(1, 100, size=n_users)
+        stars = np.round(np.random.uniform(1, 5, size=n_users), 2)
+        for i in xrange(n_users):
+            friends = [user_ids[j] for j in
+                       edges[bounds[i]:bounds[i + 1], 1]]
+            f.write(json.dumps({'user_id': user_ids[i], 'type': 'user',
+                                'name': 'User',
+                                'review_count': int(review_counts[i]),
+                                'average_stars': float(stars[i]),
+                                'friends': friends}) + '\n')
+
+    with open(os.path.join(data_dir, 'yelp_academic_dataset_business.json'),
+              'w') as f:
+        review_counts = np.random.randint(3, 500, size=n_businesses)
+        stars = np.random.randint(2, 11, size=n_businesses) / 2.
+        locations = centers[business_city] +\
+            np.random.normal(0, 0.1, size=(n_businesses, 2))
+        for i in xrange(n_businesses):
+            f.write(json.dumps({'business_id': business_ids[i],
+                                'type': 'business',
+                                'city': 'City%s' % business_city[i],
+                                'review_count': int(review_counts[i]),
+                                'stars': float(stars[i]),
+                                'latitude': float(locations[i, 0]),
+                                'longitude': float(locations[i, 1]),
+                                'categories': ['Restaurants']}) + '\n')
+
+    with open(os.path.join(data_dir, 'yelp_academic_dataset_review.json'),
+              'w') as f:
+        reviewers = np.random.randint(n_users, size=n_reviews)
+        cities = np.where(np.random.rand(n_reviews) < p_review_same_city,
+                          user_city[reviewers],
+                          np.random.choice(n_cities, n_reviews,
+                                           p=city_probs))
+        picks = np.random.rand(n_reviews)
+        stars = np.random.randint(1, 6, size=n_reviews)
+        days = np.random.randint(1, 29, size=n_reviews)
+        for i in xrange(n_reviews):
+            candidates = businesses_by_city[cities[i]]
+            if len(candidates) == 0:
+                continue
+            business = candidates[int(picks[i] * len(candidates))]
+            f.write(json.dumps({'business_id': business_ids[business],
+                                'user_id': user_ids[reviewers[i]],
+                                'type': 'review',
+                                'stars': int(stars[i]),
+                                'date': '2014-06-%02d' % days[i],
+                                'text': 'Review.'}) + '\n')
+    return
+
+
+def time_stages(run_dir, code_dir, seed=0):
+    """
+    Run the preprocessing stages in order, and measure runtime of each.
+    Stored intermediate results (data/columns and pickled files) are removed
+    first, so that every stage runs from scratch. Each stage runs in a new
+    process, so that the original and current stages can be timed alike.
+    Input:
+        run_dir: directory to run stages in (sibling of the data directory).
+        code_dir: directory of the stage modules to run.
+        seed: random seed set before each stage (default: 0)
+    Output:
+        times: list of (stage name, seconds)
+    """
+    shutil.rmtree(os.path.join(run_dir, '../data/columns'),
+                  ignore_errors=True)
+    for filename in glob.glob(os.path.join(run_dir, '../data/*.pkl')):
+        os.remove(filename)
+    env = dict(os.environ, PYTHONPATH=os.path.abspath(code_dir))
+    times = []
+    for stage in stages:
+        output = subprocess.check_output(
+            [sys.executable, '-c', stage_script % (stage, seed)],
+            cwd=run_dir, env=env)
+        lines = output.rstrip('\n').split('\n')
+        if len(lines) > 1:
+            print '\n'.join(lines[:-1])
+        times.append((stage, float(lines[-1].split()[1])))
+    return times
+
+
+def main():
+    """
+    Write the synthetic data (if not written yet), and time stages.
+    """
+    root_dir = sys.argv[1]
+    scale = float(sys.argv[2]) if len(sys.argv) > 2 else 1.
+    seed = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+    baseline_code_dir = sys.argv[4] if len(sys.argv) > 4 else None
+    data_dir = os.path.join(root_dir, 'data')
+    run_dir = os.path.join(root_dir, 'run')
+    for directory in [data_dir, run_dir]:
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    np.random.seed(seed)
+    if not os.path.exists(os.path.join(data_dir,
+                                       'yelp_academic_dataset_review.json')):
+        start = time.time()
+        write_synthetic_data(data_dir, scale)
+        print "Synthetic data written (scale %s): %.1f s" % \
+            (scale, time.time() - start)
+
+    code_dir = os.path.dirname(os.path.abspath(__file__))
+    if baseline_code_dir is None:
+        times = time_stages(run_dir, code_dir, seed)
+        for (name, seconds) in times:
+            print "%s: %.1f s" % (name, seconds)
+        print "total: %.1f s" % sum(seconds for (_, seconds) in times)
+        return
+
+    # The current stages run last, so that the data directory is left with
+    # their results.
+    baseline_times = time_stages(run_dir, baseline_code_dir, seed)
+    times = time_stages(run_dir, code_dir, seed)
+    print "%-20s %10s %10s %8s" % ('stage', 'baseline', 'current',
+                                  'speedup')
+    rows = [(name, baseline, seconds) for ((name, baseline), (_, seconds))
+            in zip(baseline_times, times)]
+    rows.append(('total', sum(row[1] for row in rows),
+                 sum(row[2] for row in rows)))
+    for (name, baseline, seconds) in rows:
+        print "%-20s %8.1f s %8.1f s %7.1fx" % (name, baseline, seconds,
+                                                baseline / seconds)
+    return
+
+
+if __name__ == '__main__':
+    main()
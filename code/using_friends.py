@@ -6,6 +6,9 @@
 
 import numpy as np
 import itertools
+from scipy import sparse
+
+from csr_graph import CSR_Graph
 
 
 class Using_Friends():
@@ -15,11 +18,14 @@ class Using_Friends():
     """
     def __init__(self, my_network,
                  n_ratings_lower_limit=3, n_ratings_upper_limit=100,
-                 if_average=False):
+                 if_average=False, engine='loop', friends2_weight=0.,
+                 friends2=None):
         """
         Constructor of the class
         Input:
-            my_network: network info in the form of dict of lists.
+            my_network: network info in the form of dict of lists,
+                or CSR_Graph (neighbors are used as they are, without
+                copying them into sets).
             n_ratings_lower_limit: lower limit for the number of ratings
                 for prediction; should be 1 or higher  (default: 3)
             n_ratings_upper_limit: upper limit for the number
@@ -27,20 +33,54 @@ class Using_Friends():
                 (default: 100)
             if_average: if True, give average item average as a prediction.
                 If False, do not predict.
+            engine: 'loop' for dicts of sets and lists, or 'sparse' for
+                a CSC ratings matrix and a CSR friend adjacency, where each
+                prediction intersects two sorted index arrays
+                (same results, default: 'loop')
+            friends2_weight: weight of ratings by friends of friends
+                (not friends); if 0, only friends are used. The prediction
+                is the weighted mean (S1 + w * S2) / (N1 + w * N2) of
+                ratings by friends (sum S1, number N1) and friends of
+                friends (S2, N2), and limits apply to N1 + N2.
+                (default: 0.)
+            friends2: friends of friends as CSR_Graph, found beforehand
+                for the same network (e.g., Validator.get_friends2()), so
+                that it is not found again for every recommender
+                (default: None, found from my_network in fit method)
         """
         self.n_ratings_lower_limit = n_ratings_lower_limit
         self.n_ratings_upper_limit = n_ratings_upper_limit
         self.if_average = if_average
+        self.engine = engine
+        self.friends2_weight = friends2_weight
 
         self.ratings_mat = None  # will be obtained in fit method.
         self.ratings_mat_coo = None  # will be obtained in fit method.
         self.my_network = my_network
+        # Network as CSR_Graph, if given in that form.
+        if isinstance(my_network, CSR_Graph):
+            self.friends_graph = my_network
+        else:
+            self.friends_graph = None
         self.my_friends = {}  # will be found in fit method (dict of sets).
         self.my_friends2 = {}  # {friends of friends} - {friends} (dict of sets)
         # Only additional friends will be stored.
         # Rows with nonzero items given an item (list of lists).
         self.rows_nonzero = None
         self.average_ratings_item = None
+        self.ratings_csr = None  # for the sparse engine (sorted indices).
+        self.ratings_csc = None
+        self.friends_csr = None  # friend adjacency (sorted indices).
+        # Friends of friends as CSR_Graph and its adjacency, found once
+        # for the network (when friends2_weight > 0).
+        self.friends2_graph = friends2
+        self.friends2_csr = None
+        self.n_raters_item = None  # number of ratings for each item.
+        # Sums and numbers of friends' ratings (sparse products, found
+        # when batch predictions are needed).
+        self.friend_sums = None
+        self.friend_weights = None
+        self.friend_counts = None
 
         self.n_users = None
         self.n_items = None
@@ -49,6 +89,10 @@ class Using_Friends():
         # Finding friends and friends of friends for every user.
         # And store them in sets for easier searches.
         # self.my_network contains information for friends in a dict.
+        # (The sparse engine builds the adjacency in fit method instead,
+        # and CSR_Graph is used as it is.)
+        if self.engine == 'sparse' or self.friends_graph is not None:
+            return
         for user_id in self.my_network:
             # Add the friends (ones that are connected).
             if self.n_ratings_upper_limit == 0:  # Don't need to do any, if 0.
@@ -58,11 +102,22 @@ class Using_Friends():
         return
 
     def fit(self, ratings_mat):
-        self.ratings_mat = ratings_mat.copy()  # in dok (dictionary) format.
+        if self.engine == 'sparse':
+            return self._fit_sparse(ratings_mat)
+
+        self.ratings_mat = ratings_mat.todok()  # in dok (dictionary) format.
         # coo is better for looping over nonzero values (converting to coo).
         self.ratings_mat_coo = ratings_mat.tocoo()
         self.n_users, self.n_items = ratings_mat.shape
         self.n_rated = self.ratings_mat_coo.row.size
+        # csr is used for batch predictions.
+        self.ratings_csr = sparse.csr_matrix(ratings_mat)
+        self.ratings_csr.sort_indices()
+        self.n_raters_item = np.bincount(self.ratings_csr.indices,
+                                         minlength=self.n_items)
+        self.friend_sums = None
+        self.friend_weights = None
+        self.friend_counts = None
         print "    problem size:", self.n_users, self.n_items, self.n_rated
 
         # Here we also find rows with non-zero ratings for given item.
@@ -83,6 +138,8 @@ class Using_Friends():
         for icol in xrange(self.n_items):
             self.average_ratings_item[icol] =\
                 ratings_sum[icol] / len(self.rows_nonzero[icol])
+        if self.friends2_weight > 0:
+            self._find_friends2()
         """
         # For test purpose.
         with open('ratings_by_item', 'w') as f:
@@ -118,6 +175,161 @@ class Using_Friends():
 
         return self  # Return the fitted self in case.
 
+    def _fit_sparse(self, ratings_mat):
+        """
+        fit method for the sparse engine.
+        Ratings are stored in csr (by user) and csc (by item) formats, and
+        friends in a csr adjacency matrix, all with sorted indices.
+        """
+        self.ratings_csr = sparse.csr_matrix(ratings_mat)
+        self.ratings_csr.sort_indices()
+        self.ratings_csc = self.ratings_csr.tocsc()
+        self.ratings_csc.sort_indices()
+        self.n_users, self.n_items = ratings_mat.shape
+        self.n_rated = self.ratings_csr.nnz
+        print "    problem size:", self.n_users, self.n_items, self.n_rated
+
+        self.friend_sums = None
+        self.friend_weights = None
+        self.friend_counts = None
+
+        # Find the average rating for each item.
+        self.n_raters_item = np.diff(self.ratings_csc.indptr)
+        ratings_sum = np.asarray(self.ratings_csc.sum(axis=0)).ravel()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.average_ratings_item = ratings_sum / self.n_raters_item
+
+        if self.friends_csr is None or \
+                self.friends_csr.shape[0] < self.n_users:
+            self.friends_csr = self._find_friends_csr()
+        if self.friends2_weight > 0:
+            self._find_friends2()
+        print "    Fitting done."
+
+        return self  # Return the fitted self in case.
+
+    def _find_friends_csr(self):
+        """
+        Build the friend adjacency matrix (csr, sorted indices without
+        duplicates) from self.my_network.
+        Output:
+            adjacency: sparse.csr_matrix (n x n, n >= n_users)
+        """
+        if self.friends_graph is not None:
+            return self.friends_graph.to_sparse(
+                max(self.n_users, self.friends_graph.n_nodes))
+        users = [user_id for user_id in self.my_network]
+        lengths = [len(self.my_network[user_id]) for user_id in users]
+        rows = np.repeat(np.array(users, dtype=np.int64), lengths)
+        cols = np.fromiter(itertools.chain.from_iterable(
+            self.my_network[user_id] for user_id in users),
+            dtype=np.int64, count=sum(lengths))
+        size = max([self.n_users] + [ids.max() + 1 for ids in (rows, cols)
+                                     if ids.size])
+        adjacency = sparse.csr_matrix(
+            (np.ones(rows.size, dtype=np.int8), (rows, cols)),
+            shape=(size, size))
+        adjacency.sum_duplicates()  # also sorts indices.
+        adjacency.data[:] = 1
+        return adjacency
+
+    def _find_friends2(self):
+        """
+        Find friends of friends (excluding the user and friends) for every
+        user from the sparse product A * A of the friend adjacency, unless
+        they are given or found already. For the loop engine with a dict
+        network,
+        self.my_friends2 is filled (dict of sets).
+        """
+        if self.friends2_csr is not None and \
+                self.friends2_csr.shape[0] >= self.n_users:
+            return
+        if self.friends2_graph is None:
+            if self.friends_csr is None or \
+                    self.friends_csr.shape[0] < self.n_users:
+                self.friends_csr = self._find_friends_csr()
+            self.friends2_graph = CSR_Graph(self.friends_csr.indptr,
+                                            self.friends_csr.indices).two_hop()
+        self.friends2_csr = self.friends2_graph.to_sparse(
+            max(self.n_users, self.friends2_graph.n_nodes))
+        if self.engine == 'sparse' or self.friends_graph is not None:
+            return
+        for user_id in self.my_network:
+            if self.n_ratings_upper_limit == 0:
+                self.my_friends2[user_id] = set([])
+            else:
+                self.my_friends2[user_id] = set(
+                    self.friends2_graph.neighbors(user_id).tolist())
+        return
+
+    def _no_prediction(self, item_id):
+        """
+        Value returned when there are not enough ratings for prediction.
+        """
+        if self.if_average:
+            return self.average_ratings_item[item_id]
+        else:
+            return 0
+
+    def _pred_one_rating_sparse(self, user_id, item_id):
+        """
+        pred_one_rating method for the sparse engine.
+        Raters of the item (csc column) and friends of the user (csr row)
+        are both sorted, so friends who rated the item are found with
+        one searchsorted.
+        """
+        # For already rated user-item pair.
+        start, end = self.ratings_csr.indptr[user_id:user_id + 2]
+        rated_items = self.ratings_csr.indices[start:end]
+        pos = np.searchsorted(rated_items, item_id)
+        if pos < rated_items.size and rated_items[pos] == item_id:
+            return self.ratings_csr.data[start + pos]
+
+        # Rows for non-zero ratings for the given item.
+        start, end = self.ratings_csc.indptr[item_id:item_id + 2]
+        if end - start < self.n_ratings_lower_limit:
+            return self._no_prediction(item_id)
+        raters = self.ratings_csc.indices[start:end]
+        temp_ratings = self._ratings_by(self.friends_csr, user_id, raters,
+                                        start, end)
+        temp_ratings2 = np.zeros(0)
+        if self.friends2_weight > 0:
+            temp_ratings2 = self._ratings_by(self.friends2_csr, user_id,
+                                             raters, start, end)
+        # Only the number of ratings is limited by the upper limit
+        # (same as pick_random in the loop engine).
+        if min(temp_ratings.size + temp_ratings2.size,
+               self.n_ratings_upper_limit) < self.n_ratings_lower_limit:
+            return self._no_prediction(item_id)
+        elif temp_ratings2.size == 0:
+            return np.mean(temp_ratings)
+        else:
+            return (temp_ratings.sum() +
+                    self.friends2_weight * temp_ratings2.sum()) /\
+                (temp_ratings.size + self.friends2_weight * temp_ratings2.size)
+
+    def _ratings_by(self, adjacency, user_id, raters, start, end):
+        """
+        Find ratings of an item by neighbors of the user (for the sparse
+        engine).
+        Input:
+            adjacency: sparse.csr_matrix (sorted indices), e.g., friends
+            user_id: ID of the user
+            raters: raters of the item (sorted, the csc column)
+            start, end: range of the csc column of the item
+        Output:
+            ratings: np.array
+        """
+        if user_id + 1 >= adjacency.indptr.size:
+            return np.zeros(0)
+        friends = adjacency.indices[adjacency.indptr[user_id]:
+                                    adjacency.indptr[user_id + 1]]
+        if friends.size == 0:
+            return np.zeros(0)
+        is_friend = friends.take(np.searchsorted(friends, raters),
+                                 mode='clip') == raters
+        return self.ratings_csc.data[start:end][is_friend]
+
     def pred_one_rating(self, user_id, item_id):
         """
         Predict for one user-item pair
@@ -130,6 +342,9 @@ class Using_Friends():
         Output:
             rating: predicted rating.
         """
+        if self.engine == 'sparse':
+            return self._pred_one_rating_sparse(user_id, item_id)
+
         # For already rated user-item pair.
         if self.ratings_mat[user_id, item_id] != 0:
             return self.ratings_mat[user_id, item_id]
@@ -144,18 +359,55 @@ class Using_Friends():
             else:
                 return 0
         temp_ratings = []
+        temp_ratings_friends2 = []  # by friends of friends.
         for irow in rows:  # For all rows with non-zero ratings.
-            if irow in self.my_friends[user_id]:
+            if self._is_friend(user_id, irow):
                 temp_ratings.append(self.ratings_mat[irow, item_id])
-        temp_ratings2 = self.pick_random(temp_ratings,
+            elif self.friends2_weight > 0 and \
+                    self._is_friend2(user_id, irow):
+                temp_ratings_friends2.append(self.ratings_mat[irow, item_id])
+        temp_ratings2 = self.pick_random(temp_ratings + temp_ratings_friends2,
                                          self.n_ratings_upper_limit)
         if len(temp_ratings2) < self.n_ratings_lower_limit:
             if self.if_average:
                 return self.average_ratings_item[item_id]
             else:
                 return 0
-        else:
+        elif not temp_ratings_friends2:
             return np.mean(temp_ratings)
+        else:
+            return (np.sum(temp_ratings) +
+                    self.friends2_weight * np.sum(temp_ratings_friends2)) /\
+                (len(temp_ratings) +
+                 self.friends2_weight * len(temp_ratings_friends2))
+
+    def _is_friend(self, user_id, friend_id):
+        """
+        Check if friend_id is a friend of user_id (for the loop engine).
+        """
+        if self.friends_graph is not None:
+            return self.friends_graph.has_edge(user_id, friend_id)
+        return friend_id in self.my_friends[user_id]
+
+    def _is_friend2(self, user_id, friend_id):
+        """
+        Check if friend_id is a friend of a friend (not a friend) of user_id
+        (for the loop engine).
+        """
+        if self.friends_graph is not None:
+            return self.friends2_graph.has_edge(user_id, friend_id)
+        return friend_id in self.my_friends2[user_id]
+
+    def predict_batch(self, rows, cols):
+        """
+        Batch prediction used by Validator (same as predict_pairs).
+        Input:
+            rows: user ID's (1d np.array)
+            cols: item ID's (1d np.array, same size as rows)
+        Output:
+            predicted: np.array (1d)
+        """
+        return self.predict_pairs(rows, cols)
 
     def pred_one_user(self, user_id):
         """
@@ -171,11 +423,12 @@ class Using_Friends():
         Output:
             predicted: np.array (1d)
         """
-        prediction = np.zeros(self.n_items)  # Initialize predictions.
-        for item_id in xrange(self.n_items):
-            prediction[item_id] = self.pred_one_rating(user_id, item_id)
-            # There is no efficiency lost, by calling this function one by one.
-        return prediction
+        (sums, weights, counts) = self._friend_aggregates([user_id])
+        rated = self.ratings_csr[user_id].toarray()[0]
+        return self._predict_from_aggregates(sums.toarray()[0],
+                                             weights.toarray()[0],
+                                             counts.toarray()[0], rated,
+                                             np.arange(self.n_items))
 
     def pred_all(self):
         """
@@ -183,7 +436,108 @@ class Using_Friends():
         Output:
             predicted: np.array (2d)
         """
-        return None  # not implemeted here.
+        (sums, weights, counts) = self._friend_aggregates()
+        return self._predict_from_aggregates(sums.toarray(),
+                                             weights.toarray(),
+                                             counts.toarray(),
+                                             self.ratings_csr.toarray(),
+                                             np.arange(self.n_items))
+
+    def predict_pairs(self, rows, cols):
+        """
+        Predict for many user-item pairs at once (e.g., the row and col
+        arrays of a coo matrix), with the same rules as pred_one_rating.
+        Input:
+            rows: user ID's (1d np.array)
+            cols: item ID's (1d np.array, same size as rows)
+        Output:
+            predicted: np.array (1d)
+        """
+        rows = np.asarray(rows)
+        cols = np.asarray(cols)
+        if rows.size == 0:
+            return np.zeros(0)
+        (sums, weights, counts) = self._friend_aggregates()
+        return self._predict_from_aggregates(
+            np.asarray(sums[rows, cols]).ravel(),
+            np.asarray(weights[rows, cols]).ravel(),
+            np.asarray(counts[rows, cols]).ravel(),
+            np.asarray(self.ratings_csr[rows, cols]).ravel(), cols)
+
+    def _friend_aggregates(self, users=None):
+        """
+        Find sums and numbers of friends' ratings for every item as sparse
+        products: A * R for sums, and A * (R != 0) for numbers, where A is
+        the friend adjacency and R is the ratings matrix.
+        With friends of friends (adjacency A2), W = A + w * A2 is used for
+        weighted sums (W * R) and weights (W * (R != 0)), and A + A2 for
+        numbers.
+        Results for all users are kept until the next fit.
+        Input:
+            users: list of users (rows of A) (default: all users)
+        Output:
+            sums: sparse.csr_matrix (users x items)
+            weights: sparse.csr_matrix (users x items, same as counts
+                without friends of friends)
+            counts: sparse.csr_matrix (users x items)
+        """
+        if users is None and self.friend_sums is not None:
+            return (self.friend_sums, self.friend_weights, self.friend_counts)
+        if self.friends_csr is None or \
+                self.friends_csr.shape[0] < self.n_users:
+            self.friends_csr = self._find_friends_csr()
+        adjacency = self.friends_csr[:self.n_users, :self.n_users]
+        if users is not None:
+            adjacency = adjacency[users]
+        indicator = self.ratings_csr.copy()
+        indicator.data = np.ones(indicator.nnz, dtype=np.int32)
+        if self.friends2_weight > 0:
+            self._find_friends2()
+            adjacency2 = self.friends2_csr[:self.n_users, :self.n_users]
+            if users is not None:
+                adjacency2 = adjacency2[users]
+            weighted = adjacency.astype(np.float64) +\
+                self.friends2_weight * adjacency2.astype(np.float64)
+            sums = weighted * self.ratings_csr
+            weights = weighted * indicator
+            counts = (adjacency + adjacency2) * indicator
+        else:
+            sums = adjacency * self.ratings_csr
+            counts = adjacency * indicator
+            weights = counts
+        if users is None:
+            (self.friend_sums, self.friend_weights, self.friend_counts) =\
+                (sums, weights, counts)
+        return (sums, weights, counts)
+
+    def _predict_from_aggregates(self, sums, weights, counts, rated, cols):
+        """
+        Vectorized version of pred_one_rating: apply lower/upper limits and
+        the item average (if_average) to sums and numbers of friends'
+        ratings, as masks.
+        Input:
+            sums: (weighted) sums of friends' ratings (np.array)
+            weights: sums of weights of friends' ratings (np.array,
+                same shape)
+            counts: numbers of friends' ratings (np.array, same shape)
+            rated: already given ratings, 0 if not rated (same shape)
+            cols: item ID's (np.array, broadcastable to the same shape)
+        Output:
+            predicted: np.array (same shape as sums)
+        """
+        # Enough ratings for the item, and enough (limited) friends' ratings.
+        enough = (self.n_raters_item[cols] >= self.n_ratings_lower_limit) &\
+            (np.minimum(counts, self.n_ratings_upper_limit) >=
+             self.n_ratings_lower_limit)
+        if self.if_average:
+            no_prediction = self.average_ratings_item[cols]
+        else:
+            no_prediction = 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            prediction = np.where(enough, sums / weights.astype(float),
+                                  no_prediction)
+        # For already rated user-item pairs.
+        return np.where(rated != 0, rated, prediction)
 
     def top_n_recs(self, user_id, num):
         """
@@ -196,9 +550,7 @@ class Using_Friends():
         """
         pred_output = self.pred_one_user(user_id)  # 1d np.array
         items_predicted = np.ones(self.n_items, dtype='bool')
-        for icol in xrange(self.n_items):
-            if self.ratings_mat[user_id, icol]:
-                items_predicted[icol] = False
+        items_predicted[self.ratings_csr[user_id].indices] = False
         return np.argsort(pred_output[items_predicted])[-num:][::-1]
 
     def pick_random(self, ratings_list, n_ratings_limit, seed=789):
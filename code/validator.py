@@ -11,7 +11,25 @@ import pandas as pd
 import numpy as np
 from scipy import sparse
 import itertools
+import copy
+import os
+import shutil
+import tempfile
 from my_utilities import read_dictlist_from_file, reindex_graph
+from my_utilities import read_columns, read_graph_from_file
+from my_utilities import fork_pool, get_worker_state
+from csr_graph import CSR_Graph, is_graph_file
+
+# Names of the arrays (attributes of Validator) shared with worker processes
+# through memory-mapped files.
+shared_array_names = ['rows', 'cols', 'ratings', 'fold_number']
+
+def run_fold_worker(i):
+    """
+    Run validation for i-th fold in a worker process of fork_pool.
+    """
+    (validator, recommender, use_average, seed) = get_worker_state()
+    return validator.validate_fold(recommender, i, use_average, seed)
 
 
 class Validator():
@@ -19,114 +37,157 @@ class Validator():
     Class for reading the ratings file, and computing RMSE's for the given model
     """
     def __init__(self, ratings_filename, network_filename, k=5,
-                 test_ratio=None):
+                 test_ratio=None, seed=None, network_format='dict'):
         """
         Constructor for Validator class.
         It will read the ratings information from the file
-        and save it to a sparse matrix (dok format).
+        and save it to sparse matrices (csr format).
         Input:
-            ratings_filename: filename for ratings.
+            ratings_filename: filename for ratings (csv with no header),
+                or directory of ratings in the columnar format
+                (user_id.npy, item_id.npy, rating.npy, memory-mapped).
             network_filename: filename for the network
                 (in csv format with no header)
                 ("2,1,3,4" in a line means 2 has friends 1, 3, and 4)
+                or a binary graph file ('.csrg', memory-mapped),
+                or the network as CSR_Graph.
             k: number of folds for cross validation (default: 5)
             test_ratio: ratio of test set (float, 0~1, default: None)
+            seed: random seed for assigning folds; if None, the global
+                random state is used (default: None)
+            network_format: 'dict' for dict of lists, or 'csr' for
+                CSR_Graph (default: 'dict')
         """
         self.my_network = {}
+        # Network and friends of friends as CSR_Graph (found when needed,
+        # once for all folds and parameters).
+        self.friends_graph = None
+        self.friends2_graph = None
         self.ratings_filename = ratings_filename
         self.k = int(k)
         self.test_ratio = test_ratio
 
         # Read the files.
-        ratings_contents = pd.read_csv(ratings_filename,
-                                       names=['user_id', 'item_id', 'rating'],
-                                       header=None)
-
-        # Creating matrices.
-        # ratings_mat: ratings info on a matrix
-        # ratings_testing: ratings info for testing (test set).
-        # list_ratings_val: list of ratings for validation (determined by k)
-        # list_ratings_training: list of ratings for training (determined by k)
-        u_size = ratings_contents.user_id.nunique()
-        i_size = ratings_contents.item_id.nunique()
-        self.ratings_train = sparse.dok_matrix((u_size, i_size))
-        self.ratings_test = sparse.dok_matrix((u_size, i_size))
-        self.list_ratings_val = []
-        self.list_ratings_rest = []
-        for i in range(self.k):
-            self.list_ratings_val.append(sparse.dok_matrix((u_size, i_size)))
-            self.list_ratings_rest.append(sparse.dok_matrix((u_size, i_size)))
-        # Since no arithmetic will be used for these matrices,
-        # dok_matrix (dictionary of keys) will be used.
+        if os.path.isdir(ratings_filename):
+            ratings_contents = read_columns(ratings_filename)
+        else:
+            ratings_contents = pd.read_csv(ratings_filename,
+                                           names=['user_id', 'item_id',
+                                                  'rating'],
+                                           header=None)
+
+        # Converting user_id and item_id to make them continuous starting from 0
+        # (in the order of first appearance).
+        self.n_reviews = len(ratings_contents['rating'])
+        (user_codes, user_ids) = pd.factorize(ratings_contents['user_id'])
+        (item_codes, item_ids) = pd.factorize(ratings_contents['item_id'])
+        u_size = len(user_ids)
+        i_size = len(item_ids)
 
         # Dict to store ID mapping info.
-        self.users_id_map = {}
-        self.items_id_map = {}
+        self.users_id_map = dict(itertools.izip(user_ids.tolist(),
+                                                xrange(u_size)))
+        self.items_id_map = dict(itertools.izip(item_ids.tolist(),
+                                                xrange(i_size)))
 
-        # Converting user_id and item_id to make them continuous starting from 0
-        u_id = 0  # New id for users starting from 0 to size-1
-        i_id = 0  # New id for items starting from 0 to size-1
-
-        # As we read the data, we will perform the division for k folds.
-        # And ratings matrices for all folds and outside of folds will be
-        # stored in lists of matrices.
-        self.n_reviews = ratings_contents.shape[0]
-
-        rating_dict = {}  # dict to store ratings
-        for _, row in ratings_contents.iterrows():
-            u_temp = int(row.user_id)
-            i_temp = int(row.item_id)
-            if u_temp not in self.users_id_map:
-                self.users_id_map[u_temp] = u_id
-                u_id += 1
-            if i_temp not in self.items_id_map:
-                self.items_id_map[i_temp] = i_id
-                i_id += 1
-            uu = self.users_id_map[u_temp]
-            ii = self.items_id_map[i_temp]
-            pair = (uu, ii)
-            rating = float(row.rating)
-
-            if pair not in rating_dict:
-                rating_dict[pair] = [rating]
-            else:
-                rating_dict[pair].append(rating)
+        # In case there are multiple ratings for the same (user, business)
+        # pair, take the average.
+        ratings_by_pair = pd.DataFrame({'user': user_codes,
+                                        'item': item_codes,
+                                        'rating': np.asarray(
+                                            ratings_contents['rating'],
+                                            dtype=float)})\
+            .groupby(['user', 'item'], sort=False).rating.mean()
+        self.rows = ratings_by_pair.index.get_level_values('user').values
+        self.cols = ratings_by_pair.index.get_level_values('item').values
+        self.ratings = ratings_by_pair.values
+        self.shape = (u_size, i_size)
 
         # Assigning sets for cross-validations.
-        fold_number = []  # Fold number for each review. (-1: for test set)
-        for _ in xrange(len(rating_dict)):
-            if np.random.rand() < self.test_ratio:
-                fold_number.append(-1)
-            else:
-                fold_number.append(np.random.randint(self.k))
-        count = 0
-        for pair in rating_dict:
-            (uu, ii) = pair
-            # In case there are multiple ratings for the same (user, business)
-            # pair, take the average.
-            rating = np.mean(rating_dict[pair])
-            if fold_number[count] == -1:
-                self.ratings_test[uu, ii] = rating
-            else:
-                self.ratings_train[uu, ii] = rating
-                for j in range(k):
-                    if fold_number[count] == j:  # Inside fold.
-                        self.list_ratings_val[j][uu, ii] = rating
-                    else:  # Outside fold.
-                        self.list_ratings_rest[j][uu, ii] = rating
-            count += 1
+        # Fold number for each rating. (-1: for test set)
+        if seed is None:
+            random_state = np.random
+        else:
+            random_state = np.random.RandomState(seed)
+        n_pairs = len(self.ratings)
+        in_test = random_state.rand(n_pairs) < (self.test_ratio or 0)
+        fold_number = random_state.randint(self.k, size=n_pairs)
+        fold_number[in_test] = -1
+
+        # Ratings are stored only once, sorted by fold number, so that
+        # each fold is a contiguous slice of the arrays (test set first).
+        order = np.argsort(fold_number, kind='mergesort')
+        self.rows = self.rows[order]
+        self.cols = self.cols[order]
+        self.ratings = self.ratings[order]
+        self.fold_number = fold_number[order]
+        self.fold_bounds = np.searchsorted(self.fold_number,
+                                           np.arange(-1, self.k + 1))
+
+        # Ratings matrices for the whole training set and the test set.
+        # (Matrices for k folds are created when needed.)
+        self.ratings_train = self.ratings_matrix(
+            slice(self.fold_bounds[1], None))
+        self.ratings_test = self.ratings_matrix(
+            slice(None, self.fold_bounds[1]))
 
         # Now read the network.
-        temp_network = read_dictlist_from_file(network_filename)
+        if isinstance(network_filename, CSR_Graph):
+            temp_network = network_filename
+        elif is_graph_file(network_filename):
+            temp_network = read_graph_from_file(network_filename)
+        else:
+            temp_network = read_dictlist_from_file(network_filename)
         # But we need to map ID's into consecutive integers.
-        self.my_network, users_id_map, not_counted =\
-            reindex_graph(temp_network, self.users_id_map)
+        if network_format == 'csr':
+            if not isinstance(temp_network, CSR_Graph):
+                temp_network = CSR_Graph.from_dictlist(temp_network)
+            self.my_network, not_counted =\
+                temp_network.reindex(self.users_id_map)
+        else:
+            if isinstance(temp_network, CSR_Graph):
+                temp_network = temp_network.to_dictlist()
+            self.my_network, users_id_map, not_counted =\
+                reindex_graph(temp_network, self.users_id_map)
         if not_counted > 0:
             print "    There are some users not counted for the network:", \
                 not_counted
         return
 
-    def validate(self, recommender, use_average=False, run_all=True):
+    def ratings_matrix(self, index, format='csr'):
+        """
+        Build a ratings matrix with the selected ratings.
+        Input:
+            index: slice (a view, no copy) or boolean mask of the ratings.
+            format: 'csr' or 'coo' (default: 'csr')
+        Output:
+            ratings: sparse matrix (users x items)
+        """
+        ratings = sparse.coo_matrix((self.ratings[index],
+                                     (self.rows[index], self.cols[index])),
+                                    shape=self.shape)
+        if format == 'coo':
+            return ratings
+        return ratings.tocsr()
+
+    def get_ratings_val(self, i):
+        """
+        Return the ratings of i-th fold (validation set) in coo format,
+        built on views of the stored arrays.
+        """
+        return self.ratings_matrix(
+            slice(self.fold_bounds[i + 1], self.fold_bounds[i + 2]), 'coo')
+
+    def get_ratings_rest(self, i):
+        """
+        Return the ratings outside of i-th fold (training set for the fold)
+        in csr format.
+        """
+        return self.ratings_matrix((self.fold_number >= 0) &
+                                   (self.fold_number != i))
+
+    def validate(self, recommender, use_average=False, run_all=True,
+                 n_jobs=1, seed=0, folds=None):
         """
         Perform the K-fold validation using k folds (k times)
         Here we already have split ratings for k folds.
@@ -134,41 +195,112 @@ class Validator():
             recommender: model
             ratings: ratings matrix for
             use_average: if True, predict using just averages (default: False)
+            run_all: if False, only the first fold is used (default: True)
+            n_jobs: number of processes to run folds in parallel. Ratings are
+                shared by memory-mapped files. The recommender is fitted in
+                the worker processes, so it is not fitted after this.
+                Worker processes cannot start processes, so recommenders
+                run in one process there (e.g., the ALS solver of
+                Matrix_Factorization ignores its n_jobs). (default: 1)
+            seed: the random seed is set to seed + i before fitting i-th
+                fold, so that results are reproducible (and the same for
+                any n_jobs). If None, the global random state is used as it
+                is with n_jobs=1; with n_jobs > 1, a seed is drawn from it,
+                since folds in worker processes would otherwise depend on
+                which worker runs them. (default: 0)
+            folds: list of folds to use; overrides run_all (default: None)
         Output:
             rmse: list of RMSE for each fold.
+            ratio: list of ratios of ratings predicted for each fold.
         """
         # Perform k-fold validation k times.
-        list_rmse = []
-        list_ratio = []  # Ratio of predictions.
-        if run_all:
-            for i in range(self.k):
-                print "Validation set", i, "started."
-                recommender.fit(self.list_ratings_rest[i])
-                if use_average:
-                    prediction = recommender.pred_average(False, True)
-                    (rmse, ratio) =\
-                        self.find_rmse_prediction(prediction,
-                                                  self.list_ratings_val[i])
-                else:
-                    (rmse, ratio) =\
-                        self.find_rmse(recommender, self.list_ratings_val[i])
-                list_rmse.append(rmse)
-                list_ratio.append(ratio)
+        if folds is None:
+            folds = range(self.k) if run_all else [0]
+        if n_jobs > 1 and len(folds) > 1:
+            if seed is None:
+                seed = np.random.randint(2**31 - max(folds) - 1)
+            results = self.validate_parallel(recommender, folds, use_average,
+                                             n_jobs, seed)
         else:
-            print "Validation set", 0, "started."
-            recommender.fit(self.list_ratings_rest[0])
-            if use_average:
-                prediction = recommender.pred_average(False, True)
-                (rmse, ratio) =\
-                    self.find_rmse_prediction(prediction,
-                                              self.list_ratings_val[0])
-            else:
-                (rmse, ratio) =\
-                    self.find_rmse(recommender, self.list_ratings_val[0])
-            list_rmse.append(rmse)
-            list_ratio.append(ratio)
+            results = [self.validate_fold(recommender, i, use_average, seed)
+                       for i in folds]
+        list_rmse = [rmse for (rmse, _) in results]
+        list_ratio = [ratio for (_, ratio) in results]  # Ratio of predictions.
         return list_rmse, list_ratio
 
+    def validate_fold(self, recommender, i, use_average=False, seed=None):
+        """
+        Fit the recommender with ratings outside of i-th fold, and find the
+        RMSE for i-th fold.
+        Input:
+            recommender: model
+            i: fold number
+            use_average: if True, predict using just averages (default: False)
+            seed: if given, random seed is set to seed + i (default: None)
+        Output:
+            rmse: float
+            ratio_predicted: ratio of ratigns predicted (float)
+        """
+        print "Validation set", i, "started."
+        if seed is not None:
+            np.random.seed(seed + i)
+        recommender.fit(self.get_ratings_rest(i))
+        if use_average:
+            return self.find_rmse_average(recommender, self.get_ratings_val(i))
+        else:
+            return self.find_rmse(recommender, self.get_ratings_val(i))
+
+    def validate_parallel(self, recommender, folds, use_average, n_jobs,
+                          seed=None):
+        """
+        Run validate_fold for given folds in a process pool.
+        Ratings arrays are saved once in a temporary directory, and
+        memory-mapped by workers; only fold numbers are sent to workers.
+        Input:
+            recommender: model
+            folds: list of fold numbers
+            use_average: if True, predict using just averages
+            n_jobs: number of processes
+            seed: random seed (default: None)
+        Output:
+            results: list of (rmse, ratio) in the order of folds.
+        """
+        array_dir = tempfile.mkdtemp(prefix='validator_')
+        try:
+            # Workers get a copy of the validator with the arrays
+            # memory-mapped (read-only, shared among processes).
+            validator = copy.copy(self)
+            for name in shared_array_names:
+                filename = os.path.join(array_dir, name + '.npy')
+                np.save(filename, getattr(self, name))
+                setattr(validator, name, np.load(filename, mmap_mode='r'))
+            pool = fork_pool((validator, recommender, use_average, seed),
+                             min(n_jobs, len(folds)))
+            try:
+                results = pool.map(run_fold_worker, folds, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            shutil.rmtree(array_dir, ignore_errors=True)
+        return results
+
+    def rmse_hook(self, i):
+        """
+        Return a function that finds the RMSE of i-th fold for a (partially)
+        fitted recommender, e.g., for validation_hook of
+        Matrix_Factorization.
+        Input:
+            i: fold number
+        Output:
+            hook: function (recommender) -> rmse
+        """
+        ratings_val = self.get_ratings_val(i)
+
+        def hook(recommender):
+            return self.find_rmse(recommender, ratings_val)[0]
+        return hook
+
     def find_test_rmse(self, recommender):
         """
         Find the RMSE for the test set
@@ -195,6 +327,10 @@ class Validator():
             ratio_predicted: ratio of ratigns predicted (float)
         """
         mat = ratings.tocoo()  # coo format is know to be faster when looping.
+        # Use batch predictions if the recommender has them.
+        if hasattr(recommender, 'predict_batch'):
+            return self.find_rmse_values(
+                recommender.predict_batch(mat.row, mat.col), mat.data)
         n_total = len(mat.row)
         # Loop over non-zero values
         squared_sum = 0.
@@ -225,22 +361,52 @@ class Validator():
             rmse: float
             ratio_predicted: ratio of ratigns predicted (float)
         """
-        mat = ratings.tocoo()  # coo format is know to be faster when looping.
-        n_total = len(mat.row)
-        # Loop over non-zero values
-        squared_sum = 0.
-        n_not_predicted = 0
-        n_predicted = 0
-        for irow, icol, val in itertools.izip(mat.row, mat.col, mat.data):
-            if prediction[irow, icol] > 0.0001:
-                squared_sum += (val - prediction[irow, icol])**2
-                n_predicted += 1
-            else:
-                n_not_predicted += 1
+        mat = ratings.tocoo()
+        return self.find_rmse_values(
+            np.asarray(prediction[mat.row, mat.col]).ravel(), mat.data)
+
+    def find_rmse_average(self, recommender, ratings, user_bias=False,
+                          item_bias=True):
+        """
+        Using the averages (and biases) of the fitted model, compute the RMSE
+        of the validation set. Only pairs in the validation set are
+        predicted (the whole prediction matrix is not built).
+        Input:
+            recommender: model (fitted, with pred_average_pairs method)
+            ratings_val: sparse matrix containing validation set.
+            user_bias: if True, add user_bias (default: False)
+            item_bias: if True, add item_bias (default: True)
+        Output:
+            rmse: float
+            ratio_predicted: ratio of ratigns predicted (float)
+        """
+        mat = ratings.tocoo()
+        return self.find_rmse_values(
+            recommender.pred_average_pairs(mat.row, mat.col, user_bias,
+                                           item_bias), mat.data)
+
+    def find_rmse_values(self, predicted, ratings):
+        """
+        Compute the RMSE from arrays of predicted and actual ratings.
+        Predictions below 0.0001 mean there is no prediction, and they are
+        ignored (but counted in the ratio).
+        Input:
+            predicted: predicted ratings (1d np.array)
+            ratings: actual ratings (1d np.array, same size)
+        Output:
+            rmse: float
+            ratio_predicted: ratio of ratigns predicted (float)
+        """
+        n_total = len(ratings)
+        with np.errstate(invalid='ignore'):  # nan is not a prediction.
+            is_predicted = predicted > 0.0001
+        n_predicted = np.count_nonzero(is_predicted)
         if n_predicted == 0:
             return (None, None)
         else:
-            return np.sqrt(squared_sum/n_predicted), n_predicted/float(n_total)
+            errors = ratings[is_predicted] - predicted[is_predicted]
+            return np.sqrt(np.dot(errors, errors)/n_predicted),\
+                n_predicted/float(n_total)
 
     def get_baseline(self):
         """
@@ -254,10 +420,32 @@ class Validator():
 
     def get_network(self):
         """
-        Return the network in a dict of lists
+        Return the network in a dict of lists (or CSR_Graph)
         """
         return self.my_network
 
+    def get_friends_graph(self):
+        """
+        Return the network as CSR_Graph (converted once, and kept).
+        """
+        if self.friends_graph is None:
+            if isinstance(self.my_network, CSR_Graph):
+                self.friends_graph = self.my_network
+            else:
+                self.friends_graph = CSR_Graph.from_dictlist(
+                    self.my_network, self.shape[0])
+        return self.friends_graph
+
+    def get_friends2(self):
+        """
+        Return friends of friends (excluding friends) as CSR_Graph, found
+        once with CSR_Graph.two_hop, and kept (e.g., for friends2 of
+        Using_Friends).
+        """
+        if self.friends2_graph is None:
+            self.friends2_graph = self.get_friends_graph().two_hop()
+        return self.friends2_graph
+
     def get_matrix_train(self):
         """
         Return the ratigns matrix of a train set.